@@ -0,0 +1,420 @@
+# pihsm: Turn your Raspberry Pi into a Hardware Security Module 
+# Copyright (C) 2017 System76, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Serve the serial ports from an asyncio event loop.
+
+Each port is served by two tasks.  The reader reads the port without blocking
+as bytes arrive, answers pings (and baudrate frames) as soon as they're read,
+and queues the request frames.  The signer takes every request frame queued by
+the time it's free and sends them to the PrivateServer in one round trip, so
+while it's waiting on one run the reader carries on queueing the next.
+"""
+
+import asyncio
+import errno
+import logging
+import os
+import select
+import socket
+import time
+from collections import deque
+
+from .common import (
+    IPC_TIMEOUT,
+    SERIAL_TIMEOUT,
+    RESPONSE,
+    log_request,
+    log_response,
+)
+from .capture import WRITE
+from .verify import verify_message
+from .ipc import DEFAULT_CHAIN, check_chain_name, pack_private_request
+from .serial import POLL_INTERVAL, PolledSerialServer
+from .wire import (
+    FULL_REQUEST,
+    COMPACT_REQUEST,
+    BATCH_REQUEST,
+    MAX_BATCH,
+    next_seq,
+    pack_frame,
+)
+
+
+log = logging.getLogger(__name__)
+
+
+# The async counterpart of ipc.PrivateClient.  Over SOCK_SEQPACKET up to
+# MAX_BATCH requests go in one message; over SOCK_STREAM it's a connection per
+# request.  With a *chain*, the requests are signed by that chain, which needs
+# SOCK_SEQPACKET:
+class AsyncPrivateClient:
+    __slots__ = ('filename', 'sock_type', 'buf', 'lock', 'chain')
+
+    def __init__(self, filename='/run/pihsm/private.socket', sock_type=None,
+            chain=None):
+        assert sock_type in (None, socket.SOCK_STREAM, socket.SOCK_SEQPACKET)
+        self.filename = filename
+        self.sock_type = sock_type
+        self.buf = bytearray(RESPONSE * MAX_BATCH + 1)
+        self.lock = None
+        if chain is not None:
+            check_chain_name(chain)
+        self.chain = (None if chain == DEFAULT_CHAIN else chain)
+
+    async def connect(self):
+        loop = asyncio.get_event_loop()
+        if self.sock_type is None:
+            sock_types = [socket.SOCK_SEQPACKET, socket.SOCK_STREAM]
+        else:
+            sock_types = [self.sock_type]
+        for sock_type in sock_types:
+            sock = socket.socket(socket.AF_UNIX, sock_type)
+            sock.setblocking(False)
+            try:
+                await loop.sock_connect(sock, self.filename)
+            except OSError as e:
+                sock.close()
+                if e.errno != errno.EPROTOTYPE or sock_type == sock_types[-1]:
+                    raise
+                continue
+            if self.sock_type is None:
+                self.sock_type = sock_type
+                log.info('Using %s for %r', sock_type.name, self.filename)
+            return sock
+
+    async def exchange(self, sock, message, size):
+        loop = asyncio.get_event_loop()
+        try:
+            await loop.sock_sendall(sock, message)
+            view = memoryview(self.buf)
+            if sock.type == socket.SOCK_SEQPACKET:
+                return await loop.sock_recv_into(sock, view)
+            received = 0
+            while received < size:
+                n = await loop.sock_recv_into(sock, view[received:size])
+                if n == 0:
+                    break
+                received += n
+            return received
+        finally:
+            sock.close()
+
+    async def make_request(self, request):
+        return (await self.make_requests([request]))[0]
+
+    # A chain signs one connection at a time, so we only ever have one open
+    # (clients for different chains don't wait on each other):
+    async def make_requests(self, requests):
+        if self.lock is None:
+            self.lock = asyncio.Lock()
+        responses = []
+        async with self.lock:
+            for i in range(0, len(requests), MAX_BATCH):
+                responses.extend(await asyncio.wait_for(
+                    self._make_requests(requests[i:i + MAX_BATCH]),
+                    IPC_TIMEOUT
+                ))
+        return responses
+
+    async def _make_requests(self, requests):
+        # Connecting first settles the socket type, if it isn't yet:
+        sock = await self.connect()
+        if self.sock_type == socket.SOCK_SEQPACKET:
+            chunks = [requests]
+        elif self.chain is not None:
+            sock.close()
+            raise ValueError(
+                'chain {!r}: needs SOCK_SEQPACKET'.format(self.chain)
+            )
+        else:
+            chunks = [[request] for request in requests]
+        responses = []
+        for chunk in chunks:
+            if sock is None:
+                sock = await self.connect()
+            expected = RESPONSE * len(chunk)
+            size = await self.exchange(sock,
+                pack_private_request(chunk, self.chain), expected
+            )
+            sock = None
+            if size != expected:
+                raise ValueError(
+                    'bad response size: expected {}; got {}'.format(
+                        expected, size
+                    )
+                )
+            responses.extend(
+                bytes(self.buf[i:i + RESPONSE]) for i in range(0, size, RESPONSE)
+            )
+        for (request, response) in zip(requests, responses):
+            verify_message(response)
+            assert response.endswith(request)
+        return responses
+
+
+# Writes don't block the loop either: frames go out through the non-blocking
+# fd as far as the kernel takes them, and the rest is sent from a writer
+# callback as room frees up.  Nothing waits for the UART to drain, except a
+# baudrate change, which has to let what's queued leave at the old rate:
+class AsyncSerialServer(PolledSerialServer):
+    __slots__ = ('outgoing', 'writing', 'write_error')
+
+    def __init__(self, private_client, port, SerialClass=None, capture=None,
+            status_key=None):
+        super().__init__(private_client, port, SerialClass, capture,
+            status_key
+        )
+        self.outgoing = bytearray()
+        # The fd we're waiting to write to, if any:
+        self.writing = None
+        # An error from the writer callback, raised by the reader:
+        self.write_error = None
+
+    def open_serial(self):
+        ttl = super().open_serial()
+        os.set_blocking(ttl.fileno(), False)
+        return ttl
+
+    def write_frame(self, ftype, seq, payload):
+        frame = pack_frame(ftype, seq, payload)
+        if self.capture is not None:
+            self.capture.record(WRITE, frame)
+        self.outgoing += frame
+        if self.writing is None:
+            self.send_outgoing()
+
+    def send_outgoing(self):
+        fd = self.get_serial().fileno()
+        try:
+            while self.outgoing:
+                n = os.write(fd, self.outgoing)
+                del self.outgoing[:n]
+        except BlockingIOError:
+            if self.writing is None:
+                asyncio.get_event_loop().add_writer(fd, self.on_writable)
+                self.writing = fd
+            return
+        self.stop_writing()
+
+    def on_writable(self):
+        try:
+            self.send_outgoing()
+        except OSError as e:
+            self.stop_writing()
+            self.write_error = e
+
+    def stop_writing(self):
+        if self.writing is not None:
+            asyncio.get_event_loop().remove_writer(self.writing)
+            self.writing = None
+
+    # Blocks, but only on a baudrate change:
+    def drain(self):
+        ttl = self.get_serial()
+        fd = ttl.fileno()
+        self.stop_writing()
+        while self.outgoing:
+            select.select([], [fd], [], SERIAL_TIMEOUT)
+            try:
+                n = os.write(fd, self.outgoing)
+            except BlockingIOError:
+                continue
+            del self.outgoing[:n]
+        ttl.flush()
+
+    def set_baudrate(self, rate):
+        if self.get_serial().baudrate != rate:
+            self.drain()
+        super().set_baudrate(rate)
+
+    def close_serial(self):
+        self.stop_writing()
+        self.outgoing.clear()
+        super().close_serial()
+
+    async def serve(self, stop=None):
+        loop = asyncio.get_event_loop()
+        readable = asyncio.Event()
+        try:
+            while stop is None or not stop.is_set():
+                try:
+                    fd = self.get_serial().fileno()
+                    loop.add_reader(fd, readable.set)
+                except OSError:
+                    self.io_error()
+                    await asyncio.sleep(SERIAL_TIMEOUT)
+                    continue
+                try:
+                    await self.serve_port(readable, stop)
+                except OSError:
+                    loop.remove_reader(fd)
+                    self.io_error()
+                    await asyncio.sleep(SERIAL_TIMEOUT)
+                else:
+                    loop.remove_reader(fd)
+        finally:
+            self.close_serial()
+
+    def io_error(self):
+        log.exception('Error on serial port %r:', self.port)
+        self.counters['io_errors'] += 1
+        self.close_serial()
+        self.frames.clear()
+
+    # Returns once *stop* is set and the signer has finished what was queued.
+    # An error in either task cancels the other and is raised here:
+    async def serve_port(self, readable, stop=None):
+        queued = asyncio.Event()
+        reader = asyncio.ensure_future(
+            self.read_forever(readable, queued, stop)
+        )
+        signer = asyncio.ensure_future(self.sign_forever(queued, reader))
+        tasks = [reader, signer]
+        try:
+            await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+        for task in tasks:
+            if not task.cancelled() and task.exception() is not None:
+                raise task.exception()
+
+    async def read_forever(self, readable, queued, stop=None):
+        try:
+            while stop is None or not stop.is_set():
+                try:
+                    await asyncio.wait_for(readable.wait(), POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                readable.clear()
+                if self.write_error is not None:
+                    (e, self.write_error) = (self.write_error, None)
+                    raise e
+                if self.poll() and self.answer_frames():
+                    queued.set()
+        finally:
+            # So the signer sees we're done:
+            queued.set()
+
+    # Answers everything but the request frames, which are left in self.frames
+    # for the signer.  Returns how many are left:
+    def answer_frames(self):
+        now = time.monotonic()
+        requests = []
+        for (received, frame) in self.frames:
+            if frame[0] in (FULL_REQUEST, COMPACT_REQUEST, BATCH_REQUEST):
+                requests.append((received, frame))
+            else:
+                self.admit_frame(*frame)
+                self.add_latency(received, now)
+        self.frames.clear()
+        self.frames.extend(requests)
+        return len(self.frames)
+
+    # Only the signer touches the sequence state (expected, held, known), so
+    # the reader can't change it under a run that's being signed:
+    async def sign_forever(self, queued, reader):
+        while self.frames or not reader.done():
+            if not self.frames:
+                await queued.wait()
+                queued.clear()
+                continue
+            frames = list(self.frames)
+            self.frames.clear()
+            await self.handle_frames(frames)
+
+    async def handle_frames(self, frames):
+        for (received, (ftype, seq, payload)) in frames:
+            if self.admit_frame(ftype, seq, payload):
+                self.held[seq] = (ftype, payload)
+        await self.sign_held()
+        now = time.monotonic()
+        for (received, frame) in frames:
+            self.add_latency(received, now)
+
+    # Every request frame that's ready, in sequence order, is signed in as few
+    # round trips to the PrivateServer as possible:
+    async def sign_held(self):
+        while self.expected in self.held:
+            known = deque(self.known, maxlen=self.known.maxlen)
+            run = []
+            seq = self.expected
+            while seq in self.held:
+                (ftype, payload) = self.held.pop(seq)
+                requests = self.prepare_request_frame(ftype, seq, payload)
+                if requests is None:
+                    break
+                run.append((ftype, seq, requests))
+                # So a compact request can follow the one before it in the run:
+                self.known.extend(requests[-2:])
+                seq = next_seq(seq)
+            self.known = known
+            if not run:
+                return
+            self.pending = None
+            requests = [r for (ftype, seq, frame) in run for r in frame]
+            for request in requests:
+                log_request(request)
+            try:
+                responses = await self.private_client.make_requests(requests)
+            except Exception:
+                # The client retransmits whatever it doesn't hear back about:
+                log.exception('Error signing %d requests:', len(requests))
+                return
+            i = 0
+            for (ftype, seq, frame) in run:
+                for response in responses[i:i + len(frame)]:
+                    log_response(response)
+                self.finish_request_frame(ftype, seq, frame,
+                    responses[i:i + len(frame)]
+                )
+                i += len(frame)
+                self.expected = next_seq(seq)
+
+
+# *private_client* is shared by every port, unless it's a list with one per
+# port (to sign each port's requests on a chain of its own).  Every port signs
+# its status frames with *status_key*:
+async def serve_ports(private_client, ports, SerialClass=None, captures=None,
+        stop=None, status_key=None):
+    if captures is None:
+        captures = [None] * len(ports)
+    if isinstance(private_client, list):
+        private_clients = private_client
+        assert len(private_clients) == len(ports)
+    else:
+        private_clients = [private_client] * len(ports)
+    servers = [
+        AsyncSerialServer(client, port, SerialClass, capture, status_key)
+        for (client, port, capture) in zip(private_clients, ports, captures)
+    ]
+    await asyncio.gather(*[server.serve(stop) for server in servers])
+    return servers
+
+
+def run(private_client, ports, SerialClass=None, captures=None, stop=None,
+        status_key=None):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(
+            serve_ports(private_client, ports, SerialClass, captures, stop,
+                status_key
+            )
+        )
+    finally:
+        loop.close()
@@ -0,0 +1,382 @@
+# pihsm: Turn your Raspberry Pi into a Hardware Security Module 
+# Copyright (C) 2017 System76, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Micro-benchmarks, so numbers from x86 build hosts and ARM Pis can be compared.
+"""
+
+import logging
+import os
+import platform
+import random
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+from .capture import WRITE, Replay
+from .combined import LocalPrivateClient, SignerThread
+from .common import (
+    IPC_TIMEOUT,
+    DIGEST_ALGORITHMS,
+    REQUEST,
+    RESPONSE,
+    compute_digest,
+)
+from .ipc import PrivateClient, PrivateServer
+from .schedule import percentile
+from .serial import SerialServer, SerialClient, open_serial, read_frame
+from .sign import Signer
+from .simulate import NullDisplayClient, PtyPair
+from .verify import isvalid, verify_message
+from .wire import (
+    FULL_REQUEST,
+    COMPACT_REQUEST,
+    NEED_FULL,
+    FrameDecoder,
+    pack_frame,
+    next_seq,
+    expand_request,
+)
+
+
+log = logging.getLogger(__name__)
+
+MiB = 1024 * 1024
+
+
+def get_machine():
+    return platform.machine()
+
+
+def bench_digest(algorithm, size=16 * MiB, count=4):
+    assert type(size) is int and size > 0
+    assert type(count) is int and count > 0
+    data = os.urandom(size)
+    start = time.perf_counter()
+    for i in range(count):
+        compute_digest(data, algorithm)
+    elapsed = time.perf_counter() - start
+    return (size * count) / MiB / elapsed
+
+
+def bench_digests(size=16 * MiB, count=4):
+    machine = get_machine()
+    results = {}
+    for algorithm in sorted(DIGEST_ALGORITHMS):
+        rate = bench_digest(algorithm, size, count)
+        log.info('%s %s: %.1f MiB/s', machine, algorithm, rate)
+        results[algorithm] = rate
+    return results
+
+
+def _read_exactly(fd, size):
+    data = b''
+    while len(data) < size:
+        data += os.read(fd, size - len(data))
+    return data
+
+
+def _echo_responses(fd, count):
+    # Stands in for the Pi: answer each request with a RESPONSE sized frame
+    response = os.urandom(RESPONSE)
+    for i in range(count):
+        _read_exactly(fd, REQUEST)
+        os.write(fd, response)
+
+
+def _bench_round_trips(pty, count, get_ttl):
+    buf = bytearray(RESPONSE)
+    request = os.urandom(REQUEST)
+    thread = threading.Thread(target=_echo_responses, args=(pty.master, count))
+    thread.start()
+    start = time.perf_counter()
+    for i in range(count):
+        ttl = get_ttl()
+        ttl.write(request)
+        ttl.flush()
+        ttl.readinto(buf)
+    elapsed = time.perf_counter() - start
+    thread.join()
+    return elapsed / count
+
+
+# Per-request latency over a pty pair, reopening the port for every request
+# (the old behavior) versus keeping one port open:
+def bench_serial_open(count=200):
+    pty = PtyPair()
+    try:
+        opened = []
+
+        def reopen():
+            while opened:
+                opened.pop().close()
+            opened.append(open_serial(pty.name))
+            return opened[0]
+
+        reopened = _bench_round_trips(pty, count, reopen)
+        while opened:
+            opened.pop().close()
+
+        ttl = open_serial(pty.name)
+        try:
+            persistent = _bench_round_trips(pty, count, lambda: ttl)
+        finally:
+            ttl.close()
+    finally:
+        pty.close()
+    log.info('%s serial latency: %.3f ms reopened, %.3f ms persistent',
+        get_machine(), reopened * 1000, persistent * 1000
+    )
+    return {'reopened': reopened, 'persistent': persistent}
+
+
+# Time from a corrupted frame being written to the next good frame being read,
+# over a pty pair.  Each round corrupts one random byte of a frame and follows
+# it with a good one:
+def bench_recovery(count=100):
+    pty = PtyPair()
+    try:
+        ttl = open_serial(pty.name)
+        decoder = FrameDecoder()
+        latencies = []
+        lost = 0
+        try:
+            for i in range(count):
+                seq = (i * 2) & 0xFFFF
+                bad = bytearray(pack_frame(NEED_FULL, seq, os.urandom(64)))
+                bad[random.randrange(len(bad))] ^= 0xFF
+                good = (NEED_FULL, seq + 1, os.urandom(64))
+                start = time.perf_counter()
+                os.write(pty.master, bytes(bad) + pack_frame(*good))
+                if read_frame(ttl, decoder) != good:
+                    lost += 1
+                latencies.append(time.perf_counter() - start)
+        finally:
+            ttl.close()
+    finally:
+        pty.close()
+    latencies.sort()
+    results = {
+        'p50': percentile(latencies, 50),
+        'p99': percentile(latencies, 99),
+        'lost': lost,
+    }
+    log.info('%s recovery: p50=%.3f ms p99=%.3f ms, %d good frames lost',
+        get_machine(), results['p50'] * 1000, results['p99'] * 1000, lost
+    )
+    return results
+
+
+# Signs replayed requests with a throwaway Signer, in place of a PrivateClient:
+class _ReplaySigner:
+    __slots__ = ('signer',)
+
+    def __init__(self):
+        self.signer = Signer()
+
+    def make_request(self, request):
+        return self.signer.sign(request)
+
+    def make_requests(self, requests):
+        return self.signer.sign_many(requests)
+
+
+def _fork(target, *args):
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            target(*args)
+            status = 0
+        except BaseException:
+            log.exception('Benchmark child failed:')
+        finally:
+            os._exit(status)
+    return pid
+
+
+# The resource usage of a child started with _fork():
+def _wait(pid):
+    (pid, status, rusage) = os.wait4(pid, 0)
+    if status != 0:
+        raise ValueError('benchmark child exited with status {}'.format(status))
+    return rusage
+
+
+# What a SerialServer does for each request, less the serial port:
+def _front_end(private_client, requests):
+    for request in requests:
+        verify_message(request)
+        private_client.make_request(request)
+
+
+def _split_front_end(filename, requests):
+    _front_end(PrivateClient(filename, socket.SOCK_SEQPACKET), requests)
+
+
+def _split_private(sock, count):
+    server = PrivateServer(sock, NullDisplayClient(), Signer())
+    sock.settimeout(IPC_TIMEOUT)
+    for i in range(count):
+        (conn, address) = sock.accept()
+        try:
+            server.handle_connection(conn)
+        finally:
+            conn.close()
+
+
+def _combined(requests):
+    signer_thread = SignerThread(NullDisplayClient(), Signer())
+    signer_thread.start()
+    try:
+        _front_end(LocalPrivateClient(signer_thread), requests)
+    finally:
+        signer_thread.stop()
+
+
+def _usage(rusages, count):
+    return {
+        'cpu': sum(r.ru_utime + r.ru_stime for r in rusages) / count,
+        'rss': sum(r.ru_maxrss for r in rusages),
+    }
+
+
+# Per-request CPU and total peak RSS (in KiB) of the front end and the
+# PrivateServer as two processes over SOCK_SEQPACKET, versus one process with
+# the PrivateServer in a SignerThread.  Each runs in forked children, so both
+# start from the same interpreter image:
+def bench_combined(count=200):
+    client = Signer()
+    requests = [client.sign(os.urandom(48)) for i in range(count)]
+    tmp = tempfile.mkdtemp(prefix='pihsm-benchmark.')
+    try:
+        filename = os.path.join(tmp, 'private.socket')
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        try:
+            sock.bind(filename)
+            sock.listen(1)
+            pids = [
+                _fork(_split_private, sock, count),
+                _fork(_split_front_end, filename, requests),
+            ]
+            split = [_wait(pid) for pid in pids]
+        finally:
+            sock.close()
+    finally:
+        shutil.rmtree(tmp)
+    results = {
+        'split': _usage(split, count),
+        'combined': _usage([_wait(_fork(_combined, requests))], count),
+    }
+    for (name, usage) in sorted(results.items()):
+        log.info('%s %s: %.3f ms CPU per request, %d KiB RSS',
+            get_machine(), name, usage['cpu'] * 1000, usage['rss']
+        )
+    return results
+
+
+def _replay_results(name, serial, elapsed, **results):
+    results['elapsed'] = elapsed
+    results['counters'] = dict(serial.counters)
+    log.info('%s replay: %.3fs, %r', name, elapsed, results)
+    return results
+
+
+# Feeds the bytes a SerialServer received in a captured session back into a
+# fresh SerialServer, signing with a throwaway key:
+def replay_server(records, speed=None):
+    replay = Replay(records, speed=speed)
+    server = SerialServer(_ReplaySigner(), 'replay', replay)
+    start = time.perf_counter()
+    try:
+        while True:
+            server.serve_once()
+    except EOFError:
+        pass
+    elapsed = time.perf_counter() - start
+    signed = server.private_client.signer.counter
+    return _replay_results('server', server, elapsed, signed=signed)
+
+
+# The unique requests a SerialClient wrote in a captured session, as
+# (seq, request) pairs in the order they were first sent:
+def captured_requests(records):
+    decoder = FrameDecoder()
+    decoder.feed(b''.join(data for (o, kind, data) in records if kind == WRITE))
+    seen = set()
+    known = []
+    requests = []
+    while True:
+        frame = decoder.next()
+        if frame is None:
+            break
+        (ftype, seq, payload) = frame
+        if ftype == FULL_REQUEST:
+            request = payload
+        elif ftype == COMPACT_REQUEST:
+            for previous in reversed(known[-2:]):
+                request = expand_request(previous, payload)
+                if isvalid(request):
+                    break
+            else:
+                continue
+        else:
+            continue
+        if request[:64] not in seen:
+            seen.add(request[:64])
+            known.append(request)
+            requests.append((seq, request))
+    return requests
+
+
+def _runs(requests):
+    run = []
+    for (seq, request) in requests:
+        if run and seq != next_seq(run[-1][0]):
+            yield run
+            run = []
+        run.append((seq, request))
+    if run:
+        yield run
+
+
+# Makes the requests a SerialClient sent in a captured session again, reading
+# the responses it received in that session:
+def replay_client(records, speed=None):
+    replay = Replay(records, speed=speed)
+    client = SerialClient('replay', replay)
+    responses = 0
+    failed = 0
+    start = time.perf_counter()
+    try:
+        for run in _runs(captured_requests(records)):
+            client.seq = run[0][0]
+            try:
+                client.make_requests([request for (seq, request) in run])
+                responses += len(run)
+            except EOFError:
+                raise
+            except Exception:
+                log.exception('Replayed requests failed:')
+                failed += len(run)
+    except EOFError:
+        pass
+    elapsed = time.perf_counter() - start
+    return _replay_results('client', client, elapsed,
+        responses=responses, failed=failed
+    )
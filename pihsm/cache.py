@@ -0,0 +1,189 @@
+# pihsm: Turn your Raspberry Pi into a Hardware Security Module 
+# Copyright (C) 2017 System76, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Bounded caches of signed responses.
+
+ResponseCache is a digest => response map for the client.  Only the 64-byte
+response signature is kept in memory (and in the on-disk index); the response
+itself is read back from the ChainStore it was already written to.
+"""
+
+from collections import OrderedDict
+import logging
+import threading
+
+from .common import (
+    SIGNATURE,
+    RESPONSE,
+    get_signature,
+    get_message,
+    get_timestamp,
+    atomic_write,
+    b32enc,
+)
+from .sign import get_time
+from .verify import verify_message
+
+
+log = logging.getLogger(__name__)
+
+
+class RingCache:
+    __slots__ = ('size', 'entries', 'hits', 'misses', 'evictions', 'lock')
+
+    def __init__(self, size):
+        assert type(size) is int and size > 0
+        self.size = size
+        self.entries = OrderedDict()
+        # Shared by the ScheduledClientServer workers.  Reentrant, as
+        # ResponseCache.put holds it across add() and the index append:
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.size:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+
+    def stats(self):
+        with self.lock:
+            return {
+                'entries': len(self.entries),
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions,
+            }
+
+
+def get_digest(response):
+    return get_message(get_message(response))
+
+
+class ResponseCache(RingCache):
+    __slots__ = ('store', 'window', 'filename')
+
+    def __init__(self, store, size, window, filename=None):
+        assert type(window) is int and window > 0
+        super().__init__(size)
+        self.store = store
+        self.window = window
+        self.filename = filename
+
+    def expired(self, timestamp, now):
+        return now - timestamp > self.window
+
+    def read(self, signature):
+        with self.store.open(signature) as fp:
+            return fp.read(RESPONSE)
+
+    def get(self, digest, now=None):
+        now = (get_time() if now is None else now)
+        with self.lock:
+            signature = self.lookup(digest, now)
+        if signature is None:
+            return None
+        return self.read(signature)
+
+    # The signature of the response to *digest*, if cached and not expired.
+    # Call with the lock held:
+    def lookup(self, digest, now):
+        entry = self.entries.get(digest)
+        if entry is not None:
+            (signature, timestamp) = entry
+            if self.expired(timestamp, now):
+                del self.entries[digest]
+                self.evictions += 1
+            else:
+                self.hits += 1
+                self.entries.move_to_end(digest)
+                log.info('Response cache hit %s (%d hits, %d misses)',
+                    b32enc(signature), self.hits, self.misses
+                )
+                return signature
+        self.misses += 1
+        return None
+
+    def add(self, response):
+        signature = get_signature(response)
+        timestamp = get_timestamp(get_message(response))
+        super().put(get_digest(response), (signature, timestamp))
+
+    def put(self, response):
+        assert len(response) == RESPONSE
+        with self.lock:
+            self.add(response)
+            if self.filename is not None:
+                self.append_index(get_signature(response))
+
+    # The index is a best effort hint, so appends aren't fsync'ed; the responses
+    # themselves were already durably written to the ChainStore:
+    def append_index(self, signature):
+        with open(self.filename, 'ab', 0) as fp:
+            fp.write(signature)
+            size = fp.tell()
+        if size > SIGNATURE * self.size * 2:
+            self.write_index()
+
+    def write_index(self):
+        content = b''.join(s for (s, t) in self.entries.values())
+        atomic_write(0o644, content, self.filename)
+
+    def iter_index(self):
+        try:
+            with open(self.filename, 'rb', 0) as fp:
+                data = fp.read(SIGNATURE * self.size * 2)
+        except FileNotFoundError:
+            return
+        for i in range(0, len(data) - SIGNATURE + 1, SIGNATURE):
+            yield data[i:i + SIGNATURE]
+
+    def load(self, now=None):
+        if self.filename is None:
+            return 0
+        now = (get_time() if now is None else now)
+        for signature in self.iter_index():
+            try:
+                response = self.read(signature)
+                verify_message(response)
+            except Exception:
+                log.warning('Skipping cache entry %s', b32enc(signature))
+                continue
+            if not self.expired(get_timestamp(get_message(response)), now):
+                self.add(response)
+        self.write_index()
+        log.info('Loaded %d cached responses from %r',
+            len(self.entries), self.filename
+        )
+        return len(self.entries)
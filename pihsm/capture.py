@@ -0,0 +1,252 @@
+# pihsm: Turn your Raspberry Pi into a Hardware Security Module 
+# Copyright (C) 2017 System76, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Record serial sessions to a capture file and replay them later.
+
+A capture starts with CAPTURE_MAGIC, then one record per read, write, or
+baudrate change: a RECORD header (microseconds since the previous record,
+kind, size) followed by the bytes.
+
+A capture file is appended to, so a restart doesn't lose what came before it.
+Each session starts with CAPTURE_MAGIC again, which can't be mistaken for a
+RECORD header as its kind byte isn't one of KINDS.
+"""
+
+import logging
+import struct
+import time
+
+
+log = logging.getLogger(__name__)
+
+CAPTURE_MAGIC = b'PiHSM.capture.1\n'
+CAPTURE_MAX_SIZE = 64 * 1024 * 1024
+RECORD = struct.Struct('<IBH')
+MAX_DELTA = 0xFFFFFFFF
+
+READ = 0
+WRITE = 1
+RATE = 2
+KINDS = (READ, WRITE, RATE)
+
+
+# *max_size* caps the whole file, not just this session, so a service that
+# keeps restarting can't fill the disk:
+class Capture:
+    __slots__ = ('fp', 'max_size', 'size', 'last', 'clock')
+
+    def __init__(self, fp, max_size=CAPTURE_MAX_SIZE, clock=time.monotonic):
+        self.fp = fp
+        self.max_size = max_size
+        self.clock = clock
+        self.last = clock()
+        self.size = fp.tell()
+        if self.size + len(CAPTURE_MAGIC) > max_size:
+            log.warning('Capture already has %d bytes, not recording',
+                self.size
+            )
+            self.size = None
+        else:
+            self.size += fp.write(CAPTURE_MAGIC)
+
+    def record(self, kind, data):
+        assert kind in KINDS
+        if self.size is None:
+            return
+        data = bytes(data)
+        if self.size + RECORD.size + len(data) > self.max_size:
+            log.warning('Capture reached %d bytes, no longer recording',
+                self.size
+            )
+            self.size = None
+            return
+        now = self.clock()
+        delta = min(int((now - self.last) * 1000000), MAX_DELTA)
+        self.last = now
+        self.fp.write(RECORD.pack(delta, kind, len(data)))
+        self.fp.write(data)
+        self.size += RECORD.size + len(data)
+
+    def flush(self):
+        self.fp.flush()
+
+    def close(self):
+        self.fp.close()
+
+
+def open_capture(filename, max_size=CAPTURE_MAX_SIZE):
+    log.info('Capturing serial traffic to %r', filename)
+    return Capture(open(filename, 'ab'), max_size)
+
+
+# Yields (seconds since the start, kind, data) for each record.  The sessions
+# in a file follow on from each other, without the time between them:
+def iter_capture(fp):
+    magic = fp.read(len(CAPTURE_MAGIC))
+    if magic != CAPTURE_MAGIC:
+        raise ValueError('capture: bad magic {!r}'.format(magic))
+    offset = 0
+    while True:
+        header = fp.read(RECORD.size)
+        if len(header) == 0:
+            break
+        if len(header) < RECORD.size:
+            log.warning('Capture ends in a partial record header')
+            break
+        if header == CAPTURE_MAGIC[:RECORD.size]:
+            magic = header + fp.read(len(CAPTURE_MAGIC) - RECORD.size)
+            if len(magic) < len(CAPTURE_MAGIC):
+                log.warning('Capture ends in a partial session header')
+                break
+            if magic != CAPTURE_MAGIC:
+                raise ValueError('capture: bad magic {!r}'.format(magic))
+            continue
+        (delta, kind, size) = RECORD.unpack(header)
+        data = fp.read(size)
+        if len(data) < size:
+            log.warning('Capture ends in a partial record')
+            break
+        if kind not in KINDS:
+            raise ValueError('capture: bad record kind {!r}'.format(kind))
+        offset += delta / 1000000
+        yield (offset, kind, data)
+
+
+def load_capture(filename):
+    with open(filename, 'rb') as fp:
+        return list(iter_capture(fp))
+
+
+def rate_record(rate):
+    return rate.to_bytes(4, 'little')
+
+
+# Wraps a serial port, recording everything read from and written to it:
+class TapSerial:
+    __slots__ = ('ttl', 'capture')
+
+    def __init__(self, ttl, capture):
+        self.ttl = ttl
+        self.capture = capture
+        capture.record(RATE, rate_record(ttl.baudrate))
+
+    @property
+    def baudrate(self):
+        return self.ttl.baudrate
+
+    @baudrate.setter
+    def baudrate(self, rate):
+        self.ttl.baudrate = rate
+        self.capture.record(RATE, rate_record(rate))
+
+    @property
+    def timeout(self):
+        return self.ttl.timeout
+
+    @timeout.setter
+    def timeout(self, timeout):
+        self.ttl.timeout = timeout
+
+    def fileno(self):
+        return self.ttl.fileno()
+
+    def readinto(self, buf):
+        received = self.ttl.readinto(buf)
+        if received:
+            self.capture.record(READ, buf[:received])
+        return received
+
+    def write(self, data):
+        self.capture.record(WRITE, data)
+        return self.ttl.write(data)
+
+    def flush(self):
+        self.ttl.flush()
+        self.capture.flush()
+
+    def close(self):
+        self.capture.flush()
+        self.ttl.close()
+
+
+# Stands in for both the Serial class and the open port: reads return the
+# bytes one side received during a captured session, paced as they were
+# captured (*speed* times faster), or as fast as possible if *speed* is None.
+# Writes are counted and discarded.  EOFError is raised once the capture has
+# been consumed:
+class Replay:
+    __slots__ = ('chunks', 'index', 'data', 'speed', 'start', 'clock',
+        'sleep', 'port', 'baudrate', 'timeout', 'written',
+    )
+
+    def __init__(self, records, kind=READ, speed=None, clock=time.monotonic,
+            sleep=time.sleep):
+        assert speed is None or speed > 0
+        self.chunks = [
+            (offset, data) for (offset, k, data) in records if k == kind
+        ]
+        self.index = 0
+        self.data = b''
+        self.speed = speed
+        self.start = None
+        self.clock = clock
+        self.sleep = sleep
+        self.port = None
+        self.baudrate = None
+        self.timeout = None
+        self.written = 0
+
+    def __call__(self, port, baudrate=None, timeout=None):
+        self.port = port
+        self.baudrate = baudrate
+        self.timeout = timeout
+        return self
+
+    def __len__(self):
+        return len(self.chunks) - self.index
+
+    def readinto(self, buf):
+        if not self.data:
+            if self.index >= len(self.chunks):
+                raise EOFError('replay: end of capture')
+            (offset, data) = self.chunks[self.index]
+            if self.speed is not None:
+                now = self.clock()
+                if self.start is None:
+                    self.start = now - offset / self.speed
+                wait = self.start + offset / self.speed - now
+                if self.timeout is not None and wait > self.timeout:
+                    self.sleep(self.timeout)
+                    return 0
+                if wait > 0:
+                    self.sleep(wait)
+            self.data = data
+            self.index += 1
+        size = min(len(buf), len(self.data))
+        buf[:size] = self.data[:size]
+        self.data = self.data[size:]
+        return size
+
+    def write(self, data):
+        self.written += len(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        pass
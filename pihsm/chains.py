@@ -0,0 +1,318 @@
+# pihsm: Turn your Raspberry Pi into a Hardware Security Module 
+# Copyright (C) 2017 System76, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Host several named chains in one pihsm-private, each signing on its own core.
+
+Every chain has its own key and ChainStore, and is signed by a PrivateServer
+in a worker process of its own, so requests for unrelated chains are signed in
+parallel.  The MultiChainServer reads the chain name off each message (see
+ipc.pack_private_request) and hands the connection to that chain's
+ChainWorker, where a relay thread passes the requests to the worker process
+and sends the responses back.
+
+The default chain keeps the usual store and display tail, so a pihsm-private
+that gains chains carries on with the chain it had.
+"""
+
+import logging
+import multiprocessing
+import os
+from os import path
+import queue
+import signal
+import socket
+import threading
+
+from .common import (
+    IPC_TIMEOUT,
+    REQUEST,
+    ChainStore,
+    b32enc,
+    get_counter,
+    get_pubkey,
+)
+from .display import SpecialClient
+from .ipc import (
+    DEFAULT_CHAIN,
+    MAX_CHAIN_FIELD,
+    ROTATE_POLL,
+    PrivateServer,
+    Server,
+    check_chain_name,
+    recv_message,
+    unpack_private_request,
+)
+from .sign import Signer
+from .wire import MAX_BATCH
+
+
+log = logging.getLogger(__name__)
+
+SIGN = 'sign'
+ROTATE = 'rotate'
+
+
+def chain_dir(basedir, name):
+    if name == DEFAULT_CHAIN:
+        return basedir
+    return path.join(basedir, 'chains', check_chain_name(name))
+
+
+def tail_name(name):
+    if name == DEFAULT_CHAIN:
+        return 'tail'
+    return 'tail.' + check_chain_name(name)
+
+
+# Runs in the worker process.  It first answers with the chain's genesis, then
+# each (SIGN, requests) or (ROTATE, None) from the parent is answered with
+# (result, error); None stops the worker:
+def _run_worker(conn, name, basedir, rundir):
+    # `systemctl kill` signals every process in the unit, but it's the parent
+    # that passes rotations on:
+    signal.signal(signal.SIGUSR1, signal.SIG_IGN)
+    try:
+        dirname = chain_dir(basedir, name)
+        os.makedirs(dirname, exist_ok=True)
+        display_client = SpecialClient(rundir, tail_name(name))
+        signer = Signer(ChainStore(dirname))
+        display_client.make_request(signer.genesis)
+        signer.start_next_key()
+        server = PrivateServer(None, display_client, signer)
+    except Exception as e:
+        log.exception('Chain %s: error starting worker:', name)
+        conn.send((None, '{}: {}'.format(type(e).__name__, e)))
+        return
+    log.info('Chain %s: signing in process %d', name, os.getpid())
+    conn.send((signer.genesis, None))
+    while True:
+        try:
+            item = conn.recv()
+        except EOFError:
+            break
+        if item is None:
+            break
+        (command, requests) = item
+        (result, error) = (None, None)
+        try:
+            if command == ROTATE:
+                server.rotate()
+                result = signer.genesis
+            else:
+                result = server.handle_requests(requests)
+        except Exception as e:
+            log.exception('Chain %s: error with %r:', name, command)
+            error = '{}: {}'.format(type(e).__name__, e)
+        conn.send((result, error))
+
+
+class ChainWorker:
+    __slots__ = ('name', 'basedir', 'rundir', 'conn', 'process', 'queue',
+        'thread', 'public', 'counter', 'signed', 'failures',
+    )
+
+    def __init__(self, name, basedir='/var/lib/pihsm/private',
+            rundir='/run/pihsm-private'):
+        self.name = check_chain_name(name)
+        self.basedir = basedir
+        self.rundir = rundir
+        self.conn = None
+        self.process = None
+        self.queue = queue.Queue()
+        self.thread = None
+        self.public = None
+        self.counter = None
+        self.signed = 0
+        self.failures = 0
+
+    def start(self):
+        assert self.process is None
+        (self.conn, child_conn) = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(target=_run_worker,
+            args=(child_conn, self.name, self.basedir, self.rundir),
+            name='chain-' + self.name, daemon=True
+        )
+        self.process.start()
+        child_conn.close()
+        self.started(self.receive())
+        self.thread = threading.Thread(target=self.relay_forever,
+            name='relay-' + self.name, daemon=True
+        )
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+        if self.process is not None:
+            try:
+                self.conn.send(None)
+            except OSError:
+                pass
+            self.process.join(IPC_TIMEOUT)
+            if self.process.is_alive():
+                self.process.terminate()
+                self.process.join()
+            self.conn.close()
+            self.process = None
+
+    def is_alive(self):
+        return self.process is not None and self.process.is_alive()
+
+    def receive(self):
+        (result, error) = self.conn.recv()
+        if error is not None:
+            raise ValueError('chain {}: {}'.format(self.name, error))
+        return result
+
+    def started(self, genesis):
+        self.public = get_pubkey(genesis)
+        self.counter = 0
+        log.info('Chain %s: public key %s', self.name, b32enc(self.public))
+
+    def relay_forever(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            (command, sock, requests) = item
+            try:
+                self.conn.send((command, requests))
+                result = self.receive()
+                if command == ROTATE:
+                    self.started(result)
+                    continue
+                # Signed, so the chain has moved on even if the send fails:
+                self.signed += len(result)
+                self.counter = get_counter(result[-1])
+                sock.sendall(b''.join(result))
+            except Exception:
+                if command == SIGN:
+                    self.failures += 1
+                log.exception('Chain %s: error with %r:', self.name, command)
+            finally:
+                if sock is not None:
+                    sock.close()
+
+    # *sock* now belongs to the relay thread, which closes it once the
+    # responses are sent:
+    def submit(self, sock, requests):
+        assert 0 < len(requests) <= MAX_BATCH
+        self.queue.put((SIGN, sock, list(requests)))
+
+    # Queued like a request, so it happens between two signings:
+    def rotate(self):
+        self.queue.put((ROTATE, None, None))
+
+    def stats(self):
+        return {
+            'public': (None if self.public is None else b32enc(self.public)),
+            'counter': self.counter,
+            'signed': self.signed,
+            'failures': self.failures,
+            'alive': self.is_alive(),
+        }
+
+
+def build_workers(names, basedir='/var/lib/pihsm/private',
+        rundir='/run/pihsm-private'):
+    names = [DEFAULT_CHAIN] + [n for n in names if n != DEFAULT_CHAIN]
+    if len(set(names)) != len(names):
+        raise ValueError('duplicate chain names: {!r}'.format(names))
+    return [ChainWorker(name, basedir, rundir) for name in names]
+
+
+# Stands in for PrivateServer when pihsm-private hosts several chains.  Over
+# SOCK_STREAM there's no room for a chain name, so those requests always go to
+# the default chain:
+class MultiChainServer(Server):
+    __slots__ = ('workers', 'rotate_requested')
+
+    def __init__(self, sock, workers):
+        super().__init__(sock, REQUEST)
+        self.buf = bytearray(MAX_CHAIN_FIELD + REQUEST * MAX_BATCH + 1)
+        self.workers = dict((w.name, w) for w in workers)
+        assert len(self.workers) == len(workers)
+        assert DEFAULT_CHAIN in self.workers
+        self.rotate_requested = False
+
+    def start(self):
+        for worker in self.workers.values():
+            worker.start()
+
+    def stop(self):
+        for worker in self.workers.values():
+            worker.stop()
+
+    # Only sets a flag, so it's safe to call from a signal handler:
+    def request_rotate(self):
+        self.rotate_requested = True
+
+    def rotate(self):
+        self.rotate_requested = False
+        for worker in self.workers.values():
+            worker.rotate()
+
+    # Like pihsm-private itself, a chain that dies isn't restarted; we exit so
+    # the display shows the crash:
+    def check_workers(self):
+        for worker in self.workers.values():
+            if not worker.is_alive():
+                raise RuntimeError(
+                    'chain {}: worker is not running'.format(worker.name)
+                )
+
+    def serve_forever(self):
+        self.sock.settimeout(ROTATE_POLL)
+        while True:
+            self.check_workers()
+            if self.rotate_requested:
+                self.rotate()
+            try:
+                (sock, address) = self.sock.accept()
+            except socket.timeout:
+                continue
+            self.serve_connection(sock)
+
+    def serve_connection(self, sock):
+        try:
+            sock.settimeout(IPC_TIMEOUT)
+            (chain, requests) = self.read_requests(sock)
+            worker = self.workers.get(chain)
+            if worker is None:
+                raise ValueError('unknown chain {!r}'.format(chain))
+        except Exception:
+            log.exception('Error handling request:')
+            sock.close()
+            return
+        worker.submit(sock, requests)
+
+    def read_requests(self, sock):
+        size = recv_message(sock, self.buf, self.request_size)
+        if sock.type == socket.SOCK_SEQPACKET:
+            return unpack_private_request(memoryview(self.buf)[:size])
+        if size != REQUEST:
+            raise ValueError(
+                'bad request: expected {} bytes; got {}'.format(REQUEST, size)
+            )
+        return (DEFAULT_CHAIN, [bytes(memoryview(self.buf)[:size])])
+
+    def stats(self):
+        return dict(
+            (name, worker.stats()) for (name, worker) in self.workers.items()
+        )
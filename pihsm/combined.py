@@ -0,0 +1,184 @@
+# pihsm: Turn your Raspberry Pi into a Hardware Security Module 
+# Copyright (C) 2017 System76, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Run the serial front end and the PrivateServer in one process.
+
+Split, every signature crosses two interpreters and an AF_UNIX hop, and both
+processes verify the request.  Combined, the PrivateServer runs in a
+SignerThread and the serial servers hand it requests they've already verified.
+
+The thread owns the Signer, and the only way in is submit(): requests go in,
+responses come out.  Threads share an address space, so this is a narrower
+interface than the socket, not a process boundary; deployments that want the
+key in its own process keep running pihsm-private.
+"""
+
+import asyncio
+import logging
+import queue
+import threading
+
+from .common import IPC_TIMEOUT
+from .ipc import PrivateServer
+from . import aio
+
+
+log = logging.getLogger(__name__)
+
+ROTATE = object()
+
+
+class SignerThread:
+    __slots__ = ('server', 'queue', 'thread')
+
+    def __init__(self, display_client, signer):
+        self.server = PrivateServer(None, display_client, signer,
+            trusted=True
+        )
+        self.queue = queue.Queue()
+        self.thread = None
+
+    def start(self):
+        assert self.thread is None
+        self.thread = threading.Thread(target=self.serve_forever,
+            name='signer', daemon=True
+        )
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is not None:
+            self.queue.put(None)
+            self.thread.join()
+            self.thread = None
+
+    def serve_forever(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            if item is ROTATE:
+                try:
+                    self.server.rotate()
+                except Exception:
+                    log.exception('Error rotating key:')
+                continue
+            (requests, callback) = item
+            (responses, error) = (None, None)
+            try:
+                responses = self.server.handle_requests(requests)
+            except Exception as e:
+                log.exception('Error signing %d requests:', len(requests))
+                error = e
+            try:
+                callback(responses, error)
+            except Exception:
+                log.exception('Error returning %d responses:', len(requests))
+
+    # Queued like a request, so it happens between two signings:
+    def rotate(self):
+        self.queue.put(ROTATE)
+
+    # *callback(responses, error)* is called from the signer thread once the
+    # requests are signed, or have failed:
+    def submit(self, requests, callback):
+        assert len(requests) > 0
+        self.queue.put((list(requests), callback))
+
+
+# Stands in for ipc.PrivateClient.  The responses come from our own Signer, so
+# unlike a response read off a socket, there's no need to verify them:
+class LocalPrivateClient:
+    __slots__ = ('signer_thread',)
+
+    def __init__(self, signer_thread):
+        self.signer_thread = signer_thread
+
+    def make_request(self, request):
+        return self.make_requests([request])[0]
+
+    def make_requests(self, requests):
+        replies = queue.Queue(1)
+        self.signer_thread.submit(requests,
+            lambda responses, error: replies.put((responses, error))
+        )
+        try:
+            (responses, error) = replies.get(timeout=IPC_TIMEOUT)
+        except queue.Empty:
+            raise TimeoutError(
+                'signer thread: no responses after {}s'.format(IPC_TIMEOUT)
+            )
+        if error is not None:
+            raise error
+        return responses
+
+
+def _settle(future, responses, error):
+    if future.done():
+        return
+    if error is not None:
+        future.set_exception(error)
+    else:
+        future.set_result(responses)
+
+
+# Stands in for aio.AsyncPrivateClient:
+class AsyncLocalClient:
+    __slots__ = ('signer_thread',)
+
+    def __init__(self, signer_thread):
+        self.signer_thread = signer_thread
+
+    async def make_request(self, request):
+        return (await self.make_requests([request]))[0]
+
+    async def make_requests(self, requests):
+        loop = asyncio.get_event_loop()
+        future = loop.create_future()
+        self.signer_thread.submit(requests,
+            lambda responses, error: loop.call_soon_threadsafe(
+                _settle, future, responses, error
+            )
+        )
+        return await asyncio.wait_for(future, IPC_TIMEOUT)
+
+
+async def serve_ports(signer_thread, ports, SerialClass=None, captures=None,
+        stop=None, rotate_signal=None, status_key=None):
+    if rotate_signal is not None:
+        loop = asyncio.get_event_loop()
+        loop.add_signal_handler(rotate_signal, signer_thread.rotate)
+    return await aio.serve_ports(AsyncLocalClient(signer_thread), ports,
+        SerialClass, captures, stop, status_key
+    )
+
+
+# With *rotate_signal*, that signal rotates the key (which only works when
+# run from the main thread):
+def run(display_client, signer, ports, SerialClass=None, captures=None,
+        stop=None, rotate_signal=None, status_key=None):
+    signer_thread = SignerThread(display_client, signer)
+    signer_thread.start()
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(
+            serve_ports(signer_thread, ports, SerialClass, captures, stop,
+                rotate_signal, status_key
+            )
+        )
+    finally:
+        loop.close()
+        signer_thread.stop()
@@ -16,8 +16,9 @@
 
 from collections import namedtuple
 import logging
-from hashlib import sha384
+from hashlib import sha384, blake2b
 from base64 import b32encode, b32decode
+import ctypes
 import json
 import os
 from os import path
@@ -29,8 +30,10 @@ Config = namedtuple('Config', 'key types default')
 log = logging.getLogger(__name__)
 
 SERIAL_BAUDRATE = 57600
+SERIAL_BAUDRATES = (57600, 115200, 230400, 460800, 921600)
 SERIAL_TIMEOUT = 2
 SERIAL_RETRIES = 3
+SERIAL_WINDOW = 8
 IPC_TIMEOUT = SERIAL_TIMEOUT * SERIAL_RETRIES * 2
 
 SIGNATURE = 64
@@ -40,6 +43,7 @@ TIMESTAMP = 8
 GENESIS = SIGNATURE + PUBKEY
 PREFIX = GENESIS + SIGNATURE + COUNTER + TIMESTAMP
 DIGEST = 48
+DEFAULT_DIGEST_ALGORITHM = 'sha384'
 REQUEST = PREFIX + DIGEST
 RESPONSE = PREFIX + REQUEST
 
@@ -48,6 +52,8 @@ MAX_SIZE = max(SIZES)
 
 MAX_CONFIG_FILE_SIZE = 4096
 CONFIG_DEBUG = Config('debug', bool, False)
+CONFIG_SERIAL_CAPTURE = Config('serial_capture', str, '')
+CONFIG_DIGEST_ALGORITHM = Config('digest_algorithm', str, DEFAULT_DIGEST_ALGORITHM)
 
 
 B32ALPHABET = 'ABCDEFGHIJKLMNOPQRSTUVWXYZ234567'
@@ -144,6 +150,39 @@ def atomic_write(mode, content, filename, tmp=None):
     log.info('Wrote %03o %r', mode, filename)
 
 
+def _load_syncfs():
+    try:
+        return ctypes.CDLL(None, use_errno=True).syncfs
+    except (OSError, AttributeError):
+        return None
+
+
+_syncfs = _load_syncfs()
+
+
+# One syncfs(2) of the filesystem *dirname* is on, which (unlike os.sync())
+# leaves the other filesystems alone.  False where there's no syncfs(2):
+def syncfs(dirname):
+    if _syncfs is None:
+        return False
+    fd = os.open(dirname, os.O_RDONLY | os.O_DIRECTORY)
+    try:
+        if _syncfs(fd) != 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), dirname)
+    finally:
+        os.close(fd)
+    return True
+
+
+def fsync_file(filename):
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
 LOG_SEP = '\n  '
 
 GENESIS_TEMPLATE = LOG_SEP.join([
@@ -284,6 +323,14 @@ def load_config(filename, *schema):
 def load_client_config(filename='/etc/pihsm/client.json'):
     return load_config(filename,
         Config('serial_port', str, '/dev/ttyUSB0'),
+        Config('serial_ports', list, []),
+        CONFIG_DIGEST_ALGORITHM,
+        Config('response_cache_size', int, 0),
+        Config('response_cache_window', int, 3600),
+        Config('max_queue', int, 32),
+        Config('max_baudrate', int, SERIAL_BAUDRATES[-1]),
+        Config('resume_chain', bool, False),
+        CONFIG_SERIAL_CAPTURE,
         CONFIG_DEBUG,
     )
 
@@ -291,6 +338,16 @@ def load_client_config(filename='/etc/pihsm/client.json'):
 def load_server_config(filename='/etc/pihsm/server.json'):
     return load_config(filename,
         Config('serial_port', str, '/dev/ttyAMA0'),
+        Config('serial_ports', list, []),
+        Config('serial_chains', dict, {}),
+        CONFIG_SERIAL_CAPTURE,
+        CONFIG_DEBUG,
+    )
+
+
+def load_private_config(filename='/etc/pihsm/private.json'):
+    return load_config(filename,
+        Config('chains', list, []),
         CONFIG_DEBUG,
     )
 
@@ -311,7 +368,28 @@ def enable_display_hardware(filename='/etc/pihsm/display.json'):
     atomic_write(0o644, content, filename)
 
 
-def compute_digest(data):
+def _blake2b(data):
+    return blake2b(data, digest_size=DIGEST)
+
+
+DIGEST_ALGORITHMS = {
+    'sha384': sha384,
+    'blake2b': _blake2b,
+}
+
+
+def check_digest_algorithm(algorithm):
+    if algorithm not in DIGEST_ALGORITHMS:
+        raise ValueError(
+            'algorithm: need one of {!r}; got {!r}'.format(
+                sorted(DIGEST_ALGORITHMS), algorithm
+            )
+        )
+    return algorithm
+
+
+def compute_digest(data, algorithm=DEFAULT_DIGEST_ALGORITHM):
+    check_digest_algorithm(algorithm)
     if type(data) is not bytes:
         raise TypeError(
             'data: need a {!r}; got a {!r}'.format(bytes, type(data))
@@ -320,7 +398,30 @@ def compute_digest(data):
         raise ValueError(
             'data: cannot provide empty bytes'
         )
-    return sha384(data).digest()
+    return DIGEST_ALGORITHMS[algorithm](data).digest()
+
+
+# Every algorithm produces a DIGEST sized value, so the fixed-size request
+# can't carry a tag; instead we recompute each over the manifest:
+def identify_digest(data, digest):
+    assert type(digest) is bytes and len(digest) == DIGEST
+    for algorithm in sorted(DIGEST_ALGORITHMS):
+        if compute_digest(data, algorithm) == digest:
+            return algorithm
+    return None
+
+
+# Which algorithm the digest in *request* was computed with over *manifest*.
+# Only the digest is compared; the request's signature is checked separately
+# (see verify.verify_message):
+def match_manifest(request, manifest):
+    digest = get_message(request)
+    algorithm = identify_digest(manifest, digest)
+    if algorithm is None:
+        raise ValueError(
+            'manifest does not match digest {}'.format(digest.hex())
+        )
+    return algorithm
 
 
 def create_b32_subdirs(basedir):
@@ -348,8 +449,11 @@ class B32Store:
         b32 = b32enc(key)
         return path.join(self.basedir, b32[0:2], b32[2:])
 
+    def compute_key(self, content):
+        return self.get_key(content)
+
     def write(self, content):
-        key = self.get_key(content)
+        key = self.compute_key(content)
         filename = self.path(key)
         tmpfile = path.join(self.basedir, 'tmp', random_id())
         with open(tmpfile, 'xb', 0) as fp:
@@ -360,17 +464,49 @@ class B32Store:
         log.info('Wrote %r', filename)
         return key
 
+    # Like write(), but with one syncfs() of the store's filesystem for the
+    # whole batch (an fsync per file where there's no syncfs), so it's never
+    # worse than a write() each.  Nothing is renamed into place until all of
+    # it is on disk:
+    def write_many(self, contents):
+        if len(contents) == 1:
+            return [self.write(contents[0])]
+        written = []
+        for content in contents:
+            key = self.compute_key(content)
+            tmpfile = path.join(self.basedir, 'tmp', random_id())
+            with open(tmpfile, 'xb', 0) as fp:
+                os.chmod(fp.fileno(), 0o444)
+                fp.write(content)
+            written.append((key, tmpfile))
+        if written and not syncfs(path.join(self.basedir, 'tmp')):
+            for (key, tmpfile) in written:
+                fsync_file(tmpfile)
+        for (key, tmpfile) in written:
+            filename = self.path(key)
+            os.rename(tmpfile, filename)
+            log.info('Wrote %r', filename)
+        return [key for (key, tmpfile) in written]
+
     def open(self, key):
         filename = self.path(key)
         return open(filename, 'rb', 0)
 
 
 class ManifestStore(B32Store):
+    __slots__ = ('algorithm',)
     name = 'manifest'
 
+    def __init__(self, parentdir, algorithm=DEFAULT_DIGEST_ALGORITHM):
+        self.algorithm = check_digest_algorithm(algorithm)
+        super().__init__(parentdir)
+
     @staticmethod
-    def get_key(content):
-        return compute_digest(content)
+    def get_key(content, algorithm=DEFAULT_DIGEST_ALGORITHM):
+        return compute_digest(content, algorithm)
+
+    def compute_key(self, content):
+        return self.get_key(content, self.algorithm)
 
 
 class ChainStore(B32Store):
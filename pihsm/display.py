@@ -37,10 +37,13 @@
 #   * Rework into a class, make easier to reuse as a library
 #
 
+import glob
+import os
+from os import path
 import time
 import logging
 
-from .common import b32enc, log_genesis, log_response, RESPONSE
+from .common import b32enc, random_id, log_genesis, log_response, RESPONSE
 from .verify import get_signature, get_pubkey, get_counter
 from .sign import get_entropy_avail
 
@@ -157,6 +160,16 @@ def _mk_time_and_counter_lines(counter):
     )
 
 
+def _mk_chain_lines(name, tail):
+    counter = (get_counter(tail) if len(tail) == RESPONSE else 0)
+    return (
+        'Chain:'.ljust(20),
+        name.rjust(20),
+        'Counter:'.ljust(20),
+        _mk_u64_line(counter),
+    )
+
+
 def _mk_pubkey_lines(pubkey):
     assert type(pubkey) is bytes and len(pubkey) == 32
     p = b32enc(pubkey)
@@ -237,19 +250,39 @@ def tail_to_screens(tail):
     raise ValueError('bad tail length')
 
 
+# Publishes the tail for the DisplayLoop, which runs as another user:
+class SpecialClient:
+    __slots__ = ('basedir', 'filename')
+
+    def __init__(self, basedir='/run/pihsm-private', name='tail'):
+        self.basedir = basedir
+        self.filename = path.join(basedir, name)
+
+    def make_request(self, request):
+        tmp = path.join(self.basedir, random_id())
+        with open(tmp, 'xb', 0) as fp:
+            os.chmod(fp.fileno(), 0o444)
+            fp.write(request)
+            os.fsync(fp.fileno())
+        os.rename(tmp, self.filename)
+
+
+# A multi-chain pihsm-private also publishes a "tail.<name>" file for each
+# named chain, and each gets a screen after those for the default chain:
 class DisplayLoop:
     def __init__(self, lcd, filename='/run/pihsm-private/tail'):
         self.lcd = lcd
         self.filename = filename
         self.last = None
         self.screens = _mk_init_screens()
+        self.chain_screens = tuple()
 
     def run_first(self):
         self.lcd.lcd_init()
         self.play_screens()
 
     def play_screens(self):
-        self.lcd.lcd_screens(*self.screens)
+        self.lcd.lcd_screens(*(self.screens + self.chain_screens))
 
     def update_tail(self, tail):
         if tail != self.last:
@@ -262,6 +295,19 @@ class DisplayLoop:
             self.update_tail(fp.read(RESPONSE))
         except FileNotFoundError:
             self.update_tail(False)
+        self.update_chains()
+
+    def update_chains(self):
+        screens = []
+        for filename in sorted(glob.glob(self.filename + '.*')):
+            try:
+                with open(filename, 'rb', 0) as fp:
+                    tail = fp.read(RESPONSE)
+            except FileNotFoundError:
+                continue
+            name = filename[len(self.filename) + 1:]
+            screens.append(_mk_chain_lines(name, tail))
+        self.chain_screens = tuple(screens)
 
     def run_once(self):
         self.update_tail_if_needed()
@@ -15,57 +15,156 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import errno
 import logging
+import os
+import re
+import select
+import selectors
 import socket
+import threading
+import time
 
 from .common import (
     IPC_TIMEOUT,
+    SERIAL_WINDOW,
+    REQUEST,
+    RESPONSE,
     log_response,
     get_signature,
     b32enc,
 )
 from .verify import verify_message
+from .cache import RingCache
+from .schedule import (
+    PRIORITIES,
+    BULK,
+    DeadlineExpired,
+    Job,
+    QueueFull,
+    Scheduler,
+    get_peercred,
+    latest_deadline,
+)
+from .pool import HEALTH_INTERVAL, NoDevice, Device, DevicePool
+from .wire import MAX_BATCH
 
 
 log = logging.getLogger(__name__)
 
+DEFAULT_PRIORITY = 0xFF
+ROTATE_POLL = 1
+
+# Chain names are directory names and fit on one line of the display:
+DEFAULT_CHAIN = 'default'
+CHAIN_NAME = re.compile('^[a-z0-9][a-z0-9_-]{0,19}$')
+MAX_CHAIN_FIELD = 21
+
 
 def open_activated_socket(fd=3):
     sock = socket.fromfd(fd, socket.AF_UNIX, socket.SOCK_STREAM)
+    sock_type = sock.getsockopt(socket.SOL_SOCKET, socket.SO_TYPE)
+    if sock_type != socket.SOCK_STREAM:
+        # Created by ListenSequentialPacket= rather than ListenStream=:
+        sock.close()
+        sock = socket.fromfd(fd, socket.AF_UNIX, sock_type)
     log.info('opened %r', sock)
     return sock
 
 
+# SOCK_SEQPACKET preserves message boundaries, so a single recv_into() gets the
+# entire message; the buffer has a spare byte so an oversized message shows up
+# as a bad size instead of being silently truncated.  SOCK_STREAM can return a
+# short read, so keep reading until we have *size* bytes or hit EOF.
+def recv_message(sock, buf, size):
+    assert len(buf) > size
+    view = memoryview(buf)
+    if sock.type == socket.SOCK_SEQPACKET:
+        return sock.recv_into(view)
+    received = 0
+    while received < size:
+        n = sock.recv_into(view[received:size])
+        if n == 0:
+            break
+        received += n
+    return received
+
+
+def open_activated_sockets(environ=None):
+    environ = (os.environ if environ is None else environ)
+    count = int(environ.get('LISTEN_FDS', 1))
+    return [open_activated_socket(3 + i) for i in range(count)]
+
+
+def check_chain_name(name):
+    if not (type(name) is str and CHAIN_NAME.match(name)):
+        raise ValueError('bad chain name: {!r}'.format(name))
+    return name
+
+
+# Over SOCK_SEQPACKET, a message for a chain other than the default starts
+# with a length byte and the chain name.  No name is long enough to make the
+# message a whole number of requests, so the two can't be confused:
+def pack_private_request(requests, chain=None):
+    data = b''.join(requests)
+    if chain is None or chain == DEFAULT_CHAIN:
+        return data
+    name = check_chain_name(chain).encode()
+    return bytes([len(name)]) + name + data
+
+
+def unpack_private_request(data):
+    chain = DEFAULT_CHAIN
+    if len(data) % REQUEST:
+        stop = 1 + data[0]
+        if stop <= MAX_CHAIN_FIELD and (len(data) - stop) % REQUEST == 0:
+            name = bytes(data[1:stop]).decode('ascii', 'replace')
+            chain = check_chain_name(name)
+            data = data[stop:]
+    size = len(data)
+    if size == 0 or size % REQUEST or size > REQUEST * MAX_BATCH:
+        raise ValueError(
+            'bad request: expected 1 to {} times {} bytes; got {}'.format(
+                MAX_BATCH, REQUEST, size
+            )
+        )
+    requests = [bytes(data[i:i + REQUEST]) for i in range(0, size, REQUEST)]
+    return (chain, requests)
+
+
 class Server:
-    __slots__ = ('sock', 'request_size')
+    __slots__ = ('sock', 'request_size', 'buf')
 
     def __init__(self, sock, request_size):
         assert type(request_size) is int and request_size > 0
         self.sock = sock
         self.request_size = request_size
+        self.buf = bytearray(request_size + 1)
 
     def serve_forever(self):
         while True:
             (sock, address) = self.sock.accept()
-            try:
-                sock.settimeout(IPC_TIMEOUT)
-                self.handle_connection(sock)
-            except:
-                log.exception('Error handling request:')
-            finally:
-                sock.close()
+            self.serve_connection(sock)
+
+    def serve_connection(self, sock):
+        try:
+            sock.settimeout(IPC_TIMEOUT)
+            self.handle_connection(sock)
+        except:
+            log.exception('Error handling request:')
+        finally:
+            sock.close()
 
     def handle_connection(self, sock):
-        request = sock.recv(self.request_size)
-        size = len(request)
+        size = recv_message(sock, self.buf, self.request_size)
         if size != self.request_size:
             raise ValueError(
                 'bad request: expected {} bytes; got {}'.format(
                     self.request_size, size
                 )
             )
-        response = self.handle_request(request)
-        sock.send(response)
+        response = self.handle_request(bytes(memoryview(self.buf)[:size]))
+        sock.sendall(response)
 
     def handle_request(self, request):
         raise NotImplementedError(
@@ -73,95 +172,511 @@ class Server:
         )
 
 
+# Over SOCK_SEQPACKET a message can carry up to MAX_BATCH requests, which are
+# signed as consecutive chain nodes with one store sync, and answered with
+# their responses in one message.
+#
+# Requests from a socket are verified before they're signed.  A *trusted*
+# PrivateServer only takes requests from inside its own process, which the
+# serial front end there has already verified:
 class PrivateServer(Server):
-    __slots__ = ('display_client', 'signer')
+    __slots__ = ('display_client', 'signer', 'recent', 'trusted',
+        'rotate_requested',
+    )
 
-    def __init__(self, sock, display_client, signer):
+    def __init__(self, sock, display_client, signer, recent_size=16,
+            trusted=False):
         super().__init__(sock, 224)
+        self.buf = bytearray(MAX_CHAIN_FIELD + REQUEST * MAX_BATCH + 1)
         self.signer = signer
         self.display_client = display_client
+        self.recent = RingCache(recent_size)
+        self.trusted = trusted
+        self.rotate_requested = False
+
+    # Only sets a flag, so it's safe to call from a signal handler; the key is
+    # rotated between connections:
+    def request_rotate(self):
+        self.rotate_requested = True
+
+    def rotate(self):
+        self.rotate_requested = False
+        handover = self.signer.rotate()
+        self.signer.start_next_key()
+        self.display_client.make_request(self.signer.genesis)
+        return handover
+
+    def serve_forever(self):
+        self.sock.settimeout(ROTATE_POLL)
+        while True:
+            if self.rotate_requested:
+                try:
+                    self.rotate()
+                except Exception:
+                    log.exception('Error rotating key:')
+            try:
+                (sock, address) = self.sock.accept()
+            except socket.timeout:
+                continue
+            self.serve_connection(sock)
+
+    def check_request(self, request):
+        if not self.trusted:
+            verify_message(request)
+
+    def handle_connection(self, sock):
+        if sock.type != socket.SOCK_SEQPACKET:
+            return super().handle_connection(sock)
+        size = recv_message(sock, self.buf, self.request_size)
+        (chain, requests) = unpack_private_request(memoryview(self.buf)[:size])
+        if chain != DEFAULT_CHAIN:
+            raise ValueError('unknown chain {!r}'.format(chain))
+        sock.sendall(b''.join(self.handle_requests(requests)))
+
+    def get_recent(self, request):
+        response = self.recent.get(get_signature(request))
+        if response is not None and response.endswith(request):
+            return response
+        return None
 
     def handle_request(self, request):
-        verify_message(request)
-        if self.signer.message == request:
-            response = self.signer.tail
-            log.warning('Reusing response %s', b32enc(get_signature(response)))
+        self.check_request(request)
+        response = self.get_recent(request)
+        if response is not None:
+            log.warning('Reusing response %s (%d retransmits)',
+                b32enc(get_signature(response)), self.recent.hits
+            )
         else:
             response = self.signer.sign(request)
+            self.recent.put(get_signature(request), response)
         log_response(response)
         self.display_client.make_request(response)
         return response
 
+    def handle_requests(self, requests):
+        if len(requests) == 1:
+            return [self.handle_request(requests[0])]
+        for request in requests:
+            self.check_request(request)
+        responses = [self.get_recent(request) for request in requests]
+        missing = [i for (i, r) in enumerate(responses) if r is None]
+        if len(missing) < len(requests):
+            log.warning('Reusing %d responses (%d retransmits)',
+                len(requests) - len(missing), self.recent.hits
+            )
+        signed = self.signer.sign_many([requests[i] for i in missing])
+        for (i, response) in zip(missing, signed):
+            self.recent.put(get_signature(requests[i]), response)
+            responses[i] = response
+        for response in responses:
+            log_response(response)
+            self.display_client.make_request(response)
+        return responses
+
 
 class ClientServer(Server):
-    __slots__ = ('serial_client', 'signer')
+    __slots__ = ('serial_client', 'signer', 'cache', 'pool')
 
-    def __init__(self, sock, serial_client, signer):
+    def __init__(self, sock, serial_client, signer, cache=None, pool=None):
         super().__init__(sock, 48)
         self.serial_client = serial_client
         self.signer = signer
+        self.cache = cache
+        if pool is None:
+            pool = DevicePool([Device('serial', serial_client, signer)])
+        self.pool = pool
+
+    def handle_request(self, digest, timestamp=None, deadline=None):
+        return self.handle_requests([digest], timestamp, deadline)[0]
+
+    def handle_requests(self, digests, timestamp=None, deadline=None,
+            batch=False):
+        assert all(len(digest) == 48 for digest in digests)
+        responses = [None] * len(digests)
+        if self.cache is not None:
+            for (i, digest) in enumerate(digests):
+                responses[i] = self.cache.get(digest)
+        missing = [i for (i, r) in enumerate(responses) if r is None]
+        if not missing:
+            return responses
+        signed = self.sign_digests([digests[i] for i in missing], timestamp,
+            deadline, batch
+        )
+        for (i, response) in zip(missing, signed):
+            if self.cache is not None:
+                self.cache.put(response)
+            responses[i] = response
+        return responses
+
+    # A batch that fails on one device is signed again on the next, until
+    # every device has been tried or the deadline has passed:
+    def sign_digests(self, digests, timestamp=None, deadline=None,
+            batch=False):
+        tried = []
+        while True:
+            device = self.pool.acquire(len(digests), tried)
+            tried.append(device)
+            try:
+                responses = self.sign_on(device, digests, timestamp, deadline,
+                    batch
+                )
+            except DeadlineExpired:
+                # Not the device's fault:
+                self.pool.release(device, len(digests), [])
+                raise
+            except Exception:
+                self.pool.release(device, len(digests))
+                if len(tried) == len(self.pool):
+                    raise
+                log.exception('Device %s failed, trying another:', device.name)
+                continue
+            self.pool.release(device, len(digests), responses)
+            return responses
+
+    def check_health(self):
+        for device in self.pool.idle():
+            self.pool.check(device, device.serial_client.ping())
+
+    def check_forever(self, stop):
+        while not stop.is_set():
+            try:
+                self.check_health()
+            except Exception:
+                log.exception('Error checking device health:')
+            stop.wait(HEALTH_INTERVAL)
+
+    # Requests are signed in order, so they can be pipelined over the serial
+    # link as a single chain, or sent in batch frames when *batch* is set.
+    # The SerialClient only returns responses it has verified:
+    def sign_on(self, device, digests, timestamp=None, deadline=None,
+            batch=False):
+        requests = device.signer.sign_many(digests, timestamp)
+        responses = device.serial_client.make_requests(requests, deadline,
+            batch
+        )
+        for (request, response) in zip(requests, responses):
+            assert response.endswith(request)
+            log.info('Signed %s on device %s',
+                b32enc(get_signature(response)), device.name
+            )
+        device.signer.store.write_many(responses)
+        return responses
+
+
+# A request is the 48-byte digest, optionally followed by a priority byte, and
+# then optionally by a deadline: milliseconds on the time.monotonic() clock (an
+# unsigned 64-bit little endian integer).  A priority of DEFAULT_PRIORITY
+# leaves the priority class of the socket in place:
+def parse_client_request(request, default=0):
+    size = len(request)
+    if size not in (48, 49, 57):
+        raise ValueError(
+            'bad request: expected 48, 49 or 57 bytes; got {}'.format(size)
+        )
+    (priority, deadline) = (default, None)
+    if size > 48 and request[48] != DEFAULT_PRIORITY:
+        priority = request[48]
+        if priority >= len(PRIORITIES):
+            raise ValueError('bad priority: {}'.format(priority))
+    if size == 57:
+        deadline = int.from_bytes(request[49:57], 'little') / 1000
+    return (request[:48], priority, deadline)
+
+
+def build_client_request(digest, priority=None, deadline=None):
+    assert len(digest) == 48
+    if priority is None and deadline is None:
+        return digest
+    if priority is None:
+        priority = DEFAULT_PRIORITY
+    assert 0 <= priority < len(PRIORITIES) or priority == DEFAULT_PRIORITY
+    request = digest + bytes([priority])
+    if deadline is not None:
+        request += int(deadline * 1000).to_bytes(8, 'little')
+    return request
+
+
+# Whether the caller has hung up, without blocking.  EOF isn't enough, as the
+# request has been read and a caller that did shutdown(SHUT_WR) after sending
+# it is still waiting for the response.  On AF_UNIX, POLLHUP is only set once
+# both directions are shut:
+def peer_closed(sock):
+    poller = select.poll()
+    poller.register(sock, select.POLLHUP)
+    for (fd, events) in poller.poll(0):
+        if events & (select.POLLHUP | select.POLLERR):
+            return True
+    return False
+
+
+# Each listening socket maps to the priority class at the same index in
+# PRIORITIES, and a request can override that with a 49th priority byte.  The
+# calling thread accepts and reads connections while worker threads drain the
+# Scheduler onto the serial links:
+class ScheduledClientServer(ClientServer):
+    __slots__ = ('socks', 'scheduler', 'pending')
+
+    def __init__(self, socks, serial_client, signer, cache=None, scheduler=None,
+            pool=None):
+        assert 0 < len(socks) <= len(PRIORITIES)
+        super().__init__(socks[0], serial_client, signer, cache, pool)
+        self.buf = bytearray(58)
+        self.socks = socks
+        self.scheduler = (Scheduler() if scheduler is None else scheduler)
+        self.pending = {}
+
+    def serve_forever(self, stop=None):
+        stop = (threading.Event() if stop is None else stop)
+        # One worker per device, each taking whatever is queued when it's free:
+        for device in self.pool.devices:
+            thread = threading.Thread(target=self.work_forever, args=(stop,),
+                daemon=True
+            )
+            thread.start()
+        thread = threading.Thread(target=self.check_forever, args=(stop,),
+            daemon=True
+        )
+        thread.start()
+        selector = selectors.DefaultSelector()
+        for (priority, sock) in enumerate(self.socks):
+            sock.setblocking(False)
+            selector.register(sock, selectors.EVENT_READ, priority)
+        while not stop.is_set():
+            for (key, events) in selector.select(timeout=1):
+                if key.fileobj in self.socks:
+                    self.accept(selector, key.fileobj, key.data)
+                else:
+                    selector.unregister(key.fileobj)
+                    self.read(key.fileobj, key.data)
+            self.expire(selector)
+
+    def accept(self, selector, listener, priority):
+        try:
+            (sock, address) = listener.accept()
+        except BlockingIOError:
+            return
+        sock.setblocking(False)
+        self.pending[sock] = time.monotonic()
+        selector.register(sock, selectors.EVENT_READ, priority)
+
+    def expire(self, selector, now=None):
+        now = (time.monotonic() if now is None else now)
+        for (sock, accepted) in list(self.pending.items()):
+            if now - accepted > IPC_TIMEOUT:
+                log.warning('Timeout waiting for request on %r', sock)
+                selector.unregister(sock)
+                del self.pending[sock]
+                sock.close()
 
-    def handle_request(self, digest, timestamp=None):
-        assert len(digest) == 48
-        request = self.signer.sign(digest, timestamp)
-        response = self.serial_client.make_request(request)
-        verify_message(response)
-        assert response.endswith(request)
-        self.signer.store.write(response)
-        return response
+    def read(self, sock, priority):
+        received = self.pending.pop(sock)
+        try:
+            size = sock.recv_into(self.buf)
+            (digest, priority, deadline) = parse_client_request(
+                bytes(memoryview(self.buf)[:size]), priority
+            )
+            # Without a deadline the caller gives up after IPC_TIMEOUT:
+            if deadline is None:
+                deadline = received + IPC_TIMEOUT
+            (pid, uid, gid) = get_peercred(sock)
+            sock.setblocking(True)
+            sock.settimeout(IPC_TIMEOUT)
+            self.scheduler.submit(
+                Job(sock, digest, priority, pid, uid, received, deadline)
+            )
+        except QueueFull as e:
+            log.warning('Rejecting request from pid %d: %s', pid, e)
+            sock.close()
+        except Exception:
+            log.exception('Error reading request:')
+            sock.close()
+
+    def work_forever(self, stop=None):
+        while stop is None or not stop.is_set():
+            job = self.scheduler.next(timeout=1)
+            if job is not None:
+                jobs = [job] + self.scheduler.take(SERIAL_WINDOW - 1)
+                jobs = self.live_jobs(jobs)
+                if jobs:
+                    self.handle_jobs(jobs)
+
+    # Drops the jobs nobody is waiting for any more, before they cost any
+    # serial bandwidth or chain nodes:
+    def live_jobs(self, jobs, now=None):
+        now = (time.monotonic() if now is None else now)
+        live = []
+        for job in jobs:
+            if job.expired(now):
+                self.scheduler.drop(job)
+            elif peer_closed(job.sock):
+                self.scheduler.drop(job, abandoned=True)
+            else:
+                live.append(job)
+                continue
+            job.sock.close()
+        return live
+
+    def handle_job(self, job):
+        self.handle_jobs([job])
+
+    def handle_jobs(self, jobs):
+        # A run of bulk jobs goes in batch frames:
+        batch = len(jobs) > 1 and all(job.priority == BULK for job in jobs)
+        try:
+            responses = self.handle_requests([job.digest for job in jobs],
+                deadline=latest_deadline(jobs), batch=batch
+            )
+        except DeadlineExpired as e:
+            log.warning('Dropping %d requests: %s', len(jobs), e)
+            for job in jobs:
+                job.sock.close()
+                self.scheduler.drop(job)
+            return
+        except NoDevice as e:
+            log.warning('Failing %d requests: %s', len(jobs), e)
+            responses = [None] * len(jobs)
+        except Exception:
+            log.exception('Error handling %d requests:', len(jobs))
+            responses = [None] * len(jobs)
+        for (job, response) in zip(jobs, responses):
+            try:
+                if response is not None:
+                    job.sock.sendall(response)
+            except Exception:
+                log.exception('Error sending response:')
+            finally:
+                job.sock.close()
+                self.scheduler.done(job)
 
 
 class Client:
-    __slots__ = ('filename', 'response_size')
+    __slots__ = ('filename', 'response_size', 'sock_type', 'buf')
 
-    def __init__(self, filename, response_size):
+    def __init__(self, filename, response_size, sock_type=None):
+        assert sock_type in (None, socket.SOCK_STREAM, socket.SOCK_SEQPACKET)
         self.filename = filename
         self.response_size = response_size
+        self.sock_type = sock_type
+        self.buf = bytearray(response_size + 1)
+
+    def _connect(self, sock_type):
+        sock = socket.socket(socket.AF_UNIX, sock_type)
+        try:
+            sock.settimeout(IPC_TIMEOUT)
+            sock.connect(self.filename)
+            return sock
+        except:
+            sock.close()
+            raise
 
     def connect(self):
-        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
-        sock.settimeout(IPC_TIMEOUT)
-        sock.connect(self.filename)
+        if self.sock_type is not None:
+            return self._connect(self.sock_type)
+        # Not configured, so try SOCK_SEQPACKET and remember what worked:
+        try:
+            sock = self._connect(socket.SOCK_SEQPACKET)
+            self.sock_type = socket.SOCK_SEQPACKET
+        except OSError as e:
+            if e.errno != errno.EPROTOTYPE:
+                raise
+            sock = self._connect(socket.SOCK_STREAM)
+            self.sock_type = socket.SOCK_STREAM
+        log.info('Using %s for %r', self.sock_type.name, self.filename)
         return sock
 
-    def _make_request(self, request):
+    def _make_request(self, request, timeout=None):
         sock = self.connect()
         try:
-            sock.send(request)
-            response = sock.recv(self.response_size)
-            if len(response) != self.response_size:
+            if timeout is not None:
+                sock.settimeout(timeout)
+            sock.sendall(request)
+            size = recv_message(sock, self.buf, self.response_size)
+            if size != self.response_size:
                 raise ValueError(
                     'bad response size: expected {}; got {}'.format(
-                        self.response_size, len(response)
+                        self.response_size, size
                     )
                 )
-            return response
+            return bytes(memoryview(self.buf)[:size])
         finally:
             sock.close()
 
 
+# With a *chain*, requests are signed by that chain on a multi-chain
+# pihsm-private, which needs SOCK_SEQPACKET to carry the name:
 class PrivateClient(Client):
-    __slots__ = tuple()
+    __slots__ = ('chain',)
 
-    def __init__(self, filename='/run/pihsm/private.socket'):
-        super().__init__(filename, 400)
+    def __init__(self, filename='/run/pihsm/private.socket', sock_type=None,
+            chain=None):
+        super().__init__(filename, 400, sock_type)
+        self.buf = bytearray(RESPONSE * MAX_BATCH + 1)
+        if chain is not None:
+            check_chain_name(chain)
+        self.chain = (None if chain == DEFAULT_CHAIN else chain)
 
     def make_request(self, request):
+        if self.chain is not None:
+            return self.make_requests([request])[0]
         response = self._make_request(request)
         verify_message(response)
         assert response.endswith(request)
         return response
 
+    # One round trip for the lot over SOCK_SEQPACKET; SOCK_STREAM has no
+    # message boundaries to carry the count, so there it's one per request:
+    def make_requests(self, requests):
+        assert 0 < len(requests) <= MAX_BATCH
+        if self.chain is None and (
+                len(requests) == 1 or self.sock_type == socket.SOCK_STREAM):
+            return [self.make_request(request) for request in requests]
+        sock = self.connect()
+        try:
+            if self.sock_type == socket.SOCK_SEQPACKET:
+                sock.sendall(pack_private_request(requests, self.chain))
+                size = sock.recv_into(self.buf)
+        finally:
+            sock.close()
+        if self.sock_type == socket.SOCK_STREAM:
+            if self.chain is not None:
+                raise ValueError(
+                    'chain {!r}: needs SOCK_SEQPACKET'.format(self.chain)
+                )
+            return [self.make_request(request) for request in requests]
+        expected = self.response_size * len(requests)
+        if size != expected:
+            raise ValueError(
+                'bad response size: expected {}; got {}'.format(expected, size)
+            )
+        view = memoryview(self.buf)
+        responses = [
+            bytes(view[i:i + self.response_size])
+            for i in range(0, size, self.response_size)
+        ]
+        for (request, response) in zip(requests, responses):
+            verify_message(response)
+            assert response.endswith(request)
+        return responses
+
 
 class ClientClient(Client):
     __slots__ = tuple()
 
-    def __init__(self, filename='/run/pihsm/client.socket'):
-        super().__init__(filename, 400)
-
-    def make_request(self, request):
-        response = self._make_request(request)
+    def __init__(self, filename='/run/pihsm/client.socket', sock_type=None):
+        super().__init__(filename, 400, sock_type)
+
+    # With a *timeout*, the server drops the request unsigned if it can't be
+    # signed in time, and we stop waiting at the same moment:
+    def make_request(self, digest, priority=None, timeout=None):
+        if priority is not None:
+            assert 0 <= priority < len(PRIORITIES)
+        deadline = None
+        if timeout is not None:
+            assert timeout > 0
+            deadline = time.monotonic() + timeout
+        request = build_client_request(digest, priority, deadline)
+        response = self._make_request(request, timeout)
         verify_message(response)
-        assert response.endswith(request)
+        assert response.endswith(digest)
         return response
 
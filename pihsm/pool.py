@@ -0,0 +1,183 @@
+# pihsm: Turn your Raspberry Pi into a Hardware Security Module 
+# Copyright (C) 2017 System76, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Spread signing requests across several PiHSMs.
+
+Each Device pairs the SerialClient for one Pi with a client Signer of its own,
+so every Pi extends an independent chain.  Requests go to the device with the
+fewest requests in flight; a device that fails is out of rotation for
+RETRY_INTERVAL seconds, doubling with each failure in a row up to RETRY_MAX,
+unless every device has failed.
+
+Idle devices are pinged every HEALTH_INTERVAL seconds.  A device that doesn't
+answer is marked down, and while every device is out of rotation with at
+least one down, requests fail at once rather than waiting out the serial
+retries.  A lone device is always tried, as failing fast gains nothing when
+there's nowhere else to go.
+"""
+
+import logging
+import threading
+import time
+
+from .common import b32enc
+from .verify import get_pubkey
+
+
+log = logging.getLogger(__name__)
+
+RETRY_INTERVAL = 1
+RETRY_MAX = 60
+HEALTH_INTERVAL = 5
+
+
+class NoDevice(Exception):
+    def __init__(self, count):
+        self.count = count
+        super().__init__('all {} devices are down'.format(count))
+
+
+class Device:
+    __slots__ = ('name', 'serial_client', 'signer', 'public', 'load', 'signed',
+        'failures', 'strikes', 'retry_at', 'down', 'status',
+    )
+
+    def __init__(self, name, serial_client, signer):
+        self.name = name
+        self.serial_client = serial_client
+        self.signer = signer
+        # The Pi's public key, once it has signed something:
+        self.public = None
+        self.load = 0
+        self.signed = 0
+        self.failures = 0
+        # Failures since the last success, for the backoff:
+        self.strikes = 0
+        self.retry_at = None
+        # Set by health checks; the last Status the device answered with:
+        self.down = False
+        self.status = None
+
+    def available(self, now):
+        return self.retry_at is None or now >= self.retry_at
+
+    def stats(self):
+        return {
+            'public': (None if self.public is None else b32enc(self.public)),
+            'load': self.load,
+            'signed': self.signed,
+            'failures': self.failures,
+            'healthy': self.retry_at is None,
+            'down': self.down,
+            'counter': (None if self.status is None else self.status.counter),
+        }
+
+
+class DevicePool:
+    __slots__ = ('devices', 'lock', 'retry_interval')
+
+    def __init__(self, devices, retry_interval=RETRY_INTERVAL):
+        assert len(devices) > 0
+        assert len(set(d.name for d in devices)) == len(devices)
+        self.devices = tuple(devices)
+        self.lock = threading.Lock()
+        self.retry_interval = retry_interval
+
+    def __len__(self):
+        return len(self.devices)
+
+    # The least loaded device not in *exclude*, preferring those in rotation.
+    # When every device has failed, the one due to be retried first is used:
+    def acquire(self, count=1, exclude=(), now=None):
+        now = (time.monotonic() if now is None else now)
+        with self.lock:
+            candidates = [d for d in self.devices if d not in exclude]
+            assert candidates
+            device = min(candidates, key=lambda d: (
+                (0, 0, d.load) if d.available(now) else (1, d.retry_at, d.load)
+            ))
+            if device.down and not device.available(now) \
+                    and len(self.devices) > 1:
+                raise NoDevice(len(self.devices))
+            device.load += count
+            return device
+
+    def release(self, device, count, responses=None, now=None):
+        now = (time.monotonic() if now is None else now)
+        with self.lock:
+            device.load -= count
+            if responses is not None:
+                if device.retry_at is not None:
+                    log.info('Device %s is back in rotation', device.name)
+                device.retry_at = None
+                device.strikes = 0
+                device.down = False
+                device.signed += len(responses)
+                if responses:
+                    device.public = get_pubkey(responses[-1])
+            else:
+                interval = self.bench(device, now)
+                log.warning('Device %s out of rotation for %ds (%d failures)',
+                    device.name, interval, device.failures
+                )
+
+    # Records the result of pinging *device*, None if it didn't answer:
+    def check(self, device, status, now=None):
+        now = (time.monotonic() if now is None else now)
+        with self.lock:
+            if status is not None:
+                if device.down:
+                    log.info('Device %s is up at counter %d',
+                        device.name, status.counter
+                    )
+                device.status = status
+                device.down = False
+                device.retry_at = None
+                device.strikes = 0
+            else:
+                if not device.down:
+                    log.warning('Device %s is down', device.name)
+                device.down = True
+                self.bench(device, now)
+
+    # Takes *device* out of rotation, for twice as long as last time if it
+    # failed then too.  Call with the lock held:
+    def bench(self, device, now):
+        device.failures += 1
+        device.strikes += 1
+        interval = min(self.retry_interval * 2 ** (device.strikes - 1),
+            RETRY_MAX
+        )
+        device.retry_at = now + interval
+        return interval
+
+    # The devices worth pinging: those without requests in flight:
+    def idle(self):
+        with self.lock:
+            return [d for d in self.devices if d.load == 0]
+
+    # The device whose Pi signed *response*:
+    def find(self, response):
+        public = get_pubkey(response)
+        for device in self.devices:
+            if device.public == public:
+                return device
+        return None
+
+    def stats(self):
+        with self.lock:
+            return dict((d.name, d.stats()) for d in self.devices)
@@ -0,0 +1,217 @@
+# pihsm: Turn your Raspberry Pi into a Hardware Security Module 
+# Copyright (C) 2017 System76, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Priority scheduling of signing requests in front of the serial link.
+
+Requests are queued by priority class (lower index is served first).  Within a
+class, peers (by SO_PEERCRED uid) are served round-robin so one busy peer can't
+starve the others.
+"""
+
+from collections import OrderedDict, deque
+import logging
+import socket
+import struct
+import threading
+import time
+
+
+log = logging.getLogger(__name__)
+
+PRIORITIES = ('interactive', 'bulk')
+INTERACTIVE = 0
+BULK = 1
+MAX_QUEUE = 32
+LATENCY_SAMPLES = 1000
+REPORT_INTERVAL = 100
+
+PEERCRED = struct.Struct('3i')
+
+
+def get_peercred(sock):
+    data = sock.getsockopt(socket.SOL_SOCKET, socket.SO_PEERCRED, PEERCRED.size)
+    return PEERCRED.unpack(data)
+
+
+def percentile(ordered, p):
+    assert 0 < p <= 100
+    if not ordered:
+        return None
+    i = max(0, -(-len(ordered) * p // 100) - 1)
+    return ordered[i]
+
+
+class QueueFull(Exception):
+    def __init__(self, priority, size):
+        self.priority = priority
+        self.size = size
+        super().__init__(
+            '{} queue is full ({} requests)'.format(PRIORITIES[priority], size)
+        )
+
+
+class DeadlineExpired(Exception):
+    def __init__(self, count):
+        self.count = count
+        super().__init__('deadline passed with {} requests unsigned'.format(
+            count)
+        )
+
+
+# *deadline* is on the time.monotonic() clock, which all processes share:
+class Job:
+    __slots__ = ('sock', 'digest', 'priority', 'pid', 'uid', 'received',
+        'deadline',
+    )
+
+    def __init__(self, sock, digest, priority, pid=0, uid=0, received=None,
+            deadline=None):
+        assert 0 <= priority < len(PRIORITIES)
+        self.sock = sock
+        self.digest = digest
+        self.priority = priority
+        self.pid = pid
+        self.uid = uid
+        self.received = (time.monotonic() if received is None else received)
+        self.deadline = deadline
+
+    def expired(self, now):
+        return self.deadline is not None and now >= self.deadline
+
+
+# The latest deadline of *jobs*, or None if any of them has none:
+def latest_deadline(jobs):
+    deadlines = [job.deadline for job in jobs]
+    if None in deadlines:
+        return None
+    return max(deadlines)
+
+
+class LatencyStats:
+    __slots__ = ('samples', 'count')
+
+    def __init__(self, size=LATENCY_SAMPLES):
+        self.samples = deque(maxlen=size)
+        self.count = 0
+
+    def add(self, seconds):
+        self.samples.append(seconds)
+        self.count += 1
+
+    def percentiles(self, *ps):
+        ordered = sorted(self.samples)
+        return tuple(percentile(ordered, p) for p in ps)
+
+
+class Scheduler:
+    __slots__ = ('max_queue', 'cond', 'queues', 'sizes', 'rejected', 'latency',
+        'expired', 'abandoned',
+    )
+
+    def __init__(self, max_queue=MAX_QUEUE):
+        assert type(max_queue) is int and max_queue > 0
+        self.max_queue = max_queue
+        self.cond = threading.Condition()
+        self.queues = tuple(OrderedDict() for p in PRIORITIES)
+        self.sizes = [0 for p in PRIORITIES]
+        self.rejected = [0 for p in PRIORITIES]
+        self.latency = tuple(LatencyStats() for p in PRIORITIES)
+        # Jobs dropped unsigned because their deadline passed, or because the
+        # caller hung up first:
+        self.expired = [0 for p in PRIORITIES]
+        self.abandoned = [0 for p in PRIORITIES]
+
+    def __len__(self):
+        return sum(self.sizes)
+
+    def submit(self, job):
+        p = job.priority
+        with self.cond:
+            if self.sizes[p] >= self.max_queue:
+                self.rejected[p] += 1
+                raise QueueFull(p, self.sizes[p])
+            peers = self.queues[p]
+            if job.uid not in peers:
+                peers[job.uid] = deque()
+            peers[job.uid].append(job)
+            self.sizes[p] += 1
+            self.cond.notify()
+
+    def _pop(self):
+        for (p, peers) in enumerate(self.queues):
+            if peers:
+                (uid, jobs) = peers.popitem(last=False)
+                job = jobs.popleft()
+                if jobs:
+                    peers[uid] = jobs  # Back of the line for this peer
+                self.sizes[p] -= 1
+                return job
+        return None
+
+    def next(self, timeout=None):
+        with self.cond:
+            if self.cond.wait_for(lambda: len(self) > 0, timeout):
+                return self._pop()
+        return None
+
+    # Whatever is queued right now, up to *limit* jobs, without waiting:
+    def take(self, limit):
+        jobs = []
+        with self.cond:
+            while len(jobs) < limit and len(self) > 0:
+                jobs.append(self._pop())
+        return jobs
+
+    def done(self, job, now=None):
+        now = (time.monotonic() if now is None else now)
+        stats = self.latency[job.priority]
+        stats.add(now - job.received)
+        if stats.count % REPORT_INTERVAL == 0:
+            self.log_latency(job.priority)
+
+    def drop(self, job, abandoned=False):
+        counts = (self.abandoned if abandoned else self.expired)
+        with self.cond:
+            counts[job.priority] += 1
+        log.warning('Dropped %s request from pid %d (%d expired, %d abandoned)',
+            PRIORITIES[job.priority], job.pid, self.expired[job.priority],
+            self.abandoned[job.priority]
+        )
+
+    def log_latency(self, priority):
+        (p50, p90, p99) = self.latency[priority].percentiles(50, 90, 99)
+        log.info('%s latency: p50=%.3fs p90=%.3fs p99=%.3fs '
+            '(%d rejected, %d expired, %d abandoned)',
+            PRIORITIES[priority], p50, p90, p99, self.rejected[priority],
+            self.expired[priority], self.abandoned[priority]
+        )
+
+    def stats(self):
+        result = {}
+        for (p, name) in enumerate(PRIORITIES):
+            (p50, p90, p99) = self.latency[p].percentiles(50, 90, 99)
+            result[name] = {
+                'queued': self.sizes[p],
+                'served': self.latency[p].count,
+                'rejected': self.rejected[p],
+                'expired': self.expired[p],
+                'abandoned': self.abandoned[p],
+                'p50': p50,
+                'p90': p90,
+                'p99': p99,
+            }
+        return result
@@ -15,22 +15,68 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 
+import json
 import logging
+import os
+import random
+import threading
 import time
+from collections import deque, namedtuple
+
+from nacl.signing import SigningKey
 
 from .common import (
     SERIAL_BAUDRATE,
+    SERIAL_BAUDRATES,
     SERIAL_TIMEOUT,
     SERIAL_RETRIES,
+    SERIAL_WINDOW,
+    SIGNATURE,
+    PREFIX,
     REQUEST,
-    RESPONSE,
     b32enc,
+    b32dec,
     log_request_attempt,
     log_request,
     log_response,
+    get_signature,
+    get_pubkey,
+    get_counter,
     get_message,
+    atomic_write,
+)
+from .sign import get_time
+from .verify import isvalid, get_verifications
+from .cache import RingCache
+from .schedule import LatencyStats, DeadlineExpired
+from .capture import TapSerial
+from .wire import (
+    FULL_REQUEST,
+    COMPACT_REQUEST,
+    RESPONSE_PREFIX,
+    NEED_FULL,
+    BAUDRATE,
+    PING,
+    STATUS,
+    BATCH_REQUEST,
+    BATCH_RESPONSE,
+    PING_NONCE,
+    MAX_BATCH,
+    MAX_FRAME,
+    SEQ_MASK,
+    FrameDecoder,
+    next_seq,
+    seq_distance,
+    pack_frame,
+    compact_request,
+    expand_request,
+    follows,
+    rebuild_response,
+    pack_batch,
+    unpack_batch,
+    pack_batch_response,
+    unpack_batch_response,
 )
-from .verify import isvalid, get_pubkey
 
 
 log = logging.getLogger(__name__)
@@ -45,79 +91,911 @@ def open_serial(port, SerialClass=None):
     )
 
 
-def read_serial(ttl, size):
-    assert type(size) is int and size > 0
-    msg = ttl.read(size)
-    if len(msg) == 0:
-        return None
-    if len(msg) != size:
-        log.warning('serial read: expected %d bytes; got %d', size, len(msg))
-        time.sleep(SERIAL_TIMEOUT)
-        ttl.reset_input_buffer()
-        return None
+RENEGOTIATE_INTERVAL = 60
+RTO_MIN = 0.2
+RTO_MAX = SERIAL_TIMEOUT
+REPORT_INTERVAL = 100
+POLL_INTERVAL = 0.5
+
+# Baudrate control frames are signed and the same size as a REQUEST, so the
+# signature doubles as an integrity check of the link at the proposed rate:
+BAUDRATE_MAGIC = b'PiHSM.baudrate\x00\x00'
+BAUDRATE_NONCE = REQUEST - 64 - 32 - len(BAUDRATE_MAGIC) - 4
+
+
+def build_baudrate_frame(key, rate, nonce=None):
+    nonce = (os.urandom(BAUDRATE_NONCE) if nonce is None else nonce)
+    assert len(nonce) == BAUDRATE_NONCE
+    frame = bytes(key.sign(b''.join([
+        bytes(key.verify_key),
+        BAUDRATE_MAGIC,
+        rate.to_bytes(4, 'little'),
+        nonce,
+    ])))
+    assert len(frame) == REQUEST
+    return frame
+
+
+def parse_baudrate_frame(frame):
+    if len(frame) == REQUEST and frame[96:112] == BAUDRATE_MAGIC:
+        return int.from_bytes(frame[112:116], 'little')
+    return None
+
+
+# A status frame is the same size as a REQUEST too.  It reports where the Pi's
+# chain is without adding to it, and is signed by the Pi's status key, which
+# the client pins:
+Status = namedtuple('Status', 'nonce public tail counter timestamp')
+
+
+# The status key is kept in *filename*, so clients that pinned it still accept
+# its status frames after a restart:
+def load_status_key(filename):
+    try:
+        with open(filename, 'rb', 0) as fp:
+            seed = fp.read(33)
+        if len(seed) != 32:
+            raise ValueError(
+                'status key: bad size {} in {!r}'.format(len(seed), filename)
+            )
+        key = SigningKey(seed)
+    except FileNotFoundError:
+        key = SigningKey.generate()
+        atomic_write(0o600, bytes(key), filename)
+    log.info('Status key: %s', b32enc(bytes(key.verify_key)))
+    return key
+
+
+def build_status_frame(key, nonce, response=None, timestamp=None):
+    assert len(nonce) == PING_NONCE
+    if response is None:
+        (public, tail, counter) = (bytes(32), bytes(SIGNATURE), 0)
+    else:
+        public = get_pubkey(response)
+        tail = get_signature(response)
+        counter = get_counter(response)
+    timestamp = (get_time() if timestamp is None else timestamp)
+    frame = bytes(key.sign(b''.join([
+        bytes(key.verify_key),
+        nonce,
+        public,
+        tail,
+        counter.to_bytes(8, 'little'),
+        timestamp.to_bytes(8, 'little'),
+    ])))
+    assert len(frame) == REQUEST
+    return frame
+
+
+def parse_status_frame(frame):
+    assert len(frame) == REQUEST
+    return Status(
+        frame[96:112],
+        frame[112:144],
+        frame[144:208],
+        int.from_bytes(frame[208:216], 'little'),
+        int.from_bytes(frame[216:224], 'little'),
+    )
+
+
+def new_counters():
+    return {
+        'short_reads': 0,
+        'resyncs': 0,
+        'bad_frames': 0,
+        'bad_signatures': 0,
+        'io_errors': 0,
+        'fallbacks': 0,
+    }
+
+
+# Reads only as many bytes as the decoder needs, so we never block waiting
+# for bytes that belong to the next frame.  A frame cut short by the timeout is
+# dropped; anything else bad is skipped by the decoder as soon as it can find
+# the next preamble:
+def read_frame(ttl, decoder, buf=None, counters=None):
+    if buf is None:
+        buf = bytearray(MAX_FRAME)
+    assert len(buf) >= MAX_FRAME
+    (bad_frames, discarded) = (decoder.bad_frames, decoder.discarded)
+    try:
+        while True:
+            frame = decoder.next()
+            if frame is not None:
+                return frame
+            size = decoder.needed()
+            received = ttl.readinto(memoryview(buf)[:size])
+            if received == 0:
+                break
+            decoder.feed(buf[:received])
+    finally:
+        if counters is not None:
+            counters['bad_frames'] += decoder.bad_frames - bad_frames
+            if decoder.discarded > discarded:
+                counters['resyncs'] += 1
+    if len(decoder) > 0:
+        log.warning('serial read: %d bytes of partial frame', len(decoder))
+        decoder.reset()
+        if counters is not None:
+            counters['short_reads'] += 1
+    return None
+
+
+def check_signature(msg, counters=None):
     if isvalid(msg):
         return msg
     log.warning('bad signature from pubkey %s', b32enc(get_pubkey(msg)))
+    if counters is not None:
+        counters['bad_signatures'] += 1
     return None
 
 
+# Smoothed round trip time and variance, as TCP keeps them (RFC 6298).  The
+# retransmission timeout is never longer than the old fixed SERIAL_TIMEOUT:
+class RttEstimator:
+    __slots__ = ('srtt', 'rttvar', 'rto', 'samples', 'timeouts')
+
+    def __init__(self):
+        self.srtt = None
+        self.rttvar = None
+        self.rto = RTO_MAX
+        self.samples = 0
+        self.timeouts = 0
+
+    def add(self, sample):
+        assert sample >= 0
+        if self.srtt is None:
+            self.srtt = sample
+            self.rttvar = sample / 2
+        else:
+            self.rttvar = 0.75 * self.rttvar + 0.25 * abs(self.srtt - sample)
+            self.srtt = 0.875 * self.srtt + 0.125 * sample
+        self.rto = min(max(self.srtt + 4 * self.rttvar, RTO_MIN), RTO_MAX)
+        self.samples += 1
+
+    def backoff(self):
+        self.timeouts += 1
+        self.rto = min(self.rto * 2, RTO_MAX)
+
+    def stats(self):
+        return {
+            'srtt': self.srtt,
+            'rttvar': self.rttvar,
+            'rto': self.rto,
+            'samples': self.samples,
+            'timeouts': self.timeouts,
+        }
+
+
 class BaseSerial:
-    __slots__ = ('port', 'SerialClass')
+    __slots__ = ('port', 'SerialClass', 'ttl', 'buf', 'decoder', 'counters',
+        'capture',
+    )
 
-    def __init__(self, port, SerialClass=None):
+    def __init__(self, port, SerialClass=None, capture=None):
         self.port = port
         self.SerialClass = SerialClass
+        self.capture = capture
+        self.ttl = None
+        self.buf = bytearray(MAX_FRAME)
+        self.decoder = FrameDecoder()
+        self.counters = new_counters()
+
+    @property
+    def errors(self):
+        return sum(self.counters.values()) - self.counters['fallbacks']
+
+    def read_frame(self):
+        return read_frame(self.get_serial(), self.decoder, self.buf,
+            self.counters
+        )
+
+    def write_frame(self, ftype, seq, payload):
+        ttl = self.get_serial()
+        ttl.write(pack_frame(ftype, seq, payload))
+        ttl.flush()
+
+    def check_signature(self, msg):
+        return check_signature(msg, self.counters)
+
+    def set_timeout(self, timeout):
+        ttl = self.get_serial()
+        if ttl.timeout != timeout:
+            ttl.timeout = timeout
+
+    def set_baudrate(self, rate):
+        ttl = self.get_serial()
+        if ttl.baudrate != rate:
+            ttl.baudrate = rate
+            self.decoder.reset()
+            log.info('Serial port %r now at %d baud', self.port, rate)
+
+    def fall_back(self):
+        self.counters['fallbacks'] += 1
+        log.warning('Falling back to %d baud; errors: %r',
+            SERIAL_BAUDRATE, self.counters
+        )
+        self.set_baudrate(SERIAL_BAUDRATE)
 
     def open_serial(self):
-        return open_serial(self.port, self.SerialClass)
+        ttl = open_serial(self.port, self.SerialClass)
+        if self.capture is not None:
+            ttl = TapSerial(ttl, self.capture)
+        return ttl
+
+    # The port is opened once and kept open; it's only reopened after an error:
+    def get_serial(self):
+        if self.ttl is None:
+            self.ttl = self.open_serial()
+            log.info('Opened serial port %r', self.port)
+        return self.ttl
+
+    def close_serial(self):
+        if self.ttl is not None:
+            ttl = self.ttl
+            self.ttl = None
+            self.decoder.reset()
+            try:
+                ttl.close()
+            except OSError:
+                log.exception('Error closing serial port %r:', self.port)
 
 
 class SerialServer(BaseSerial):
-    __slots__ = ('private_client', 'exit')
+    __slots__ = ('private_client', 'pending', 'known', 'expected', 'held',
+        'sent', 'key', 'tail',
+    )
 
-    def __init__(self, private_client, port, SerialClass=None):
-        super().__init__(port, SerialClass)
+    def __init__(self, private_client, port, SerialClass=None, capture=None,
+            status_key=None):
+        super().__init__(port, SerialClass, capture)
         self.private_client = private_client
+        self.pending = None
+        # The last requests we signed; a compact request is expanded against
+        # these (two, so a retransmitted request still has its predecessor):
+        self.known = deque(maxlen=2)
+        # Requests are signed strictly in sequence order; frames that arrive
+        # after a lost one are held until the client retransmits it:
+        self.expected = None
+        self.held = {}
+        # (frame type, payload) of the responses we sent, by the signature of
+        # the (first) request they answer:
+        self.sent = RingCache(SERIAL_WINDOW * 2)
+        # Signs status frames (see load_status_key()); the last response we
+        # relayed is what they report:
+        self.key = (SigningKey.generate() if status_key is None else
+            status_key
+        )
+        self.tail = None
 
     def serve_forever(self):
         try:
             while True:
-                ttl = self.open_serial()
-                request = read_serial(ttl, REQUEST)
-                if request is not None:
-                    response = self.handle_request(request)
-                    ttl.write(response)
-                    ttl.flush()
+                self.serve_once()
         except:
             log.exception('Error in SerialServer:')
             raise
 
+    def serve_once(self):
+        try:
+            errors = self.errors
+            frame = self.read_frame()
+            if frame is not None:
+                self.handle_frame(*frame)
+            if frame is None or self.errors > errors:
+                self.check_baudrate(self.errors > errors)
+        except OSError:
+            log.exception('Error on serial port %r:', self.port)
+            self.counters['io_errors'] += 1
+            self.close_serial()
+            time.sleep(SERIAL_TIMEOUT)
+
+    def handle_frame(self, ftype, seq, payload):
+        if not self.admit_frame(ftype, seq, payload):
+            return
+        while self.handle_request_frame(ftype, seq, payload):
+            seq = self.expected = next_seq(seq)
+            if seq not in self.held:
+                break
+            (ftype, payload) = self.held.pop(seq)
+
+    # Answers anything that doesn't need signing, and holds request frames
+    # that arrive ahead of the one we expect.  Returns True when the frame is
+    # the request to sign next:
+    def admit_frame(self, ftype, seq, payload):
+        if ftype == BAUDRATE:
+            rate = parse_baudrate_frame(payload)
+            if rate is None:
+                self.counters['bad_frames'] += 1
+            elif self.check_signature(payload) is not None:
+                self.handle_baudrate(seq, payload, rate)
+            return False
+        if ftype == PING:
+            self.write_frame(STATUS, seq,
+                build_status_frame(self.key, payload, self.tail)
+            )
+            return False
+        if ftype not in (FULL_REQUEST, COMPACT_REQUEST, BATCH_REQUEST):
+            log.warning('Unexpected frame type %d', ftype)
+            self.counters['bad_frames'] += 1
+            return False
+        sent = self.sent.get(payload[:SIGNATURE])
+        if sent is not None:
+            log.info('Resending response to frame %d', seq)
+            self.write_frame(sent[0], seq, sent[1])
+            return False
+        if self.expected is not None and seq != self.expected:
+            if 0 < seq_distance(self.expected, seq) < SERIAL_WINDOW:
+                self.held[seq] = (ftype, payload)
+                return False
+            log.warning('Resynchronizing at frame %d (expected %d)',
+                seq, self.expected
+            )
+            self.held.clear()
+        self.expected = seq
+        return True
+
+    def handle_request_frame(self, ftype, seq, payload):
+        requests = self.prepare_request_frame(ftype, seq, payload)
+        if requests is None:
+            return False
+        self.pending = None
+        if ftype == BATCH_REQUEST:
+            responses = self.handle_requests(requests)
+        else:
+            responses = [self.handle_request(requests[0])]
+        self.finish_request_frame(ftype, seq, requests, responses)
+        return True
+
+    # The verified requests in a frame, or None.  A batch is signed as a whole
+    # or not at all:
+    def prepare_request_frame(self, ftype, seq, payload):
+        if ftype == BATCH_REQUEST:
+            requests = unpack_batch(payload)
+            for request in requests:
+                if self.check_signature(request) is None:
+                    return None
+            return requests
+        if ftype == COMPACT_REQUEST:
+            request = self.expand(payload)
+            if request is None:
+                log.info('Unknown compact request, asking for the full one')
+                self.write_frame(NEED_FULL, seq, payload[:SIGNATURE])
+                return None
+            return [request]
+        request = self.check_signature(payload)
+        if request is None:
+            return None
+        return [request]
+
+    def finish_request_frame(self, ftype, seq, requests, responses):
+        self.known.extend(requests[-2:])
+        self.tail = responses[-1]
+        if ftype == BATCH_REQUEST:
+            (rtype, payload) = (BATCH_RESPONSE, pack_batch_response(responses))
+        else:
+            (rtype, payload) = (RESPONSE_PREFIX, responses[0][:PREFIX])
+        self.sent.put(get_signature(requests[0]), (rtype, payload))
+        self.write_frame(rtype, seq, payload)
+
+    def expand(self, compact):
+        for previous in reversed(self.known):
+            request = expand_request(previous, compact)
+            if isvalid(request):
+                return request
+        return None
+
+    # After switching rates we need a valid frame within SERIAL_TIMEOUT or we
+    # go back to the previous rate; any other bad read above the default rate
+    # means the link isn't reliable there:
+    def check_baudrate(self, error):
+        if self.pending is not None:
+            (rate, self.pending) = (self.pending, None)
+            self.counters['fallbacks'] += 1
+            log.warning('No confirmation, back to %d baud', rate)
+            self.set_baudrate(rate)
+        elif error and self.get_serial().baudrate != SERIAL_BAUDRATE:
+            self.fall_back()
+
+    def handle_baudrate(self, seq, frame, rate):
+        ttl = self.get_serial()
+        if rate not in SERIAL_BAUDRATES:
+            log.warning('Ignoring unsupported baudrate %d', rate)
+            return
+        # Always echo at the current rate, only then switch:
+        self.write_frame(BAUDRATE, seq, frame)
+        if rate == ttl.baudrate:
+            log.info('Confirmed %d baud', rate)
+            self.pending = None
+        else:
+            self.pending = ttl.baudrate
+            self.set_baudrate(rate)
+
     def handle_request(self, request):
         log_request(request)
         response = self.private_client.make_request(request)
         log_response(response)
         return response
 
+    def handle_requests(self, requests):
+        for request in requests:
+            log_request(request)
+        responses = self.private_client.make_requests(requests)
+        for response in responses:
+            log_response(response)
+        return responses
+
+
+# The base of aio.AsyncSerialServer.  Reads never block: whatever has arrived
+# is fed to the decoder and complete frames are queued, so a slow or noisy port
+# can't hold up the others:
+class PolledSerialServer(SerialServer):
+    __slots__ = ('frames', 'latency', 'last_read')
+
+    def __init__(self, private_client, port, SerialClass=None, capture=None,
+            status_key=None):
+        super().__init__(private_client, port, SerialClass, capture,
+            status_key
+        )
+        self.frames = deque()
+        self.latency = LatencyStats()
+        self.last_read = time.monotonic()
+
+    def open_serial(self):
+        ttl = super().open_serial()
+        ttl.timeout = 0
+        return ttl
+
+    def poll(self, now=None):
+        now = (time.monotonic() if now is None else now)
+        ttl = self.get_serial()
+        (bad_frames, discarded) = (self.decoder.bad_frames,
+            self.decoder.discarded
+        )
+        errors = self.errors
+        while True:
+            received = ttl.readinto(self.buf)
+            if received == 0:
+                break
+            self.decoder.feed(self.buf[:received])
+            self.last_read = now
+        while True:
+            frame = self.decoder.next()
+            if frame is None:
+                break
+            self.frames.append((now, frame))
+        self.counters['bad_frames'] += self.decoder.bad_frames - bad_frames
+        if self.decoder.discarded > discarded:
+            self.counters['resyncs'] += 1
+        # Nothing for SERIAL_TIMEOUT counts as a timed out read:
+        timeout = (now - self.last_read >= SERIAL_TIMEOUT)
+        if timeout:
+            self.last_read = now
+            if len(self.decoder) > 0:
+                log.warning('serial read: %d bytes of partial frame',
+                    len(self.decoder)
+                )
+                self.decoder.reset()
+                self.counters['short_reads'] += 1
+        if timeout or self.errors > errors:
+            self.check_baudrate(self.errors > errors)
+        return len(self.frames)
+
+    def add_latency(self, received, now):
+        self.latency.add(now - received)
+        if self.latency.count % REPORT_INTERVAL == 0:
+            (p50, p99) = self.latency.percentiles(50, 99)
+            log.info('Serial port %r latency: p50=%.3fs p99=%.3fs',
+                self.port, p50, p99
+            )
+
+    def stats(self):
+        (p50, p90, p99) = self.latency.percentiles(50, 90, 99)
+        stats = {
+            'served': self.latency.count,
+            'queued': len(self.frames),
+            'p50': p50,
+            'p90': p90,
+            'p99': p99,
+            'verifications': get_verifications(),
+        }
+        stats.update(self.counters)
+        return stats
+
 
 class SerialClient(BaseSerial):
-    __slots__ = tuple()
+    __slots__ = (
+        'key', 'best', 'max_baudrate', 'filename', 'renegotiate_at', 'acked',
+        'seq', 'rtt', 'metrics_file', 'completed', 'lock', 'status',
+        'expired', 'status_key', 'status_file',
+    )
+
+    def __init__(self, port, SerialClass=None,
+            max_baudrate=SERIAL_BAUDRATES[-1], filename=None,
+            metrics_file=None, capture=None, status_file=None):
+        super().__init__(port, SerialClass, capture)
+        self.rtt = RttEstimator()
+        self.metrics_file = metrics_file
+        self.completed = 0
+        # Requests and pings can come from different threads:
+        self.lock = threading.Lock()
+        self.status = None
+        # The server's status key, pinned the first time it answers a ping:
+        self.status_key = None
+        self.status_file = status_file
+        # Requests given up on unsigned because their deadline passed:
+        self.expired = 0
+        self.key = SigningKey.generate()
+        self.best = SERIAL_BAUDRATE
+        self.max_baudrate = max_baudrate
+        self.filename = filename
+        # None, or when to negotiate on the next request or ping:
+        self.renegotiate_at = None
+        # The last request the server signed, which it can expand the next
+        # compact request against:
+        self.acked = None
+        # Start somewhere random so a restarted client doesn't land inside the
+        # server's window:
+        self.seq = random.randint(0, SEQ_MASK)
+
+    def echo(self, frame):
+        self.write_frame(BAUDRATE, 0, frame)
+        return self.read_frame() == (BAUDRATE, 0, frame)
+
+    def confirm_baudrate(self, rate):
+        self.set_baudrate(rate)
+        return self.echo(build_baudrate_frame(self.key, rate))
+
+    def try_baudrate(self, rate):
+        current = self.get_serial().baudrate
+        if not self.echo(build_baudrate_frame(self.key, rate)):
+            log.warning('Server did not accept %d baud', rate)
+            return False
+        if self.confirm_baudrate(rate):
+            return True
+        log.warning('Signed test frame failed at %d baud', rate)
+        self.set_baudrate(current)
+        return False
+
+    # Get both ends back to SERIAL_BAUDRATE; the server falls back on its own
+    # after a bad read or a missing confirmation:
+    def fall_back(self):
+        super().fall_back()
+        self.renegotiate_at = time.monotonic() + RENEGOTIATE_INTERVAL
+        for i in range(SERIAL_RETRIES):
+            if self.confirm_baudrate(SERIAL_BAUDRATE):
+                return True
+        return False
+
+    def negotiate(self):
+        self.renegotiate_at = None
+        current = self.get_serial().baudrate
+        if self.best > current and self.try_baudrate(self.best):
+            current = self.best
+        elif not self.confirm_baudrate(current):
+            self.fall_back()
+            current = SERIAL_BAUDRATE
+        for rate in SERIAL_BAUDRATES:
+            if current < rate <= self.max_baudrate:
+                if not self.try_baudrate(rate):
+                    break
+                current = rate
+        log.info('Negotiated %d baud on %r', current, self.port)
+        if current != self.best:
+            self.best = current
+            self.save_baudrate()
+        return current
+
+    # An OSError leaves negotiation due, so it's tried again on the next
+    # request or health check once the port is back:
+    def negotiate_if_due(self):
+        if self.renegotiate_at is None:
+            return
+        if time.monotonic() < self.renegotiate_at:
+            return
+        try:
+            self.negotiate()
+        except OSError:
+            self.renegotiate_at = 0
+            self.close_serial()
+            raise
+
+    def load_baudrate(self):
+        if self.filename is not None:
+            try:
+                with open(self.filename, 'rb', 0) as fp:
+                    rate = int(fp.read(16))
+                if SERIAL_BAUDRATE <= rate <= self.max_baudrate:
+                    self.best = rate
+            except (FileNotFoundError, ValueError):
+                pass
+        return self.best
+
+    def save_baudrate(self):
+        if self.filename is not None:
+            atomic_write(0o644, str(self.best).encode(), self.filename)
+
+    def load_status_key(self):
+        if self.status_file is not None:
+            try:
+                with open(self.status_file, 'rb', 0) as fp:
+                    public = b32dec(fp.read(64).decode().strip())
+                if len(public) == 32:
+                    self.status_key = public
+            except (FileNotFoundError, ValueError):
+                pass
+        return self.status_key
+
+    # Trust on first use: the first status key we see is pinned (and saved to
+    # *status_file*), and status frames signed by any other key are ignored
+    # until that file is removed:
+    def check_status_key(self, public):
+        if self.status_key is None:
+            self.status_key = public
+            log.info('Pinned status key %s for %r', b32enc(public), self.port)
+            if self.status_file is not None:
+                atomic_write(0o644, b32enc(public).encode(), self.status_file)
+        elif public != self.status_key:
+            log.warning('status frame from unknown key %s on %r',
+                b32enc(public), self.port
+            )
+            self.counters['bad_signatures'] += 1
+            return False
+        return True
 
     def make_request(self, request):
-        ttl = self.open_serial()
+        return self.make_requests([request])[0]
+
+    def make_requests(self, requests, deadline=None, batch=False):
+        with self.lock:
+            if batch:
+                return self._make_batches(requests, deadline)
+            return self._make_requests(requests, deadline)
+
+    # For bulk work: MAX_BATCH requests to a frame and one frame in flight,
+    # trading latency for fewer frames and far fewer round trips to the
+    # PrivateServer.  The requests must follow each other:
+    def _make_batches(self, requests, deadline=None):
+        self.negotiate_if_due()
+        responses = []
+        for i in range(0, len(requests), MAX_BATCH):
+            responses.extend(self.make_batch(requests[i:i + MAX_BATCH],
+                deadline, len(requests) - i
+            ))
+        self.acked = requests[-1]
+        self.report(len(requests))
+        return responses
+
+    def make_batch(self, batch, deadline=None, unsigned=None):
+        payload = pack_batch(batch)
+        (seq, self.seq) = (self.seq, next_seq(self.seq))
         for i in range(SERIAL_RETRIES):
-            log_request_attempt(request, i, SERIAL_RETRIES)
-            ttl.write(request)
-            ttl.flush()
-            response = read_serial(ttl, RESPONSE)
-            if response is not None:
-                log_response(response)
-                assert get_message(response) == request
-                return response
-            else:
-                cruft = ttl.read(RESPONSE * 2)
-                if len(cruft) > 0:
-                    log.warning('%d extra bytes read from serial', len(cruft))
+            if deadline is not None and time.monotonic() >= deadline:
+                self.give_up(len(batch) if unsigned is None else unsigned)
+            try:
+                if i > 0 and self.get_serial().baudrate != SERIAL_BAUDRATE:
+                    self.fall_back()
+                log_request_attempt(batch[0], i, SERIAL_RETRIES)
+                start = time.monotonic()
+                self.write_frame(BATCH_REQUEST, seq, payload)
+                # The Pi signs the whole batch before it answers:
+                timeout = self.rtt.rto * len(batch)
+                if deadline is not None:
+                    timeout = max(min(timeout, deadline - start), RTO_MIN / 10)
+                self.set_timeout(timeout)
+                responses = self.read_batch(seq, batch)
+                if responses is not None:
+                    if i == 0:
+                        self.rtt.add((time.monotonic() - start) / len(batch))
+                    return responses
+            except OSError:
+                log.exception('Error on serial port %r:', self.port)
+                self.counters['io_errors'] += 1
+                self.close_serial()
+            self.rtt.backoff()
+        # Skip ahead so the server drops whatever it's holding:
+        self.seq = (self.seq + SERIAL_WINDOW) & SEQ_MASK
         raise Exception(
             'serial request failed {!r} tries'.format(SERIAL_RETRIES)
         )
 
+    def read_batch(self, seq, batch):
+        while True:
+            frame = self.read_frame()
+            if frame is None:
+                return None
+            if frame[:2] != (BATCH_RESPONSE, seq):
+                log.info('Ignoring frame %d (type %d)', frame[1], frame[0])
+                continue
+            responses = unpack_batch_response(frame[2], batch)
+            if responses is None:
+                self.counters['bad_frames'] += 1
+                continue
+            if all(self.check_signature(r) is not None for r in responses):
+                for response in responses:
+                    log_response(response)
+                return responses
+
+    # Keeps up to SERIAL_WINDOW requests in flight.  When a read times out
+    # the oldest request still outstanding is retransmitted (see retransmit()),
+    # and the server answers a retransmit of a request it already signed from
+    # its cache.
+    # Nothing more is sent once *deadline* (on the time.monotonic() clock) has
+    # passed:
+    def _make_requests(self, requests, deadline=None):
+        self.negotiate_if_due()
+        responses = [None] * len(requests)
+        tries = [0] * len(requests)
+        window = {}
+        # When each frame was first sent; retransmitted frames are dropped, as
+        # we can't tell which copy a response is for (Karn's algorithm):
+        sent_at = {}
+        last = None
+        previous = self.acked
+        sent = 0
+        resend = False
+        while sent < len(requests) or window:
+            if deadline is not None and time.monotonic() >= deadline:
+                self.give_up(len(requests) - sent + len(window))
+            try:
+                if resend:
+                    resend = False
+                    for seq in self.retransmit(requests, window, tries):
+                        sent_at.pop(seq, None)
+                while sent < len(requests) and len(window) < SERIAL_WINDOW:
+                    (seq, self.seq) = (self.seq, next_seq(self.seq))
+                    window[seq] = sent
+                    request = requests[sent]
+                    sent += 1
+                    log_request_attempt(request, 0, SERIAL_RETRIES)
+                    self.send_request(seq, request, previous)
+                    sent_at[seq] = time.monotonic()
+                    previous = request
+                timeout = self.rtt.rto
+                if deadline is not None:
+                    timeout = max(min(timeout, deadline - time.monotonic()),
+                        RTO_MIN / 10
+                    )
+                self.set_timeout(timeout)
+                frame = self.read_frame()
+                if frame is not None:
+                    seq = frame[1]
+                    if self.handle_frame(*frame, requests, window, responses):
+                        now = time.monotonic()
+                        # Requests are served in order, so a pipelined request
+                        # only starts its round trip once the one ahead is done:
+                        if seq in sent_at:
+                            start = sent_at.pop(seq)
+                            if last is not None:
+                                start = max(start, last)
+                            self.rtt.add(now - start)
+                        last = now
+                    else:
+                        sent_at.pop(seq, None)
+                    continue
+            except OSError:
+                log.exception('Error on serial port %r:', self.port)
+                self.counters['io_errors'] += 1
+                self.close_serial()
+            self.rtt.backoff()
+            resend = True
+        self.acked = requests[-1]
+        self.report(len(requests))
+        return responses
+
+    # Costs one small round trip and no chain node.  Returns the Status, or
+    # None if the server didn't answer:
+    def ping(self):
+        nonce = os.urandom(PING_NONCE)
+        with self.lock:
+            for i in range(SERIAL_RETRIES):
+                try:
+                    self.negotiate_if_due()
+                    self.write_frame(PING, 0, nonce)
+                    self.set_timeout(self.rtt.rto)
+                    status = self.read_status(nonce)
+                    if status is not None:
+                        self.status = status
+                        return status
+                except OSError:
+                    log.exception('Error on serial port %r:', self.port)
+                    self.counters['io_errors'] += 1
+                    self.close_serial()
+                self.rtt.backoff()
+        log.warning('No status from %r after %d pings',
+            self.port, SERIAL_RETRIES
+        )
+        return None
+
+    def read_status(self, nonce):
+        while True:
+            frame = self.read_frame()
+            if frame is None:
+                return None
+            (ftype, seq, payload) = frame
+            if ftype == STATUS and self.check_signature(payload) is not None:
+                status = parse_status_frame(payload)
+                if status.nonce == nonce and \
+                        self.check_status_key(get_pubkey(payload)):
+                    return status
+
+    def handle_frame(self, ftype, seq, payload, requests, window, responses):
+        if seq not in window:
+            log.info('Ignoring frame %d (type %d)', seq, ftype)
+            return False
+        index = window[seq]
+        request = requests[index]
+        if ftype == NEED_FULL and payload == get_signature(request):
+            log.info('Server needs the full request for frame %d', seq)
+            self.write_frame(FULL_REQUEST, seq, request)
+        elif ftype == RESPONSE_PREFIX:
+            response = rebuild_response(payload, request)
+            if self.check_signature(response) is not None:
+                log_response(response)
+                assert get_message(response) == request
+                responses[index] = response
+                del window[seq]
+                return True
+        else:
+            log.warning('Unexpected frame type %d', ftype)
+            self.counters['bad_frames'] += 1
+        return False
+
+    def stats(self):
+        stats = self.rtt.stats()
+        stats.update(self.counters)
+        stats['expired'] = self.expired
+        stats['verifications'] = get_verifications()
+        stats['baudrate'] = (None if self.ttl is None else self.ttl.baudrate)
+        return stats
+
+    def report(self, count):
+        before = self.completed // REPORT_INTERVAL
+        self.completed += count
+        if self.completed // REPORT_INTERVAL == before:
+            return
+        stats = self.stats()
+        if stats['srtt'] is not None:
+            log.info('Serial link: srtt=%.3fs rttvar=%.3fs rto=%.3fs '
+                '(%d timeouts)', stats['srtt'], stats['rttvar'], stats['rto'],
+                stats['timeouts']
+            )
+        if self.metrics_file is not None:
+            content = json.dumps(stats, sort_keys=True, indent=4).encode()
+            atomic_write(0o644, content, self.metrics_file)
+
+    def give_up(self, unsigned):
+        self.expired += unsigned
+        # Skip ahead so the server drops whatever it's holding:
+        self.seq = (self.seq + SERIAL_WINDOW) & SEQ_MASK
+        raise DeadlineExpired(unsigned)
+
+    # The server holds the frames after a lost one until it's filled in, then
+    # answers them all, so normally only the oldest unanswered request is sent
+    # again (and only it uses up a try).  After falling back to
+    # SERIAL_BAUDRATE, everything in flight was garbled and goes again.
+    # Returns the seqs resent:
+    def retransmit(self, requests, window, tries):
+        items = sorted(window.items(), key=lambda item: item[1])
+        if self.get_serial().baudrate != SERIAL_BAUDRATE:
+            self.fall_back()
+        else:
+            items = items[:1]
+        for (seq, index) in items:
+            tries[index] += 1
+            if tries[index] >= SERIAL_RETRIES:
+                # Skip ahead so the server drops whatever it's holding:
+                self.seq = (self.seq + SERIAL_WINDOW) & SEQ_MASK
+                raise Exception(
+                    'serial request failed {!r} tries'.format(SERIAL_RETRIES)
+                )
+            request = requests[index]
+            log_request_attempt(request, tries[index], SERIAL_RETRIES)
+            self.write_frame(FULL_REQUEST, seq, request)
+        return [seq for (seq, index) in items]
+
+    def send_request(self, seq, request, previous):
+        if follows(previous, request):
+            self.write_frame(COMPACT_REQUEST, seq, compact_request(request))
+        else:
+            self.write_frame(FULL_REQUEST, seq, request)
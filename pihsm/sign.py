@@ -23,14 +23,32 @@ Generic signed message format:
 Generic chained signed message format:
 
     signature + pubkey [+ previous + counter + timestamp] + message
+
+A key rotation ends the old chain with a handover node, signed by the old key,
+whose message is the genesis of the new chain:
+
+    signature + old pubkey + previous + counter + timestamp + new genesis
 """
 
 import logging
+import os
+import select
+import threading
 import time
 
 from nacl.signing import SigningKey
 
-from .common import get_signature, get_message, log_genesis
+from .common import (
+    GENESIS,
+    atomic_write,
+    b32enc,
+    get_signature,
+    get_pubkey,
+    get_counter,
+    get_message,
+    log_genesis,
+)
+from .verify import verify_genesis, verify_message
 
 
 log = logging.getLogger(__name__)
@@ -45,23 +63,43 @@ def get_entropy_avail(filename='/proc/sys/kernel/random/entropy_avail'):
         return int(fp.read(20))
 
 
-def wait_for_entropy_avail(target=3000, filename='/proc/sys/kernel/random/entropy_avail'):
-    assert isinstance(target, int) and target >= 1000
-    delay = 5
-    for i in range(100):
-        avail = get_entropy_avail(filename)
-        if avail >= target:
-            log.info(
-                '%d bits of entropy available >= %d requested', avail, target
-            )
-            return avail
-        else:
-            log.info(
-                '%d/%d bits of entropy available after %d checks, %d seconds',
-                avail, target, i, i * delay
-            )
-            time.sleep(delay)
-    raise Exception("Not enough entropy available!")
+def get_uptime(filename='/proc/uptime'):
+    with open(filename, 'rb', 0) as fp:
+        return float(fp.read(64).split()[0])
+
+
+def _poll_random(filename='/dev/random'):
+    fd = os.open(filename, os.O_RDONLY)
+    try:
+        poller = select.poll()
+        poller.register(fd, select.POLLIN)
+        poller.poll()
+    finally:
+        os.close(fd)
+
+
+# Blocks until the kernel's random pool is initialized, which is all the key
+# needs.  getrandom() waits exactly that long, and /dev/random becomes readable
+# at the same point where os.getrandom() isn't available (Python 3.5).
+# entropy_avail is capped at 256 bits since Linux 5.18, so it can't be polled
+# for more.  Returns the seconds waited:
+def wait_for_entropy(getrandom=None, poll_random=_poll_random,
+        clock=time.monotonic):
+    if getrandom is None:
+        getrandom = getattr(os, 'getrandom', None)
+    start = clock()
+    if getrandom is not None:
+        getrandom(1)
+    else:
+        poll_random()
+    waited = clock() - start
+    try:
+        log.info('Random pool ready after waiting %.3fs, %.1fs after boot',
+            waited, get_uptime()
+        )
+    except OSError:
+        log.info('Random pool ready after waiting %.3fs', waited)
+    return waited
 
 
 def build_signing_form(public, previous, counter, timestamp, message):
@@ -83,18 +121,117 @@ class DummyStore:
     def write(self, signed):
         pass      
 
+    def write_many(self, signed):
+        pass
 
+
+# The key's seed, the genesis and the tail, so a Signer can carry on its chain
+# after a restart:
+def pack_state(key, genesis, tail):
+    return b''.join([bytes(key), genesis, tail])
+
+
+def unpack_state(data):
+    seed = data[:32]
+    genesis = data[32:32 + GENESIS]
+    tail = data[32 + GENESIS:]
+    if len(seed) != 32 or len(genesis) != GENESIS or len(tail) < GENESIS:
+        raise ValueError('signer state: bad size {}'.format(len(data)))
+    key = SigningKey(seed)
+    public = bytes(key.verify_key)
+    verify_genesis(get_signature(genesis), get_pubkey(genesis))
+    verify_message(tail)
+    for signed in (genesis, tail):
+        if get_pubkey(signed) != public:
+            raise ValueError(
+                'signer state: {} not signed by {}'.format(
+                    b32enc(get_signature(signed)), b32enc(public)
+                )
+            )
+    return (key, genesis, tail)
+
+
+# With a *state_file*, the key and tail are saved there after every signing,
+# and a Signer started with the same file resumes the chain instead of
+# starting a new one:
 class Signer:
-    __slots__ = ('key', 'public', 'genesis', 'tail', 'counter', 'store')
+    __slots__ = ('key', 'public', 'genesis', 'tail', 'counter', 'store',
+        'next_key', 'state_file',
+    )
 
-    def __init__(self, store=None):
-        self.key = SigningKey.generate()
+    def __init__(self, store=None, state_file=None):
+        self.store = (DummyStore() if store is None else store)
+        self.next_key = None
+        self.state_file = state_file
+        if self.resume():
+            return
+        self.start_chain(SigningKey.generate())
+        self.store.write(self.genesis)
+        self.save()
+
+    def resume(self):
+        if self.state_file is None:
+            return False
+        try:
+            with open(self.state_file, 'rb', 0) as fp:
+                data = fp.read()
+        except FileNotFoundError:
+            return False
+        (self.key, self.genesis, self.tail) = unpack_state(data)
         self.public = bytes(self.key.verify_key)
-        self.genesis = self.tail = bytes(self.key.sign(self.public))
+        self.counter = (0 if self.tail == self.genesis else
+            get_counter(self.tail)
+        )
+        log.info('Resumed chain %s at counter %d',
+            b32enc(self.public), self.counter
+        )
+        return True
+
+    # Only after the store has the tail, so a resumed chain never points at a
+    # node that was lost:
+    def save(self):
+        if self.state_file is not None:
+            atomic_write(0o600, pack_state(self.key, self.genesis, self.tail),
+                self.state_file
+            )
+
+    def start_chain(self, key):
+        self.key = key
+        self.public = bytes(key.verify_key)
+        self.genesis = self.tail = bytes(key.sign(self.public))
         log_genesis(self.genesis)
         self.counter = 0
-        self.store = (DummyStore() if store is None else store)
-        self.store.write(self.genesis)
+
+    def prepare_next_key(self):
+        if self.next_key is None:
+            self.next_key = SigningKey.generate()
+            log.info('Next key ready')
+
+    # Generates the key for the next rotate() in a background thread, so the
+    # rotation itself doesn't have to:
+    def start_next_key(self):
+        thread = threading.Thread(target=self.prepare_next_key, daemon=True)
+        thread.start()
+        return thread
+
+    # Ends this chain with a handover node linking it to the genesis of a new
+    # one, and carries on signing on the new one.  Both are stored together
+    # with B32Store.write_many().  Returns the handover node:
+    def rotate(self, timestamp=None):
+        timestamp = (get_time() if timestamp is None else timestamp)
+        (key, self.next_key) = (self.next_key, None)
+        if key is None:
+            key = SigningKey.generate()
+        public = bytes(key.verify_key)
+        handover = self._sign(bytes(key.sign(public)), timestamp)
+        old = self.public
+        self.start_chain(key)
+        self.store.write_many([handover, self.genesis])
+        self.save()
+        log.info('Rotated key %s to %s at counter %d',
+            b32enc(old), b32enc(public), get_counter(handover)
+        )
+        return handover
 
     @property
     def previous(self):
@@ -109,11 +246,25 @@ class Signer:
             self.public, self.previous, self.counter, timestamp, message
         )
 
-    def sign(self, message, timestamp=None):
-        timestamp = (get_time() if timestamp is None else timestamp)
+    def _sign(self, message, timestamp):
         self.counter += 1
         signing_form = self.build_signing_form(timestamp, message)
         self.tail = bytes(self.key.sign(signing_form))
+        return self.tail
+
+    def sign(self, message, timestamp=None):
+        timestamp = (get_time() if timestamp is None else timestamp)
+        self._sign(message, timestamp)
         self.store.write(self.tail)
+        self.save()
         return self.tail
 
+    # Consecutive chain nodes, one per message, stored together with
+    # B32Store.write_many():
+    def sign_many(self, messages, timestamp=None):
+        timestamp = (get_time() if timestamp is None else timestamp)
+        signed = [self._sign(message, timestamp) for message in messages]
+        self.store.write_many(signed)
+        self.save()
+        return signed
+
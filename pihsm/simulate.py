@@ -0,0 +1,288 @@
+# pihsm: Turn your Raspberry Pi into a Hardware Security Module 
+# Copyright (C) 2017 System76, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+End-to-end PiHSM simulator for benchmarking on any Linux box.
+
+The whole stack runs in one process: ClientClient -> ScheduledClientServer ->
+SerialClient -> pty pair -> paced, lossy wire -> pty pair -> SerialServer ->
+PrivateClient -> PrivateServer, with both chains written to real ChainStores.
+"""
+
+import logging
+import os
+import random
+import select
+import shutil
+import socket
+import tempfile
+import threading
+import time
+
+from .common import IPC_TIMEOUT, SERIAL_BAUDRATE, ChainStore
+from .pool import Device, DevicePool
+from .ipc import (
+    PrivateServer, PrivateClient, ScheduledClientServer, ClientClient,
+)
+from .schedule import Scheduler, percentile
+from .serial import SerialServer, SerialClient
+from .sign import Signer
+
+
+log = logging.getLogger(__name__)
+
+BITS_PER_BYTE = 10  # Start bit, 8 data bits, stop bit
+
+
+class NullDisplayClient:
+    __slots__ = tuple()
+
+    def make_request(self, response):
+        pass
+
+
+class PtyPair:
+    __slots__ = ('master', 'slave', 'name')
+
+    def __init__(self):
+        (self.master, self.slave) = os.openpty()
+        self.name = os.ttyname(self.slave)
+
+    def close(self):
+        os.close(self.master)
+        os.close(self.slave)
+
+
+# Carries bytes from one pty master to another at *baudrate*, dropping or
+# corrupting each byte with the given probabilities:
+class Wire:
+    __slots__ = ('baudrate', 'drop', 'corrupt', 'random', 'dropped',
+        'corrupted', 'carried',
+    )
+
+    def __init__(self, baudrate=SERIAL_BAUDRATE, drop=0.0, corrupt=0.0,
+            seed=None):
+        assert 0.0 <= drop < 1.0
+        assert 0.0 <= corrupt < 1.0
+        self.baudrate = baudrate
+        self.drop = drop
+        self.corrupt = corrupt
+        self.random = random.Random(seed)
+        self.dropped = 0
+        self.corrupted = 0
+        self.carried = 0
+
+    def transform(self, data):
+        if self.drop == 0 and self.corrupt == 0:
+            return data
+        out = bytearray()
+        for byte in data:
+            if self.random.random() < self.drop:
+                self.dropped += 1
+                continue
+            if self.random.random() < self.corrupt:
+                self.corrupted += 1
+                byte ^= 1 << self.random.randrange(8)
+            out.append(byte)
+        return bytes(out)
+
+    def delay(self, size):
+        return size * BITS_PER_BYTE / self.baudrate
+
+    def carry(self, src, dst, stop):
+        while not stop.is_set():
+            (ready, w, x) = select.select([src], [], [], 0.1)
+            if not ready:
+                continue
+            try:
+                data = os.read(src, 4096)
+            except OSError:
+                return
+            time.sleep(self.delay(len(data)))
+            data = self.transform(data)
+            self.carried += len(data)
+            if data:
+                os.write(dst, data)
+
+
+def _serve_connections(server, stop):
+    server.sock.settimeout(0.1)
+    while not stop.is_set():
+        try:
+            (sock, address) = server.sock.accept()
+        except socket.timeout:
+            continue
+        try:
+            sock.settimeout(IPC_TIMEOUT)
+            server.handle_connection(sock)
+        except Exception:
+            log.exception('Error handling request:')
+        finally:
+            sock.close()
+
+
+def _serve_serial(server, stop):
+    while not stop.is_set():
+        server.serve_once()
+    server.close_serial()
+
+
+def _listen(filename):
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.bind(filename)
+    sock.listen(16)
+    return sock
+
+
+class Simulator:
+    __slots__ = ('wire', 'devices', 'tmp', 'stop', 'threads', 'ptys', 'socks',
+        'pool', 'filename',
+    )
+
+    def __init__(self, wire=None, devices=1):
+        assert devices > 0
+        self.wire = (Wire() if wire is None else wire)
+        self.devices = devices
+        self.tmp = tempfile.mkdtemp(prefix='pihsm-simulate.')
+        self.stop = threading.Event()
+        self.threads = []
+        self.ptys = []
+        self.socks = []
+        self.pool = None
+        self.filename = os.path.join(self.tmp, 'client.socket')
+
+    def _store(self, name):
+        dirname = os.path.join(self.tmp, name)
+        os.mkdir(dirname)
+        return ChainStore(dirname)
+
+    def _spawn(self, target, *args):
+        thread = threading.Thread(target=target, args=args, daemon=True)
+        thread.start()
+        self.threads.append(thread)
+
+    def _listen(self, name):
+        sock = _listen(os.path.join(self.tmp, name))
+        self.socks.append(sock)
+        return sock
+
+    # A simulated Pi, with its own wire, SerialServer and PrivateServer:
+    def _start_device(self, i, store):
+        (client_pty, server_pty) = (PtyPair(), PtyPair())
+        self.ptys.extend([client_pty, server_pty])
+        for (src, dst) in [(client_pty, server_pty), (server_pty, client_pty)]:
+            self._spawn(self.wire.carry, src.master, dst.master, self.stop)
+
+        name = 'private{}.socket'.format(i)
+        sock = self._listen(name)
+        signer = Signer(self._store('private{}'.format(i)))
+        private = PrivateServer(sock, NullDisplayClient(), signer)
+        self._spawn(_serve_connections, private, self.stop)
+
+        private_client = PrivateClient(os.path.join(self.tmp, name))
+        server = SerialServer(private_client, server_pty.name)
+        self._spawn(_serve_serial, server, self.stop)
+        return Device(client_pty.name, SerialClient(client_pty.name),
+            Signer(store)
+        )
+
+    def start(self):
+        store = self._store('client')
+        self.pool = DevicePool(
+            [self._start_device(i, store) for i in range(self.devices)]
+        )
+        sock = self._listen('client.socket')
+        device = self.pool.devices[0]
+        client = ScheduledClientServer([sock], device.serial_client,
+            device.signer, scheduler=Scheduler(), pool=self.pool
+        )
+        self._spawn(client.serve_forever, self.stop)
+
+    def close(self):
+        self.stop.set()
+        for thread in self.threads:
+            thread.join()
+        if self.pool is not None:
+            for device in self.pool.devices:
+                device.serial_client.close_serial()
+        for sock in self.socks:
+            sock.close()
+        for pty in self.ptys:
+            pty.close()
+        shutil.rmtree(self.tmp)
+
+    def _load(self, count, latencies, errors):
+        client = ClientClient(self.filename, socket.SOCK_STREAM)
+        for i in range(count):
+            start = time.perf_counter()
+            try:
+                client.make_request(os.urandom(48))
+                latencies.append(time.perf_counter() - start)
+            except Exception:
+                log.exception('Simulated request failed:')
+                errors.append(i)
+
+    # Runs *count* requests from *concurrency* clients at once:
+    def run(self, count=100, concurrency=4):
+        assert count >= concurrency > 0
+        latencies = []
+        errors = []
+        # The first count % concurrency threads make one request extra:
+        (share, extra) = divmod(count, concurrency)
+        threads = [
+            threading.Thread(target=self._load,
+                args=(share + (i < extra), latencies, errors)
+            )
+            for i in range(concurrency)
+        ]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        elapsed = time.perf_counter() - start
+        latencies.sort()
+        results = {
+            'signatures': len(latencies),
+            'errors': len(errors),
+            'elapsed': elapsed,
+            'rate': len(latencies) / elapsed,
+            'p50': (percentile(latencies, 50) if latencies else None),
+            'p99': (percentile(latencies, 99) if latencies else None),
+            'dropped': self.wire.dropped,
+            'corrupted': self.wire.corrupted,
+        }
+        results['devices'] = self.pool.stats()
+        results.update(
+            ('serial_' + key, value) for (key, value) in
+            self.pool.devices[0].serial_client.stats().items()
+        )
+        return results
+
+
+def simulate(count=100, concurrency=4, baudrate=SERIAL_BAUDRATE, drop=0.0,
+        corrupt=0.0, seed=None, devices=1):
+    sim = Simulator(Wire(baudrate, drop, corrupt, seed), devices)
+    try:
+        sim.start()
+        results = sim.run(count, concurrency)
+    finally:
+        sim.close()
+    log.info('%d signatures in %.2fs: %.1f/s, p50=%.3fs p99=%.3fs, %d errors',
+        results['signatures'], results['elapsed'], results['rate'],
+        results['p50'] or 0, results['p99'] or 0, results['errors']
+    )
+    return results
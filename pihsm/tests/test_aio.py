@@ -0,0 +1,370 @@
+# pihsm: Turn your Raspberry Pi into a Hardware Security Module 
+# Copyright (C) 2017 System76, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from unittest import TestCase
+import asyncio
+import os
+import select
+import socket
+import threading
+
+from nacl.signing import SigningKey
+
+from .helpers import random_digest, TempDir
+from ..common import PREFIX, get_counter
+from ..ipc import PrivateServer
+from ..simulate import NullDisplayClient, PtyPair, _serve_connections
+from ..sign import Signer
+from .. import aio, wire
+
+
+def run(coro):
+    loop = asyncio.new_event_loop()
+    try:
+        return loop.run_until_complete(coro)
+    finally:
+        loop.close()
+
+
+class PrivateThread:
+    def __init__(self, sock_type=socket.SOCK_SEQPACKET):
+        self.tmp = TempDir()
+        self.filename = self.tmp.join('private.socket')
+        sock = socket.socket(socket.AF_UNIX, sock_type)
+        sock.bind(self.filename)
+        sock.listen(5)
+        self.sock = sock
+        self.signer = Signer()
+        server = PrivateServer(sock, NullDisplayClient(), self.signer)
+        self.stop = threading.Event()
+        self.thread = threading.Thread(target=_serve_connections,
+            args=(server, self.stop), daemon=True
+        )
+        self.thread.start()
+
+    def close(self):
+        self.stop.set()
+        self.thread.join()
+        self.sock.close()
+
+
+class MockAsyncClient:
+    def __init__(self, fail=False):
+        self._signer = Signer()
+        self._calls = []
+        self._fail = fail
+
+    async def make_requests(self, requests):
+        self._calls.append(list(requests))
+        if self._fail:
+            raise ValueError('private server is gone')
+        return [self._signer.sign(r) for r in requests]
+
+
+# Doesn't answer until *release* is set:
+class SlowAsyncClient(MockAsyncClient):
+    def __init__(self):
+        super().__init__()
+        self._release = threading.Event()
+
+    async def make_requests(self, requests):
+        while not self._release.is_set():
+            await asyncio.sleep(0.01)
+        return await super().make_requests(requests)
+
+
+# None if no frame arrives within *timeout* seconds:
+def _read_frame(fd, decoder, timeout=5):
+    frame = decoder.next()
+    while frame is None:
+        if not select.select([fd], [], [], timeout)[0]:
+            return None
+        decoder.feed(os.read(fd, 4096))
+        frame = decoder.next()
+    return frame
+
+
+# The write end of a pipe; frames() reads back everything written so far:
+class MockTTL:
+    def __init__(self):
+        (self._r, self._w) = os.pipe()
+        os.set_blocking(self._r, False)
+        os.set_blocking(self._w, False)
+        self._written = bytearray()
+        self._flushes = 0
+        self.baudrate = 57600
+
+    def fileno(self):
+        return self._w
+
+    def flush(self):
+        self._flushes += 1
+
+    def close(self):
+        os.close(self._r)
+        os.close(self._w)
+
+    def frames(self):
+        try:
+            self._written += os.read(self._r, 65536)
+        except BlockingIOError:
+            pass
+        d = wire.FrameDecoder()
+        d.feed(bytes(self._written))
+        frames = []
+        while True:
+            frame = d.next()
+            if frame is None:
+                return frames
+            frames.append(frame)
+
+
+class TestAsyncPrivateClient(TestCase):
+    def test_make_requests(self):
+        for sock_type in [socket.SOCK_SEQPACKET, socket.SOCK_STREAM]:
+            private = PrivateThread(sock_type)
+            try:
+                client = aio.AsyncPrivateClient(private.filename)
+                s = Signer()
+                requests = [
+                    s.sign(random_digest())
+                    for i in range(wire.MAX_BATCH + 2)
+                ]
+                responses = run(client.make_requests(requests))
+                self.assertEqual(client.sock_type, sock_type)
+                self.assertEqual(len(responses), len(requests))
+                for (i, (req, resp)) in enumerate(zip(requests, responses)):
+                    self.assertEqual(resp[PREFIX:], req)
+                    self.assertEqual(get_counter(resp), i + 1)
+                request = s.sign(random_digest())
+                response = run(client.make_request(request))
+                self.assertEqual(response[PREFIX:], request)
+                self.assertEqual(private.signer.counter, len(requests) + 1)
+            finally:
+                private.close()
+
+    def test_chain(self):
+        client = aio.AsyncPrivateClient(chain='default')
+        self.assertIsNone(client.chain)
+        with self.assertRaises(ValueError):
+            aio.AsyncPrivateClient(chain='Tenant')
+        request = Signer().sign(random_digest())
+        private = PrivateThread(socket.SOCK_STREAM)
+        try:
+            client = aio.AsyncPrivateClient(private.filename, chain='tenant-a')
+            with self.assertRaises(ValueError) as cm:
+                run(client.make_request(request))
+            self.assertEqual(str(cm.exception),
+                "chain 'tenant-a': needs SOCK_SEQPACKET"
+            )
+        finally:
+            private.close()
+        # A PrivateServer only hosts the default chain, so it hangs up:
+        private = PrivateThread()
+        try:
+            client = aio.AsyncPrivateClient(private.filename, chain='tenant-a')
+            with self.assertRaises(ValueError) as cm:
+                run(client.make_request(request))
+            self.assertEqual(str(cm.exception),
+                'bad response size: expected 400; got 0'
+            )
+            self.assertEqual(private.signer.counter, 0)
+        finally:
+            private.close()
+
+
+def _full(seq, request):
+    return (0, (wire.FULL_REQUEST, seq, request))
+
+
+class TestAsyncSerialServer(TestCase):
+    def test_handle_frames(self):
+        s = Signer()
+        requests = [s.sign(random_digest()) for i in range(5)]
+        private = MockAsyncClient()
+        server = aio.AsyncSerialServer(private, 'port')
+        server.ttl = MockTTL()
+        self.addCleanup(server.ttl.close)
+
+        # Frames ready together go to the PrivateServer in one round trip,
+        # in sequence order:
+        frames = [_full(0, requests[0]), _full(2, requests[2]),
+            (0, (wire.COMPACT_REQUEST, 1, wire.compact_request(requests[1]))),
+        ]
+        run(server.handle_frames(frames))
+        self.assertEqual(private._calls, [requests[:3]])
+        self.assertEqual(server.expected, 3)
+        self.assertEqual(server.held, {})
+        self.assertEqual(list(server.known), requests[1:3])
+        self.assertIs(server.tail.endswith(requests[2]), True)
+        self.assertEqual([f[:2] for f in server.ttl.frames()],
+            [(wire.RESPONSE_PREFIX, i) for i in range(3)]
+        )
+        self.assertEqual(server.latency.count, 3)
+
+        # A batch frame joins the run:
+        batch = wire.pack_batch(requests[3:])
+        run(server.handle_frames([(0, (wire.BATCH_REQUEST, 3, batch))]))
+        self.assertEqual(private._calls[1], requests[3:])
+        (ftype, seq, payload) = server.ttl.frames()[-1]
+        self.assertEqual((ftype, seq), (wire.BATCH_RESPONSE, 3))
+        self.assertEqual(server.expected, 4)
+
+        # A retransmit is answered from the cache:
+        run(server.handle_frames([_full(0, requests[0])]))
+        self.assertEqual(len(private._calls), 2)
+        self.assertEqual(server.ttl.frames()[-1][:2], (wire.RESPONSE_PREFIX, 0))
+
+    def test_handle_frames_error(self):
+        s = Signer()
+        requests = [s.sign(random_digest()) for i in range(2)]
+        private = MockAsyncClient(fail=True)
+        server = aio.AsyncSerialServer(private, 'port')
+        server.ttl = MockTTL()
+        self.addCleanup(server.ttl.close)
+        run(server.handle_frames([_full(7, requests[0]), _full(8, requests[1])]))
+        self.assertEqual(private._calls, [requests])
+        self.assertEqual(server.ttl.frames(), [])
+        # Nothing moved on, so the retransmits get signed:
+        self.assertEqual(server.expected, 7)
+        self.assertEqual(len(server.known), 0)
+        private._fail = False
+        run(server.handle_frames([_full(7, requests[0]), _full(8, requests[1])]))
+        self.assertEqual(private._calls[1], requests)
+        self.assertEqual(server.expected, 9)
+
+    def test_write_frame(self):
+        server = aio.AsyncSerialServer(MockAsyncClient(), 'port')
+        ttl = server.ttl = MockTTL()
+        self.addCleanup(ttl.close)
+
+        async def fill():
+            # With the pipe full, frames queue up behind a writer callback
+            # rather than blocking the loop:
+            while True:
+                try:
+                    os.write(ttl._w, bytes(4096))
+                except BlockingIOError:
+                    break
+            server.write_frame(wire.PING, 1, bytes(16))
+            server.write_frame(wire.PING, 2, bytes(16))
+            self.assertEqual(len(server.outgoing), 2 * (wire.OVERHEAD + 16))
+            self.assertEqual(server.writing, ttl._w)
+            # Once there's room, the callback sends the rest:
+            while True:
+                try:
+                    os.read(ttl._r, 65536)
+                except BlockingIOError:
+                    break
+            while server.outgoing:
+                await asyncio.sleep(0.01)
+            self.assertIsNone(server.writing)
+        run(fill())
+        self.assertEqual([f[:2] for f in ttl.frames()[-2:]],
+            [(wire.PING, 1), (wire.PING, 2)]
+        )
+        # Nothing waited on the UART to drain:
+        self.assertEqual(ttl._flushes, 0)
+
+        # Except a baudrate change, after what's queued has gone out:
+        server.outgoing += wire.pack_frame(wire.PING, 3, bytes(16))
+        server.set_baudrate(115200)
+        self.assertEqual(server.outgoing, b'')
+        self.assertEqual(ttl._flushes, 1)
+        self.assertEqual(ttl.baudrate, 115200)
+        self.assertEqual(ttl.frames()[-1][:2], (wire.PING, 3))
+
+    def test_ping_while_signing(self):
+        pty = PtyPair()
+        private = SlowAsyncClient()
+        stop = threading.Event()
+        key = SigningKey.generate()
+        thread = threading.Thread(target=aio.run,
+            args=(private, [pty.name]),
+            kwargs={'stop': stop, 'status_key': key}
+        )
+        thread.start()
+        try:
+            request = Signer().sign(random_digest())
+            nonce = os.urandom(wire.PING_NONCE)
+            # Opening the port flushes it, so give the server a moment:
+            stop.wait(0.2)
+            os.write(pty.master,
+                wire.pack_frame(wire.FULL_REQUEST, 0, request)
+            )
+            stop.wait(0.1)
+            os.write(pty.master, wire.pack_frame(wire.PING, 0, nonce))
+
+            # The ping is answered while the request is still being signed:
+            d = wire.FrameDecoder()
+            frame = _read_frame(pty.master, d, 1)
+            self.assertIsNotNone(frame)
+            self.assertEqual(frame[0], wire.STATUS)
+            self.assertEqual(frame[2][64:96], bytes(key.verify_key))
+            self.assertEqual(private._calls, [])
+            private._release.set()
+            frame = _read_frame(pty.master, d)
+            self.assertEqual(frame[:2], (wire.RESPONSE_PREFIX, 0))
+            self.assertEqual(private._calls, [[request]])
+        finally:
+            private._release.set()
+            stop.set()
+            thread.join()
+            pty.close()
+
+    def test_serve_ports(self):
+        ptys = [PtyPair(), PtyPair()]
+        private = PrivateThread()
+        stop = threading.Event()
+        client = aio.AsyncPrivateClient(private.filename)
+        thread = threading.Thread(target=aio.run,
+            args=(client, [p.name for p in ptys]), kwargs={'stop': stop}
+        )
+        thread.start()
+        try:
+            s = Signer()
+            requests = [s.sign(random_digest()) for i in range(4)]
+            # Opening the ports flushes them, so give the server a moment:
+            stop.wait(0.2)
+            for (i, pty) in enumerate(ptys):
+                for seq in range(2):
+                    os.write(pty.master,
+                        wire.pack_frame(wire.FULL_REQUEST, seq,
+                            requests[i * 2 + seq]
+                        )
+                    )
+            for (i, pty) in enumerate(ptys):
+                d = wire.FrameDecoder()
+                frames = []
+                while len(frames) < 2:
+                    d.feed(os.read(pty.master, 4096))
+                    frame = d.next()
+                    while frame is not None:
+                        frames.append(frame)
+                        frame = d.next()
+                self.assertEqual([f[:2] for f in frames],
+                    [(wire.RESPONSE_PREFIX, 0), (wire.RESPONSE_PREFIX, 1)]
+                )
+                for (seq, f) in enumerate(frames):
+                    response = wire.rebuild_response(f[2], requests[i * 2 + seq])
+                    self.assertTrue(response.endswith(requests[i * 2 + seq]))
+            self.assertEqual(private.signer.counter, 4)
+        finally:
+            stop.set()
+            thread.join()
+            private.close()
+            for pty in ptys:
+                pty.close()
@@ -0,0 +1,105 @@
+# pihsm: Turn your Raspberry Pi into a Hardware Security Module 
+# Copyright (C) 2017 System76, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from unittest import TestCase
+import io
+
+from .helpers import random_digest
+from .test_serial import Link, MockClient, connect_link
+from ..sign import Signer
+from .. import benchmark, capture, common, serial
+
+
+def record_session(count):
+    # Captures both ends of count requests over an in-memory link:
+    s1 = Signer()
+    s2 = Signer()
+    requests = [s1.sign(random_digest()) for i in range(count)]
+    responses = [s2.sign(r) for r in requests]
+    link = Link()
+    (client, server) = connect_link(link, MockClient(*responses))
+    fps = (io.BytesIO(), io.BytesIO())
+    client.capture = capture.Capture(fps[0])
+    server.capture = capture.Capture(fps[1])
+    assert client.make_requests(requests[:count // 2]) == \
+        responses[:count // 2]
+    assert client.make_requests(requests[count // 2:]) == \
+        responses[count // 2:]
+    return tuple(
+        list(capture.iter_capture(io.BytesIO(fp.getvalue()))) for fp in fps
+    ) + (requests,)
+
+
+class TestFunctions(TestCase):
+    def test_get_machine(self):
+        machine = benchmark.get_machine()
+        self.assertIs(type(machine), str)
+
+    def test_bench_digest(self):
+        for name in ['sha384', 'blake2b']:
+            rate = benchmark.bench_digest(name, 1024, 2)
+            self.assertIs(type(rate), float)
+            self.assertGreater(rate, 0)
+
+    def test_bench_digests(self):
+        results = benchmark.bench_digests(1024, 1)
+        self.assertEqual(sorted(results), ['blake2b', 'sha384'])
+
+    def test_bench_serial_open(self):
+        results = benchmark.bench_serial_open(5)
+        self.assertEqual(sorted(results), ['persistent', 'reopened'])
+        for value in results.values():
+            self.assertGreater(value, 0)
+
+    def test_bench_recovery(self):
+        results = benchmark.bench_recovery(20)
+        self.assertEqual(sorted(results), ['lost', 'p50', 'p99'])
+        self.assertEqual(results['lost'], 0)
+        # Far below the old sleep-and-flush, which cost SERIAL_TIMEOUT:
+        self.assertLess(results['p99'], 0.5)
+
+    def test_bench_combined(self):
+        results = benchmark.bench_combined(5)
+        self.assertEqual(sorted(results), ['combined', 'split'])
+        for usage in results.values():
+            self.assertEqual(sorted(usage), ['cpu', 'rss'])
+            self.assertGreater(usage['rss'], 0)
+        # Two processes' worth of interpreter against one:
+        self.assertGreater(results['split']['rss'], results['combined']['rss'])
+
+    def test_replay_server(self):
+        (client_records, server_records, requests) = record_session(5)
+        results = benchmark.replay_server(server_records)
+        self.assertEqual(results['signed'], 5)
+        self.assertEqual(results['counters'], serial.new_counters())
+        self.assertGreater(results['elapsed'], 0)
+
+    def test_captured_requests(self):
+        count = common.SERIAL_WINDOW + 3
+        (client_records, server_records, requests) = record_session(count)
+        captured = benchmark.captured_requests(client_records)
+        self.assertEqual([r for (seq, r) in captured], requests)
+        self.assertEqual(len(set(seq for (seq, r) in captured)), count)
+        self.assertEqual(list(benchmark._runs(captured)), [captured])
+        gap = captured[:2] + captured[3:]
+        self.assertEqual(list(benchmark._runs(gap)), [gap[:2], gap[2:]])
+
+    def test_replay_client(self):
+        (client_records, server_records, requests) = record_session(6)
+        results = benchmark.replay_client(client_records)
+        self.assertEqual(results['responses'], 6)
+        self.assertEqual(results['failed'], 0)
+        self.assertEqual(results['counters'], serial.new_counters())
@@ -0,0 +1,181 @@
+# pihsm: Turn your Raspberry Pi into a Hardware Security Module 
+# Copyright (C) 2017 System76, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from unittest import TestCase
+import os
+import threading
+
+from .helpers import random_digest, random_id, TempDir
+from ..common import ChainStore
+from ..sign import Signer
+from .. import cache
+
+
+def make_response(client, server, digest, timestamp):
+    request = client.sign(digest, timestamp)
+    response = server.sign(request)
+    client.store.write(response)
+    return response
+
+
+class TestRingCache(TestCase):
+    def test_init(self):
+        c = cache.RingCache(3)
+        self.assertEqual(c.size, 3)
+        self.assertEqual(len(c), 0)
+        self.assertEqual(c.stats(),
+            {'entries': 0, 'hits': 0, 'misses': 0, 'evictions': 0}
+        )
+
+    def test_get_put(self):
+        c = cache.RingCache(2)
+        keys = [os.urandom(64) for i in range(3)]
+        values = [os.urandom(400) for i in range(3)]
+        self.assertIsNone(c.get(keys[0]))
+        c.put(keys[0], values[0])
+        c.put(keys[1], values[1])
+        self.assertIs(c.get(keys[0]), values[0])
+        self.assertIs(c.get(keys[1]), values[1])
+        c.put(keys[2], values[2])
+        self.assertEqual(len(c), 2)
+        self.assertIsNone(c.get(keys[0]))
+        self.assertIs(c.get(keys[2]), values[2])
+        self.assertEqual(c.stats(),
+            {'entries': 2, 'hits': 3, 'misses': 2, 'evictions': 1}
+        )
+
+        # Re-putting an entry makes it the most recent:
+        c.put(keys[1], values[1])
+        c.put(keys[0], values[0])
+        self.assertIsNone(c.get(keys[2]))
+        self.assertIs(c.get(keys[1]), values[1])
+
+        # So does a hit, so the least recently used entry is evicted:
+        self.assertIs(c.get(keys[1]), values[1])
+        c.put(keys[2], values[2])
+        self.assertIsNone(c.get(keys[0]))
+        self.assertIs(c.get(keys[1]), values[1])
+
+    def test_threads(self):
+        # Several workers hitting one cache at once:
+        c = cache.RingCache(8)
+        keys = [os.urandom(64) for i in range(32)]
+        def target():
+            for i in range(200):
+                key = keys[i % len(keys)]
+                if c.get(key) is None:
+                    c.put(key, key)
+        threads = [threading.Thread(target=target) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        stats = c.stats()
+        self.assertEqual(stats['entries'], 8)
+        self.assertEqual(stats['hits'] + stats['misses'], 800)
+
+
+class TestResponseCache(TestCase):
+    def test_get_put(self):
+        tmp = TempDir()
+        store = ChainStore(tmp.dir)
+        client = Signer(store)
+        server = Signer()
+        c = cache.ResponseCache(store, 2, 60)
+        self.assertIsNone(c.filename)
+
+        d1 = random_digest()
+        r1 = make_response(client, server, d1, 1000)
+        self.assertIsNone(c.get(d1, 1000))
+        c.put(r1)
+        self.assertEqual(c.get(d1, 1000), r1)
+        self.assertEqual(c.get(d1, 1060), r1)
+        self.assertEqual(c.stats(),
+            {'entries': 1, 'hits': 2, 'misses': 1, 'evictions': 0}
+        )
+
+        # Outside the window:
+        self.assertIsNone(c.get(d1, 1061))
+        self.assertEqual(c.stats(),
+            {'entries': 0, 'hits': 2, 'misses': 2, 'evictions': 1}
+        )
+
+        # Bounded size:
+        digests = [random_digest() for i in range(3)]
+        for d in digests:
+            c.put(make_response(client, server, d, 2000))
+        self.assertIsNone(c.get(digests[0], 2000))
+        self.assertIsNotNone(c.get(digests[1], 2000))
+        self.assertIsNotNone(c.get(digests[2], 2000))
+        self.assertEqual(c.evictions, 2)
+
+        # Least recently used goes first:
+        self.assertIsNotNone(c.get(digests[1], 2000))
+        c.put(make_response(client, server, random_digest(), 2000))
+        self.assertIsNone(c.get(digests[2], 2000))
+        self.assertIsNotNone(c.get(digests[1], 2000))
+
+    def test_load(self):
+        tmp = TempDir()
+        store = ChainStore(tmp.dir)
+        filename = tmp.join('response_cache')
+        client = Signer(store)
+        server = Signer()
+
+        c = cache.ResponseCache(store, 3, 60, filename)
+        self.assertEqual(c.load(1000), 0)
+        digests = [random_digest() for i in range(5)]
+        responses = [
+            make_response(client, server, d, 1000 + i)
+            for (i, d) in enumerate(digests)
+        ]
+        for r in responses:
+            c.put(r)
+        self.assertEqual(os.path.getsize(filename), 5 * 64)
+
+        # Only the newest entries are loaded:
+        c = cache.ResponseCache(store, 3, 60, filename)
+        self.assertEqual(c.load(1061), 3)
+        self.assertEqual(os.path.getsize(filename), 3 * 64)
+        self.assertIsNone(c.get(digests[1], 1061))
+        for i in [2, 3, 4]:
+            self.assertEqual(c.get(digests[i], 1061), responses[i])
+
+        # Expired entries aren't loaded:
+        c = cache.ResponseCache(store, 3, 60, filename)
+        self.assertEqual(c.load(1064), 1)
+        self.assertEqual(c.get(digests[4], 1064), responses[4])
+
+        # Missing or corrupt entries are skipped:
+        with open(filename, 'ab') as fp:
+            fp.write(os.urandom(64))
+        c = cache.ResponseCache(store, 3, 60, filename)
+        self.assertEqual(c.load(1064), 1)
+
+    def test_append_index(self):
+        tmp = TempDir()
+        filename = tmp.join(random_id())
+        c = cache.ResponseCache(None, 2, 60, filename)
+        sigs = [os.urandom(64) for i in range(5)]
+        for s in sigs[:4]:
+            c.append_index(s)
+        self.assertEqual(os.path.getsize(filename), 4 * 64)
+        self.assertEqual(list(c.iter_index()), sigs[:4])
+
+        # Compacted once the index grows past twice the cache size:
+        c.entries[b'digest'] = (sigs[4], 0)
+        c.append_index(sigs[4])
+        self.assertEqual(list(c.iter_index()), [sigs[4]])
@@ -0,0 +1,217 @@
+# pihsm: Turn your Raspberry Pi into a Hardware Security Module 
+# Copyright (C) 2017 System76, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from unittest import TestCase
+import io
+import os
+
+from .helpers import TempDir
+from .test_serial import MockSerial
+from .. import capture
+
+
+class FakeClock:
+    def __init__(self, *times):
+        self._times = list(times)
+        self._sleeps = []
+
+    def __call__(self):
+        return self._times.pop(0)
+
+    def sleep(self, seconds):
+        self._sleeps.append(seconds)
+
+
+class TestCapture(TestCase):
+    def test_record(self):
+        fp = io.BytesIO()
+        c = capture.Capture(fp, clock=FakeClock(10.0, 10.5, 12.0, 12.25))
+        self.assertEqual(c.size, len(capture.CAPTURE_MAGIC))
+        c.record(capture.READ, b'hello')
+        c.record(capture.WRITE, bytearray(b'world!'))
+        c.record(capture.RATE, capture.rate_record(115200))
+        self.assertEqual(c.size, len(fp.getvalue()))
+        fp.seek(0)
+        self.assertEqual(list(capture.iter_capture(fp)), [
+            (0.5, capture.READ, b'hello'),
+            (2.0, capture.WRITE, b'world!'),
+            (2.25, capture.RATE, b'\x00\xc2\x01\x00'),
+        ])
+
+    def test_max_size(self):
+        fp = io.BytesIO()
+        size = len(capture.CAPTURE_MAGIC) + capture.RECORD.size + 10
+        c = capture.Capture(fp, size)
+        c.record(capture.READ, os.urandom(10))
+        self.assertEqual(len(fp.getvalue()), size)
+        c.record(capture.READ, b'x')
+        self.assertIsNone(c.size)
+        c.record(capture.READ, b'x')
+        self.assertEqual(len(fp.getvalue()), size)
+
+    def test_iter_capture(self):
+        with self.assertRaises(ValueError) as cm:
+            list(capture.iter_capture(io.BytesIO(b'nope')))
+        self.assertEqual(str(cm.exception), "capture: bad magic b'nope'")
+
+        record = capture.RECORD.pack(1000, capture.WRITE, 3) + b'abc'
+        data = capture.CAPTURE_MAGIC + record
+        # A capture cut short by a crash keeps every complete record:
+        for i in range(len(record)):
+            fp = io.BytesIO(data + record[:i])
+            self.assertEqual(list(capture.iter_capture(fp)),
+                [(0.001, capture.WRITE, b'abc')]
+            )
+        fp = io.BytesIO(data + capture.RECORD.pack(0, 7, 0))
+        with self.assertRaises(ValueError) as cm:
+            list(capture.iter_capture(fp))
+        self.assertEqual(str(cm.exception), 'capture: bad record kind 7')
+
+        # Sessions follow on from each other:
+        session = capture.CAPTURE_MAGIC + record
+        fp = io.BytesIO(session + session)
+        self.assertEqual(list(capture.iter_capture(fp)),
+            [(0.001, capture.WRITE, b'abc'), (0.002, capture.WRITE, b'abc')]
+        )
+        # Including one cut short before its first record:
+        for i in range(len(capture.CAPTURE_MAGIC) + 1):
+            fp = io.BytesIO(session + session[:i])
+            self.assertEqual(list(capture.iter_capture(fp)),
+                [(0.001, capture.WRITE, b'abc')]
+            )
+        bad = capture.CAPTURE_MAGIC[:-1] + b'\x00'
+        fp = io.BytesIO(session + bad)
+        with self.assertRaises(ValueError) as cm:
+            list(capture.iter_capture(fp))
+        self.assertEqual(str(cm.exception),
+            'capture: bad magic {!r}'.format(bad)
+        )
+
+    def test_open_capture(self):
+        tmp = TempDir()
+        filename = tmp.join('serial.capture')
+        c = capture.open_capture(filename)
+        c.record(capture.READ, b'data')
+        c.close()
+        records = capture.load_capture(filename)
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0][1:], (capture.READ, b'data'))
+
+        # A restart adds to the capture rather than truncating it:
+        c = capture.open_capture(filename)
+        c.record(capture.WRITE, b'more')
+        c.close()
+        records = capture.load_capture(filename)
+        self.assertEqual([r[1:] for r in records],
+            [(capture.READ, b'data'), (capture.WRITE, b'more')]
+        )
+
+        # The size cap covers every session in the file:
+        size = os.stat(filename).st_size
+        c = capture.open_capture(filename, size + len(capture.CAPTURE_MAGIC))
+        self.assertEqual(c.size, size + len(capture.CAPTURE_MAGIC))
+        c.record(capture.READ, b'x')
+        self.assertIsNone(c.size)
+        c.close()
+        c = capture.open_capture(filename, size + len(capture.CAPTURE_MAGIC))
+        self.assertIsNone(c.size)
+        c.close()
+        self.assertEqual(os.stat(filename).st_size,
+            size + len(capture.CAPTURE_MAGIC)
+        )
+        self.assertEqual(capture.load_capture(filename), records)
+
+
+class TestTapSerial(TestCase):
+    def test_all(self):
+        fp = io.BytesIO()
+        ttl = MockSerial(b'abc', b'')
+        tap = capture.TapSerial(ttl, capture.Capture(fp))
+        buf = bytearray(8)
+        self.assertEqual(tap.readinto(buf), 3)
+        self.assertEqual(tap.readinto(buf), 0)
+        self.assertEqual(tap.write(b'xyz'), 3)
+        self.assertIsNone(tap.flush())
+        tap.baudrate = 921600
+        self.assertEqual(ttl.baudrate, 921600)
+        self.assertEqual(tap.baudrate, 921600)
+        tap.timeout = 0.5
+        self.assertEqual(ttl.timeout, 0.5)
+        self.assertEqual(tap.timeout, 0.5)
+        self.assertIsNone(tap.close())
+        self.assertEqual(ttl._calls, [
+            ('readinto', 8), ('readinto', 8), ('write', b'xyz'), 'flush',
+            'close',
+        ])
+        fp.seek(0)
+        self.assertEqual(
+            [r[1:] for r in capture.iter_capture(fp)],
+            [
+                (capture.RATE, capture.rate_record(57600)),
+                (capture.READ, b'abc'),
+                (capture.WRITE, b'xyz'),
+                (capture.RATE, capture.rate_record(921600)),
+            ]
+        )
+
+
+class TestReplay(TestCase):
+    def test_unpaced(self):
+        records = [
+            (0.0, capture.RATE, capture.rate_record(57600)),
+            (1.0, capture.READ, b'abcd'),
+            (2.0, capture.WRITE, b'ignored'),
+            (3.0, capture.READ, b'ef'),
+        ]
+        replay = capture.Replay(records)
+        self.assertEqual(len(replay), 2)
+        self.assertIs(replay('port', baudrate=57600, timeout=2), replay)
+        self.assertEqual((replay.port, replay.baudrate, replay.timeout),
+            ('port', 57600, 2)
+        )
+        buf = bytearray(3)
+        self.assertEqual(replay.readinto(buf), 3)
+        self.assertEqual(buf, b'abc')
+        self.assertEqual(replay.readinto(buf), 1)
+        self.assertEqual(buf[:1], b'd')
+        self.assertEqual(replay.write(b'hello'), 5)
+        self.assertEqual(replay.written, 5)
+        self.assertEqual(replay.readinto(buf), 2)
+        self.assertEqual(buf[:2], b'ef')
+        self.assertEqual(len(replay), 0)
+        with self.assertRaises(EOFError):
+            replay.readinto(buf)
+
+    def test_paced(self):
+        records = [
+            (1.0, capture.READ, b'a'),
+            (3.0, capture.READ, b'b'),
+            (9.0, capture.READ, b'c'),
+        ]
+        clock = FakeClock(100.0, 100.25, 101.0, 103.0)
+        replay = capture.Replay(records, speed=2, clock=clock,
+            sleep=clock.sleep
+        )
+        replay('port', timeout=2)
+        buf = bytearray(1)
+        # The first chunk is due immediately; the rest at half their delays:
+        self.assertEqual(replay.readinto(buf), 1)
+        self.assertEqual(replay.readinto(buf), 1)
+        # Three seconds away is past the timeout:
+        self.assertEqual(replay.readinto(buf), 0)
+        self.assertEqual(replay.readinto(buf), 1)
+        self.assertEqual(buf, b'c')
+        self.assertEqual(clock._sleeps, [0.75, 2, 1.0])
@@ -0,0 +1,291 @@
+# pihsm: Turn your Raspberry Pi into a Hardware Security Module 
+# Copyright (C) 2017 System76, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from unittest import TestCase
+import os
+import socket
+import threading
+
+from .helpers import random_digest, TempDir
+from ..common import PREFIX, b32enc, get_counter, get_pubkey
+from ..ipc import PrivateClient, pack_private_request
+from ..sign import Signer
+from ..simulate import PtyPair
+from .. import aio, chains, wire
+
+
+def _recv_responses(sock):
+    data = sock.recv(4096)
+    return [data[i:i + 400] for i in range(0, len(data), 400)]
+
+
+def _serve(server, count):
+    def target():
+        for i in range(count):
+            (sock, address) = server.sock.accept()
+            server.serve_connection(sock)
+    thread = threading.Thread(target=target, daemon=True)
+    thread.start()
+    return thread
+
+
+class TestFunctions(TestCase):
+    def test_chain_dir(self):
+        self.assertEqual(chains.chain_dir('/foo', 'default'), '/foo')
+        self.assertEqual(chains.chain_dir('/foo', 'tenant-a'),
+            '/foo/chains/tenant-a'
+        )
+        with self.assertRaises(ValueError):
+            chains.chain_dir('/foo', '../bar')
+
+    def test_tail_name(self):
+        self.assertEqual(chains.tail_name('default'), 'tail')
+        self.assertEqual(chains.tail_name('tenant-a'), 'tail.tenant-a')
+        with self.assertRaises(ValueError):
+            chains.tail_name('a/b')
+
+    def test_build_workers(self):
+        tmp = TempDir()
+        workers = chains.build_workers(['tenant-a', 'default', 'tenant-b'],
+            tmp.join('lib'), tmp.join('run')
+        )
+        self.assertEqual([w.name for w in workers],
+            ['default', 'tenant-a', 'tenant-b']
+        )
+        for w in workers:
+            self.assertEqual(w.basedir, tmp.join('lib'))
+            self.assertEqual(w.rundir, tmp.join('run'))
+            self.assertIsNone(w.process)
+        self.assertEqual([w.name for w in chains.build_workers([])],
+            ['default']
+        )
+        with self.assertRaises(ValueError) as cm:
+            chains.build_workers(['a', 'a'])
+        self.assertEqual(str(cm.exception),
+            "duplicate chain names: ['default', 'a', 'a']"
+        )
+        with self.assertRaises(ValueError):
+            chains.build_workers(['A'])
+
+
+class TestChainWorker(TestCase):
+    def test_submit(self):
+        tmp = TempDir()
+        rundir = tmp.mkdir('run')
+        worker = chains.ChainWorker('tenant-a', tmp.dir, rundir)
+        self.assertEqual(worker.stats(), {
+            'public': None,
+            'counter': None,
+            'signed': 0,
+            'failures': 0,
+            'alive': False,
+        })
+        worker.start()
+        try:
+            self.assertTrue(worker.is_alive())
+            public = worker.public
+            self.assertEqual(tmp.listdir(), ['chains', 'run'])
+            self.assertEqual(tmp.listdir('chains', 'tenant-a'), ['chain'])
+            self.assertEqual(tmp.listdir('run'), ['tail.tenant-a'])
+            with open(tmp.join('run', 'tail.tenant-a'), 'rb') as fp:
+                self.assertEqual(get_pubkey(fp.read()), public)
+
+            s = Signer()
+            requests = [s.sign(random_digest()) for i in range(3)]
+            (a, b) = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            worker.submit(b, requests)
+            responses = _recv_responses(a)
+            a.close()
+            self.assertEqual(len(responses), 3)
+            for (i, (req, resp)) in enumerate(zip(requests, responses)):
+                self.assertEqual(resp[PREFIX:], req)
+                self.assertEqual(get_counter(resp), i + 1)
+                self.assertEqual(get_pubkey(resp), public)
+            with open(tmp.join('run', 'tail.tenant-a'), 'rb') as fp:
+                self.assertEqual(fp.read(), responses[-1])
+
+            # A bad request is counted, and the connection closed unanswered:
+            bad = bytearray(s.sign(random_digest()))
+            bad[0] ^= 1
+            (a, b) = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            worker.submit(b, [bytes(bad)])
+            self.assertEqual(a.recv(4096), b'')
+            a.close()
+            self.assertEqual(worker.stats(), {
+                'public': b32enc(public),
+                'counter': 3,
+                'signed': 3,
+                'failures': 1,
+                'alive': True,
+            })
+
+            # Rotation lands between two signings:
+            worker.rotate()
+            (a, b) = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            worker.submit(b, [s.sign(random_digest())])
+            [response] = _recv_responses(a)
+            a.close()
+            self.assertNotEqual(worker.public, public)
+            self.assertEqual(get_pubkey(response), worker.public)
+            self.assertEqual(get_counter(response), 1)
+            self.assertEqual(worker.counter, 1)
+            self.assertEqual(worker.signed, 4)
+        finally:
+            worker.stop()
+        self.assertFalse(worker.is_alive())
+        self.assertIsNone(worker.thread)
+
+    def test_start_error(self):
+        tmp = TempDir()
+        worker = chains.ChainWorker('tenant-a', tmp.dir, tmp.join('nope'))
+        with self.assertRaises(ValueError) as cm:
+            worker.start()
+        self.assertTrue(
+            str(cm.exception).startswith('chain tenant-a: FileNotFoundError')
+        )
+        worker.stop()
+        self.assertFalse(worker.is_alive())
+
+
+class TestMultiChainServer(TestCase):
+    def test_serve_connection(self):
+        tmp = TempDir()
+        rundir = tmp.mkdir('run')
+        filename = tmp.join('private.socket')
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        sock.bind(filename)
+        sock.listen(5)
+        server = chains.MultiChainServer(sock,
+            chains.build_workers(['tenant-a', 'tenant-b'], tmp.dir, rundir)
+        )
+        self.assertEqual(sorted(server.workers),
+            ['default', 'tenant-a', 'tenant-b']
+        )
+        server.start()
+        try:
+            self.assertIsNone(server.check_workers())
+            self.assertEqual(tmp.listdir('run'),
+                ['tail', 'tail.tenant-a', 'tail.tenant-b']
+            )
+            publics = dict(
+                (name, w.public) for (name, w) in server.workers.items()
+            )
+            self.assertEqual(len(set(publics.values())), 3)
+
+            # Each chain has its own key and counter:
+            s = Signer()
+            for (name, count) in [('tenant-a', 3), (None, 1), ('tenant-b', 2),
+                    ('tenant-a', 1)]:
+                client = PrivateClient(filename, chain=name)
+                requests = [s.sign(random_digest()) for i in range(count)]
+                thread = _serve(server, 1)
+                responses = client.make_requests(requests)
+                thread.join()
+                for (req, resp) in zip(requests, responses):
+                    self.assertEqual(resp[PREFIX:], req)
+                    self.assertEqual(get_pubkey(resp),
+                        publics[name or 'default']
+                    )
+            stats = server.stats()
+            self.assertEqual(
+                dict((n, (st['counter'], st['signed'])) for (n, st) in
+                    stats.items()
+                ),
+                {'default': (1, 1), 'tenant-a': (4, 4), 'tenant-b': (2, 2)}
+            )
+
+            # An unknown chain gets the connection closed:
+            (a, b) = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+            a.send(pack_private_request([s.sign(random_digest())], 'nope'))
+            server.serve_connection(b)
+            self.assertEqual(a.recv(4096), b'')
+            a.close()
+
+            # Every chain rotates:
+            self.assertIsNone(server.request_rotate())
+            self.assertIs(server.rotate_requested, True)
+            server.rotate()
+            self.assertIs(server.rotate_requested, False)
+            # Each worker rotates before its next request is signed:
+            for (name, worker) in server.workers.items():
+                client = PrivateClient(filename, chain=name)
+                thread = _serve(server, 1)
+                response = client.make_request(s.sign(random_digest()))
+                thread.join()
+                self.assertEqual(get_counter(response), 1)
+                self.assertEqual(get_pubkey(response), worker.public)
+                self.assertNotEqual(worker.public, publics[name])
+
+            server.workers['tenant-b'].stop()
+            with self.assertRaises(RuntimeError) as cm:
+                server.check_workers()
+            self.assertEqual(str(cm.exception),
+                'chain tenant-b: worker is not running'
+            )
+        finally:
+            server.stop()
+            sock.close()
+
+    def test_serve_ports(self):
+        tmp = TempDir()
+        filename = tmp.join('private.socket')
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        sock.bind(filename)
+        sock.listen(5)
+        server = chains.MultiChainServer(sock,
+            chains.build_workers(['tenant-a'], tmp.dir, tmp.mkdir('run'))
+        )
+        server.start()
+        serving = _serve(server, 2)
+        ptys = [PtyPair(), PtyPair()]
+        stop = threading.Event()
+        # One port on each chain:
+        clients = [
+            aio.AsyncPrivateClient(filename, chain=name)
+            for name in ['default', 'tenant-a']
+        ]
+        thread = threading.Thread(target=aio.run,
+            args=(clients, [p.name for p in ptys]), kwargs={'stop': stop}
+        )
+        thread.start()
+        try:
+            s = Signer()
+            requests = [s.sign(random_digest()) for i in range(4)]
+            # Opening the ports flushes them, so give the server a moment:
+            stop.wait(0.2)
+            for (i, pty) in enumerate(ptys):
+                os.write(pty.master,
+                    wire.pack_frame(wire.BATCH_REQUEST, 0,
+                        wire.pack_batch(requests[i * 2:i * 2 + 2])
+                    )
+                )
+            for (name, pty) in zip(['default', 'tenant-a'], ptys):
+                d = wire.FrameDecoder()
+                frame = None
+                while frame is None:
+                    d.feed(os.read(pty.master, 4096))
+                    frame = d.next()
+                self.assertEqual(frame[:2], (wire.BATCH_RESPONSE, 0))
+            serving.join()
+            self.assertEqual(server.workers['default'].counter, 2)
+            self.assertEqual(server.workers['tenant-a'].counter, 2)
+        finally:
+            stop.set()
+            thread.join()
+            server.stop()
+            sock.close()
+            for pty in ptys:
+                pty.close()
@@ -0,0 +1,192 @@
+# pihsm: Turn your Raspberry Pi into a Hardware Security Module 
+# Copyright (C) 2017 System76, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from unittest import TestCase
+import os
+import threading
+
+from .helpers import random_digest
+from .test_aio import run
+from ..common import PREFIX, get_counter, get_pubkey
+from ..sign import Signer
+from ..simulate import PtyPair
+from .. import combined, verify, wire
+
+
+class MockDisplayClient:
+    def __init__(self):
+        self._calls = []
+        self._fail = False
+
+    def make_request(self, response):
+        if self._fail:
+            raise OSError('no /run/pihsm-private')
+        self._calls.append(response)
+
+
+class TestSignerThread(TestCase):
+    def test_submit(self):
+        display = MockDisplayClient()
+        signer = Signer()
+        thread = combined.SignerThread(display, signer)
+        self.assertIs(thread.server.signer, signer)
+        thread.start()
+        try:
+            s = Signer()
+            requests = [s.sign(random_digest()) for i in range(3)]
+            results = []
+            done = threading.Event()
+
+            def callback(responses, error):
+                results.append((responses, error))
+                done.set()
+
+            thread.submit(requests, callback)
+            self.assertIs(done.wait(5), True)
+            (responses, error) = results[0]
+            self.assertIsNone(error)
+            self.assertEqual([r[PREFIX:] for r in responses], requests)
+            self.assertEqual(display._calls, responses)
+
+            # Errors come back to the caller, and the thread carries on:
+            display._fail = True
+            done.clear()
+            thread.submit([s.sign(random_digest())], callback)
+            self.assertIs(done.wait(5), True)
+            (responses, error) = results[1]
+            self.assertIsNone(responses)
+            self.assertIsInstance(error, OSError)
+            display._fail = False
+            done.clear()
+            thread.submit([s.sign(random_digest())], callback)
+            self.assertIs(done.wait(5), True)
+            self.assertIsNone(results[2][1])
+            self.assertEqual(signer.counter, 5)
+        finally:
+            thread.stop()
+        self.assertIsNone(thread.thread)
+
+    def test_rotate(self):
+        display = MockDisplayClient()
+        signer = Signer()
+        thread = combined.SignerThread(display, signer)
+        thread.start()
+        try:
+            client = combined.LocalPrivateClient(thread)
+            s = Signer()
+            before = client.make_request(s.sign(random_digest()))
+            genesis = signer.genesis
+            thread.rotate()
+            # Queued behind nothing, so it's done before the next request:
+            after = client.make_request(s.sign(random_digest()))
+        finally:
+            thread.stop()
+        self.assertNotEqual(signer.genesis, genesis)
+        self.assertEqual(display._calls, [before, signer.genesis, after])
+        self.assertEqual(get_pubkey(after), signer.public)
+        self.assertEqual(get_counter(after), 1)
+
+
+class TestLocalPrivateClient(TestCase):
+    def test_make_requests(self):
+        display = MockDisplayClient()
+        thread = combined.SignerThread(display, Signer())
+        thread.start()
+        try:
+            client = combined.LocalPrivateClient(thread)
+            s = Signer()
+            requests = [s.sign(random_digest()) for i in range(3)]
+            responses = client.make_requests(requests)
+            self.assertEqual([get_counter(r) for r in responses], [1, 2, 3])
+            request = s.sign(random_digest())
+            self.assertEqual(client.make_request(request)[PREFIX:], request)
+            # A retransmit gets the same response back:
+            self.assertEqual(client.make_requests(requests[-1:]),
+                responses[-1:]
+            )
+            display._fail = True
+            with self.assertRaises(OSError):
+                client.make_request(s.sign(random_digest()))
+        finally:
+            thread.stop()
+
+
+class TestAsyncLocalClient(TestCase):
+    def test_make_requests(self):
+        display = MockDisplayClient()
+        thread = combined.SignerThread(display, Signer())
+        thread.start()
+        try:
+            client = combined.AsyncLocalClient(thread)
+            s = Signer()
+            requests = [
+                s.sign(random_digest()) for i in range(wire.MAX_BATCH + 2)
+            ]
+            responses = run(client.make_requests(requests))
+            self.assertEqual([r[PREFIX:] for r in responses], requests)
+            request = s.sign(random_digest())
+            response = run(client.make_request(request))
+            self.assertEqual(get_counter(response), len(requests) + 1)
+            display._fail = True
+            with self.assertRaises(OSError):
+                run(client.make_request(s.sign(random_digest())))
+        finally:
+            thread.stop()
+
+
+class TestFunctions(TestCase):
+    def test_run(self):
+        pty = PtyPair()
+        display = MockDisplayClient()
+        signer = Signer()
+        stop = threading.Event()
+        thread = threading.Thread(target=combined.run,
+            args=(display, signer, [pty.name]), kwargs={'stop': stop}
+        )
+        s = Signer()
+        requests = [s.sign(random_digest()) for i in range(2)]
+        count = verify.get_verifications()
+        thread.start()
+        try:
+            # Opening the port flushes it, so give the server a moment:
+            stop.wait(0.2)
+            for (seq, request) in enumerate(requests):
+                os.write(pty.master,
+                    wire.pack_frame(wire.FULL_REQUEST, seq, request)
+                )
+            d = wire.FrameDecoder()
+            frames = []
+            while len(frames) < 2:
+                d.feed(os.read(pty.master, 4096))
+                frame = d.next()
+                while frame is not None:
+                    frames.append(frame)
+                    frame = d.next()
+            self.assertEqual([f[:2] for f in frames],
+                [(wire.RESPONSE_PREFIX, 0), (wire.RESPONSE_PREFIX, 1)]
+            )
+            responses = [
+                wire.rebuild_response(f[2], r)
+                for (f, r) in zip(frames, requests)
+            ]
+            self.assertEqual(display._calls, responses)
+            self.assertEqual(signer.counter, 2)
+            # Each request is verified once, by the serial front end:
+            self.assertEqual(verify.get_verifications() - count, 2)
+        finally:
+            stop.set()
+            thread.join()
+            pty.close()
@@ -68,6 +68,16 @@ class TestConstants(TestCase):
     def test_SERIAL_BAUDRATE(self):
         self.check_int('SERIAL_BAUDRATE', 57600)
 
+    def test_SERIAL_BAUDRATES(self):
+        self.assertIs(type(common.SERIAL_BAUDRATES), tuple)
+        self.assertEqual(common.SERIAL_BAUDRATES,
+            (57600, 115200, 230400, 460800, 921600)
+        )
+        self.assertEqual(common.SERIAL_BAUDRATES[0], common.SERIAL_BAUDRATE)
+        self.assertEqual(tuple(sorted(common.SERIAL_BAUDRATES)),
+            common.SERIAL_BAUDRATES
+        )
+
     def test_SERIAL_TIMEOUT(self):
         self.check_int('SERIAL_TIMEOUT', 2)
 
@@ -107,6 +117,16 @@ class TestConstants(TestCase):
     def test_DIGEST(self):
         self.check_int('DIGEST', 48)
 
+    def test_DEFAULT_DIGEST_ALGORITHM(self):
+        self.assertEqual(common.DEFAULT_DIGEST_ALGORITHM, 'sha384')
+        self.assertIn(common.DEFAULT_DIGEST_ALGORITHM, common.DIGEST_ALGORITHMS)
+
+    def test_DIGEST_ALGORITHMS(self):
+        self.assertIs(type(common.DIGEST_ALGORITHMS), dict)
+        self.assertEqual(sorted(common.DIGEST_ALGORITHMS), ['blake2b', 'sha384'])
+        for (name, func) in common.DIGEST_ALGORITHMS.items():
+            self.assertEqual(func(b'System76').digest_size, common.DIGEST)
+
     def test_REQUEST(self):
         self.check_int('REQUEST', 224)
         self.assertEqual(common.REQUEST,
@@ -170,6 +190,11 @@ class TestConfigItems(TestCase):
             common.Config('debug', bool, False)
         )
 
+    def test_CONFIG_DIGEST_ALGORITHM(self):
+        self.check_config_item('CONFIG_DIGEST_ALGORITHM',
+            common.Config('digest_algorithm', str, 'sha384')
+        )
+
 
 class TestFunctions(TestCase):
     def test_get_signature(self):
@@ -421,6 +446,52 @@ class TestFunctions(TestCase):
             self.assertEqual(common.compute_digest(good),
                 hashlib.sha384(good).digest()
             )
+            self.assertEqual(common.compute_digest(good, 'sha384'),
+                hashlib.sha384(good).digest()
+            )
+            self.assertEqual(common.compute_digest(good, 'blake2b'),
+                hashlib.blake2b(good, digest_size=48).digest()
+            )
+
+        # Bad algorithm:
+        with self.assertRaises(ValueError) as cm:
+            common.compute_digest(good, 'md5')
+        self.assertEqual(str(cm.exception),
+            "algorithm: need one of ['blake2b', 'sha384']; got 'md5'"
+        )
+
+    def test_check_digest_algorithm(self):
+        for name in ['sha384', 'blake2b']:
+            self.assertIs(common.check_digest_algorithm(name), name)
+        for bad in ['sha256', 'SHA384', 'blake2s', '']:
+            with self.assertRaises(ValueError) as cm:
+                common.check_digest_algorithm(bad)
+            self.assertEqual(str(cm.exception),
+                "algorithm: need one of ['blake2b', 'sha384']; got {!r}".format(bad)
+            )
+
+    def test_identify_digest(self):
+        for size in [1, 76, 1776]:
+            data = os.urandom(size)
+            for name in ['sha384', 'blake2b']:
+                digest = common.compute_digest(data, name)
+                self.assertEqual(common.identify_digest(data, digest), name)
+            self.assertIsNone(
+                common.identify_digest(data, os.urandom(common.DIGEST))
+            )
+
+    def test_match_manifest(self):
+        manifest = os.urandom(1776)
+        for name in ['sha384', 'blake2b']:
+            digest = common.compute_digest(manifest, name)
+            # Only the digest is looked at:
+            request = os.urandom(common.PREFIX) + digest
+            self.assertEqual(common.match_manifest(request, manifest), name)
+            with self.assertRaises(ValueError) as cm:
+                common.match_manifest(request, os.urandom(1776))
+            self.assertEqual(str(cm.exception),
+                'manifest does not match digest {}'.format(digest.hex())
+            )
 
     def test_create_b32_subdirs(self):
         expected = list(common.B32NAMES)
@@ -450,6 +521,15 @@ class TestFunctions(TestCase):
         self.assertEqual(tmp.listdir(other), expected)
         self.assertEqual(tmp.listdir(name), expected)
 
+    def test_syncfs(self):
+        tmp = TempDir()
+        if common._syncfs is None:
+            self.assertIs(common.syncfs(tmp.dir), False)
+            return
+        self.assertIs(common.syncfs(tmp.dir), True)
+        with self.assertRaises(FileNotFoundError):
+            common.syncfs(tmp.join('nope'))
+
 
 class TestB32Store(TestCase):
     def test_init(self):
@@ -493,6 +573,16 @@ class TestB32Store(TestCase):
 
 
 class TestManifestStore(TestCase):
+    def test_init(self):
+        tmp = TempDir()
+        store = common.ManifestStore(tmp.dir)
+        self.assertEqual(store.basedir, tmp.join('manifest'))
+        self.assertEqual(store.algorithm, 'sha384')
+        store = common.ManifestStore(tmp.dir, 'blake2b')
+        self.assertEqual(store.algorithm, 'blake2b')
+        with self.assertRaises(ValueError):
+            common.ManifestStore(tmp.dir, 'md5')
+
     def test_get_key(self):
         self.assertEqual(common.ManifestStore.get_key(b'System76').hex(),
             HEXDIGEST
@@ -502,6 +592,9 @@ class TestManifestStore(TestCase):
             self.assertEqual(common.ManifestStore.get_key(content),
                 hashlib.sha384(content).digest()
             )
+            self.assertEqual(common.ManifestStore.get_key(content, 'blake2b'),
+                hashlib.blake2b(content, digest_size=48).digest()
+            )
 
     def test_write(self):
         tmp = TempDir()
@@ -533,6 +626,15 @@ class TestManifestStore(TestCase):
                 self.assertEqual(fp.read(), content)
             self.assertEqual(tmp.listdir('manifest', 'tmp'), [])
 
+    def test_write_blake2b(self):
+        tmp = TempDir()
+        store = common.ManifestStore(tmp.dir, 'blake2b')
+        content = os.urandom(1776)
+        key = hashlib.blake2b(content, digest_size=48).digest()
+        self.assertEqual(store.write(content), key)
+        with store.open(key) as fp:
+            self.assertEqual(fp.read(), content)
+
 
 class TestChainStore(TestCase):
     def test_get_key(self):
@@ -572,3 +674,39 @@ class TestChainStore(TestCase):
                 self.assertEqual(fp.read(), content)
             self.assertEqual(tmp.listdir('chain', 'tmp'), [])
 
+    def test_write_many(self):
+        tmp = TempDir()
+        store = common.ChainStore(tmp.dir)
+        contents = [os.urandom(400) for i in range(3)]
+        self.assertEqual(store.write_many(contents),
+            [content[:64] for content in contents]
+        )
+        self.assertEqual(tmp.listdir('chain', 'tmp'), [])
+        for content in contents:
+            with store.open(content[:64]) as fp:
+                st = os.stat(fp.fileno())
+                self.assertEqual(stat.S_IMODE(st.st_mode), 0o444)
+                self.assertEqual(fp.read(), content)
+        self.assertEqual(store.write_many([]), [])
+
+        # A single response goes through write():
+        content = os.urandom(400)
+        self.assertEqual(store.write_many([content]), [content[:64]])
+        with store.open(content[:64]) as fp:
+            self.assertEqual(fp.read(), content)
+        self.assertEqual(tmp.listdir('chain', 'tmp'), [])
+
+        # Without syncfs(), each file is fsync'ed instead:
+        (syncfs, common._syncfs) = (common._syncfs, None)
+        try:
+            self.assertIs(common.syncfs(tmp.dir), False)
+            contents = [os.urandom(400) for i in range(2)]
+            self.assertEqual(store.write_many(contents),
+                [content[:64] for content in contents]
+            )
+        finally:
+            common._syncfs = syncfs
+        for content in contents:
+            with store.open(content[:64]) as fp:
+                self.assertEqual(fp.read(), content)
+        self.assertEqual(tmp.listdir('chain', 'tmp'), [])
@@ -17,7 +17,7 @@
 from unittest import TestCase
 import os
 
-from .helpers import random_u64, MockBus
+from .helpers import random_u64, MockBus, TempDir
 from ..common import b32enc
 from  .. import display
 
@@ -201,6 +201,17 @@ class TestFunctions(TestCase):
             (display._mk_status_lines(),)
         )
 
+    def test_mk_chain_lines(self):
+        tail = os.urandom(160) + (17).to_bytes(8, 'little') + os.urandom(232)
+        self.assertEqual(display._mk_chain_lines('tenant-a', tail), (
+            'Chain:              ',
+            '            tenant-a',
+            'Counter:            ',
+            '                  17',
+        ))
+        lines = display._mk_chain_lines('tenant-a', os.urandom(96))
+        self.assertEqual(lines[3], '                   0')
+
     def test_mk_screens_0(self):
         screens = display._mk_screens_0()
         self.assertIs(type(screens), tuple)
@@ -273,6 +284,21 @@ class TestLCD(TestCase):
         )
 
 
+class TestSpecialClient(TestCase):
+    def test_make_request(self):
+        tmp = TempDir()
+        client = display.SpecialClient(tmp.dir)
+        self.assertEqual(client.filename, tmp.join('tail'))
+        tail = os.urandom(400)
+        self.assertIsNone(client.make_request(tail))
+        self.assertEqual(tmp.listdir(), ['tail'])
+        self.assertEqual(open(client.filename, 'rb').read(), tail)
+        self.assertEqual(os.stat(client.filename).st_mode & 0o777, 0o444)
+        dloop = display.DisplayLoop(None, client.filename)
+        dloop.update_tail_if_needed()
+        self.assertEqual(dloop.last, tail)
+
+
 class MockLCD:
     def __init__(self):
         self._calls = []
@@ -315,3 +341,21 @@ class TestDisplayLoop(TestCase):
         ])
         self.assertIs(dloop.screens, screens)
 
+    def test_update_chains(self):
+        tmp = TempDir()
+        filename = tmp.join('tail')
+        dloop = display.DisplayLoop(MockLCD(), filename)
+        self.assertEqual(dloop.chain_screens, tuple())
+        tails = {'b': os.urandom(96), 'a': os.urandom(400)}
+        for (name, tail) in tails.items():
+            display.SpecialClient(tmp.dir, 'tail.' + name).make_request(tail)
+        dloop.update_tail_if_needed()
+        self.assertEqual(dloop.chain_screens, (
+            display._mk_chain_lines('a', tails['a']),
+            display._mk_chain_lines('b', tails['b']),
+        ))
+        # After the screens for the default chain:
+        dloop.play_screens()
+        self.assertEqual(dloop.lcd._calls, [
+            ('lcd_screens', dloop.screens + dloop.chain_screens),
+        ])
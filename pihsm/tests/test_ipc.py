@@ -15,19 +15,29 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from unittest import TestCase
+from os import path
 import os
+import signal
 import socket
+import time
 
 from nacl.exceptions import BadSignatureError
 
 from .helpers import iter_permutations, random_u64, random_digest, TempDir
 from ..sign import Signer, build_signing_form
+from ..common import ChainStore, get_signature
+from ..cache import RingCache, ResponseCache
+from ..serial import Status
+from ..schedule import DeadlineExpired, Job
+from ..wire import MAX_BATCH
 from .. import common
 from .. import verify
-from  .. import ipc
+from  .. import ipc, pool
 
 
 class MockSocket:
+    type = socket.SOCK_STREAM
+
     def __init__(self, *returns):
         self._returns = list(returns)
         self._calls = []
@@ -36,9 +46,19 @@ class MockSocket:
         self._calls.append(('recv', size))
         return self._returns.pop(0)
 
-    def send(self, src):
-        self._calls.append(('send', src))
-        return len(src)
+    def recv_into(self, buf, nbytes=0):
+        size = (nbytes if nbytes else len(buf))
+        self._calls.append(('recv_into', size))
+        data = (self._returns.pop(0) if self._returns else b'')[:size]
+        buf[0:len(data)] = data
+        return len(data)
+
+    def sendall(self, src):
+        self._calls.append(('sendall', src))
+
+
+class MockSeqPacketSocket(MockSocket):
+    type = socket.SOCK_SEQPACKET
 
 
 class MockClient:
@@ -50,6 +70,9 @@ class MockClient:
         self._calls.append(request)
         return self._returns.pop(0)
 
+    def make_requests(self, requests, deadline=None, batch=False):
+        return [self.make_request(r) for r in requests]
+
 
 class MockDisplayClient:
     def __init__(self):
@@ -79,15 +102,24 @@ class TestServer(TestCase):
         for size in [common.DIGEST, common.REQUEST]:
             server = ipc.Server(None, size)
 
-            # Bad size:
+            # Bad size (stream, short read then EOF):
+            sock = MockSocket(os.urandom(size - 1))
+            with self.assertRaises(ValueError) as cm:
+                server.handle_connection(sock)
+            self.assertEqual(str(cm.exception),
+                'bad request: expected {} bytes; got {}'.format(size, size - 1)
+            )
+            self.assertEqual(sock._calls, [('recv_into', size), ('recv_into', 1)])
+
+            # Bad size (seqpacket, one message):
             for bad in [size - 1, size + 1]:
-                sock = MockSocket(os.urandom(bad))
+                sock = MockSeqPacketSocket(os.urandom(bad))
                 with self.assertRaises(ValueError) as cm:
                     server.handle_connection(sock)
                 self.assertEqual(str(cm.exception),
                     'bad request: expected {} bytes; got {}'.format(size, bad)
                 )
-                self.assertEqual(sock._calls, [('recv', size)])
+                self.assertEqual(sock._calls, [('recv_into', size + 1)])
 
             # Good size, should be handed off to Server.handle_request():
             sock = MockSocket(os.urandom(size))
@@ -96,7 +128,36 @@ class TestServer(TestCase):
             self.assertEqual(str(cm.exception),
                 'Server.handle_request(request)'
             )
-            self.assertEqual(sock._calls, [('recv', size)])
+            self.assertEqual(sock._calls, [('recv_into', size)])
+
+            # Stream short reads are reassembled:
+            request = os.urandom(size)
+            sock = MockSocket(request[:7], request[7:])
+            with self.assertRaises(NotImplementedError) as cm:
+                server.handle_connection(sock)
+            self.assertEqual(sock._calls,
+                [('recv_into', size), ('recv_into', size - 7)]
+            )
+            self.assertEqual(server.buf[:size], request)
+
+            sock = MockSeqPacketSocket(os.urandom(size))
+            with self.assertRaises(NotImplementedError) as cm:
+                server.handle_connection(sock)
+            self.assertEqual(sock._calls, [('recv_into', size + 1)])
+
+    def test_handle_connection_response(self):
+        class EchoServer(ipc.Server):
+            def handle_request(self, request):
+                return request[::-1]
+
+        server = EchoServer(None, 48)
+        request = os.urandom(48)
+        sock = MockSocket(request)
+        server.handle_connection(sock)
+        # All of it, however many writes that takes:
+        self.assertEqual(sock._calls,
+            [('recv_into', 48), ('sendall', request[::-1])]
+        )
 
 
 class TestPrivateServer(TestCase):
@@ -108,9 +169,13 @@ class TestPrivateServer(TestCase):
         self.assertIs(server.sock, sock)
         self.assertIs(server.display_client, display_client)
         self.assertIs(server.signer, signer)
+        self.assertIsInstance(server.recent, RingCache)
+        self.assertEqual(server.recent.size, 16)
         self.assertEqual(sock._calls, [])
         self.assertEqual(display_client._calls, [])
         self.assertEqual(signer.counter, 0)
+        server = ipc.PrivateServer(sock, display_client, signer, 4)
+        self.assertEqual(server.recent.size, 4)
 
     def test_handle_request(self):
         sock = MockSocket()
@@ -184,6 +249,123 @@ class TestPrivateServer(TestCase):
             [response1, response1, response2, response2]
         )
 
+    def test_handle_request_retransmit(self):
+        display_client = MockDisplayClient()
+        signer = Signer()
+        server = ipc.PrivateServer(None, display_client, signer, 3)
+        s = Signer()
+        requests = [s.sign(random_digest()) for i in range(4)]
+        responses = [server.handle_request(r) for r in requests]
+        self.assertEqual(signer.counter, 4)
+        self.assertEqual(server.recent.hits, 0)
+
+        # Retries of any recent (not just the last) request are reused:
+        for i in [2, 1, 3, 3]:
+            self.assertIs(server.handle_request(requests[i]), responses[i])
+        self.assertEqual(signer.counter, 4)
+        self.assertEqual(server.recent.hits, 4)
+        self.assertIs(signer.tail, responses[3])
+
+        # Oldest request has been evicted, so it gets signed again:
+        response = server.handle_request(requests[0])
+        self.assertIsNot(response, responses[0])
+        self.assertTrue(response.endswith(requests[0]))
+        self.assertEqual(signer.counter, 5)
+        self.assertEqual(server.recent.evictions, 2)
+
+    def test_handle_requests(self):
+        display_client = MockDisplayClient()
+        signer = Signer()
+        server = ipc.PrivateServer(None, display_client, signer)
+        s = Signer()
+        requests = [s.sign(random_digest()) for i in range(4)]
+        responses = server.handle_requests(requests)
+        self.assertEqual(signer.counter, 4)
+        self.assertEqual(display_client._calls, responses)
+        for (i, (request, response)) in enumerate(zip(requests, responses)):
+            self.assertTrue(response.endswith(request))
+            self.assertEqual(verify.get_counter(response), i + 1)
+
+        # A retransmitted batch isn't signed again, but a new request is:
+        more = requests[2:] + [s.sign(random_digest())]
+        again = server.handle_requests(more)
+        self.assertEqual(again[:2], responses[2:])
+        self.assertEqual(signer.counter, 5)
+        self.assertIs(signer.tail, again[2])
+
+        # Any bad signature fails the lot:
+        bad = bytearray(requests[1])
+        bad[0] ^= 1
+        with self.assertRaises(BadSignatureError):
+            server.handle_requests([requests[0], bytes(bad)])
+        self.assertEqual(signer.counter, 5)
+
+    def test_trusted(self):
+        s = Signer()
+        requests = [s.sign(random_digest()) for i in range(3)]
+        for trusted in [False, True]:
+            signer = Signer()
+            server = ipc.PrivateServer(None, MockDisplayClient(), signer,
+                trusted=trusted
+            )
+            self.assertIs(server.trusted, trusted)
+            count = verify.get_verifications()
+            server.handle_request(requests[0])
+            server.handle_requests(requests[1:])
+            self.assertEqual(signer.counter, 3)
+            # Checked here unless the caller in this process already has:
+            self.assertEqual(verify.get_verifications() - count,
+                (0 if trusted else 3)
+            )
+
+    def test_rotate(self):
+        display_client = MockDisplayClient()
+        signer = Signer()
+        server = ipc.PrivateServer(None, display_client, signer)
+        self.assertIs(server.rotate_requested, False)
+        self.assertIsNone(server.request_rotate())
+        self.assertIs(server.rotate_requested, True)
+        genesis = signer.genesis
+        handover = server.rotate()
+        self.assertIs(server.rotate_requested, False)
+        self.assertEqual(verify.get_pubkey(handover), genesis[64:])
+        self.assertEqual(handover[176:], signer.genesis)
+        self.assertEqual(display_client._calls, [signer.genesis])
+
+        # Requests keep being signed, now on the new chain:
+        s = Signer()
+        response = server.handle_request(s.sign(random_digest()))
+        self.assertEqual(verify.get_pubkey(response), signer.public)
+        self.assertEqual(verify.get_counter(response), 1)
+
+    def test_handle_connection_chain(self):
+        signer = Signer()
+        server = ipc.PrivateServer(None, MockDisplayClient(), signer)
+        s = Signer()
+        requests = [s.sign(random_digest()) for i in range(2)]
+        (a, b) = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        try:
+            a.send(ipc.pack_private_request(requests, 'default'))
+            server.handle_connection(b)
+            self.assertEqual(len(a.recv(4096)), 800)
+            # Only a MultiChainServer hosts named chains:
+            a.send(ipc.pack_private_request(requests, 'tenant-a'))
+            with self.assertRaises(ValueError) as cm:
+                server.handle_connection(b)
+            self.assertEqual(str(cm.exception), "unknown chain 'tenant-a'")
+            self.assertEqual(signer.counter, 2)
+        finally:
+            a.close()
+            b.close()
+
+
+class FailingSerialClient:
+    def make_requests(self, requests, deadline=None, batch=False):
+        raise OSError('unplugged')
+
+    def ping(self):
+        return None
+
 
 class TestClientServer(TestCase):
     def test_init(self):
@@ -194,6 +376,11 @@ class TestClientServer(TestCase):
         self.assertIs(server.sock, sock)
         self.assertIs(server.serial_client, serial_client)
         self.assertIs(server.signer, signer)
+        self.assertIsNone(server.cache)
+        self.assertEqual(len(server.pool), 1)
+        device = server.pool.devices[0]
+        self.assertIs(device.serial_client, serial_client)
+        self.assertIs(device.signer, signer)
         self.assertEqual(sock._calls, [])
         self.assertEqual(serial_client._calls, [])
         self.assertEqual(signer.counter, 0)
@@ -212,15 +399,321 @@ class TestClientServer(TestCase):
         serial_client = MockClient(response)
         server = ipc.ClientServer(sock, serial_client, s1)
         self.assertEqual(s1.counter, 0)
+        count = verify.get_verifications()
         self.assertEqual(server.handle_request(digest, ts), response)
+        # The SerialClient verifies responses, so that's left to it:
+        self.assertEqual(verify.get_verifications(), count)
         self.assertEqual(s1.counter, 1)
         self.assertEqual(sock._calls, [])
         self.assertEqual(serial_client._calls, [request])
 
+    def test_handle_request_cached(self):
+        tmp = TempDir()
+        store = ChainStore(tmp.dir)
+        s1 = Signer(store)
+        serial_client = MockSerialClient()
+        c = ResponseCache(store, 4, 3600)
+        server = ipc.ClientServer(None, serial_client, s1, c)
+        self.assertIs(server.cache, c)
+
+        digest = random_digest()
+        response = server.handle_request(digest)
+        self.assertTrue(response.endswith(digest))
+        self.assertEqual(s1.counter, 1)
+        self.assertEqual(c.stats()['misses'], 1)
+
+        # Same digest again is answered without another request:
+        self.assertEqual(server.handle_request(digest), response)
+        self.assertEqual(s1.counter, 1)
+        self.assertEqual(c.stats()['hits'], 1)
+
+        # Different digest is signed:
+        digest2 = random_digest()
+        response2 = server.handle_request(digest2)
+        self.assertTrue(response2.endswith(digest2))
+        self.assertEqual(s1.counter, 2)
+
+    def test_handle_requests(self):
+        tmp = TempDir()
+        store = ChainStore(tmp.dir)
+        s1 = Signer(store)
+        c = ResponseCache(store, 4, 3600)
+        server = ipc.ClientServer(None, MockSerialClient(), s1, c)
+        cached = random_digest()
+        response = server.handle_request(cached)
+        digests = [random_digest(), cached, random_digest()]
+        responses = server.handle_requests(digests)
+        self.assertEqual(len(responses), 3)
+        for (digest, r) in zip(digests, responses):
+            self.assertTrue(r.endswith(digest))
+        self.assertEqual(responses[1], response)
+        self.assertEqual(s1.counter, 3)
+
+    def test_pool(self):
+        tmp = TempDir()
+        store = ChainStore(tmp.dir)
+        devices = [
+            pool.Device(name, MockSerialClient(), Signer(store))
+            for name in ['a', 'b']
+        ]
+        p = pool.DevicePool(devices)
+        server = ipc.ClientServer(None, None, None, pool=p)
+        self.assertIs(server.pool, p)
+
+        digests = [random_digest() for i in range(3)]
+        responses = server.handle_requests(digests)
+        for (digest, r) in zip(digests, responses):
+            self.assertTrue(r.endswith(digest))
+            self.assertIs(p.find(r), devices[0])
+            self.assertTrue(path.isfile(store.path(get_signature(r))))
+        self.assertEqual(devices[0].signer.counter, 3)
+        self.assertEqual(devices[0].load, 0)
+
+        # A failed batch is signed again on the other device, which then gets
+        # everything until the failed one is due to be retried:
+        devices[0].serial_client = FailingSerialClient()
+        digest = random_digest()
+        response = server.handle_request(digest)
+        self.assertTrue(response.endswith(digest))
+        self.assertIs(p.find(response), devices[1])
+        self.assertEqual(devices[0].failures, 1)
+        self.assertIsNotNone(devices[0].retry_at)
+        server.handle_request(random_digest())
+        self.assertEqual(devices[1].signer.counter, 2)
+        self.assertEqual((devices[0].load, devices[1].load), (0, 0))
+
+        # Once every device has failed, the error is raised:
+        devices[1].serial_client = FailingSerialClient()
+        devices[0].serial_client = FailingSerialClient()
+        with self.assertRaises(OSError):
+            server.handle_request(random_digest())
+        self.assertEqual((devices[0].failures, devices[1].failures), (2, 1))
+
+    def test_check_health(self):
+        devices = [
+            pool.Device(name, MockSerialClient(), Signer())
+            for name in ['a', 'b']
+        ]
+        p = pool.DevicePool(devices)
+        server = ipc.ClientServer(None, None, None, pool=p)
+        server.check_health()
+        self.assertEqual([d.status.counter for d in devices], [0, 0])
+        self.assertEqual([d.down for d in devices], [False, False])
+
+        # A dead device is found without a caller waiting on it, and once
+        # they're all dead requests fail at once:
+        for d in devices:
+            d.serial_client = FailingSerialClient()
+        server.check_health()
+        self.assertEqual([d.down for d in devices], [True, True])
+        with self.assertRaises(pool.NoDevice):
+            server.handle_request(random_digest())
+        self.assertEqual([d.signer.counter for d in devices], [0, 0])
+
+        devices[1].serial_client = MockSerialClient()
+        server.check_health()
+        self.assertEqual([d.down for d in devices], [True, False])
+        response = server.handle_request(random_digest())
+        self.assertIs(p.find(response), devices[1])
+
+
+class ExpiringSerialClient:
+    def make_requests(self, requests, deadline=None, batch=False):
+        raise DeadlineExpired(len(requests))
+
+
+class TestScheduledClientServer(TestCase):
+    def test_live_jobs(self):
+        server = ipc.ScheduledClientServer([MockSocket()], MockSerialClient(), Signer())
+        pairs = [socket.socketpair() for i in range(3)]
+        jobs = [
+            Job(a, random_digest(), 1, received=0.0, deadline=10.0)
+            for (a, b) in pairs
+        ]
+        jobs[0].deadline = 5.0
+        pairs[1][1].close()  # The caller hung up
+        pairs[2][1].shutdown(socket.SHUT_WR)  # But this one is still waiting
+        self.assertEqual(server.live_jobs(jobs, 7.0), jobs[2:])
+        self.assertEqual(server.scheduler.expired, [0, 1])
+        self.assertEqual(server.scheduler.abandoned, [0, 1])
+        self.assertEqual([j.sock.fileno() for j in jobs[:2]], [-1, -1])
+
+        # Nothing was signed for the dropped jobs:
+        server.handle_jobs(jobs[2:])
+        response = pairs[2][1].recv(common.RESPONSE)
+        self.assertTrue(response.endswith(jobs[2].digest))
+        self.assertEqual(server.signer.counter, 1)
+        for (a, b) in pairs:
+            b.close()
+
+    def test_handle_jobs_batch(self):
+        serial_client = MockSerialClient()
+        calls = []
+        make_requests = serial_client.make_requests
+        def record(requests, deadline=None, batch=False):
+            calls.append((len(requests), batch))
+            return make_requests(requests, deadline, batch)
+        serial_client.make_requests = record
+        server = ipc.ScheduledClientServer([MockSocket()], serial_client,
+            Signer()
+        )
+
+        # Only a run of bulk jobs goes in batch frames:
+        for priorities in [[1, 1, 1], [0, 1], [1]]:
+            pairs = [socket.socketpair() for p in priorities]
+            jobs = [
+                Job(a, random_digest(), p)
+                for ((a, b), p) in zip(pairs, priorities)
+            ]
+            server.handle_jobs(jobs)
+            for ((a, b), job) in zip(pairs, jobs):
+                self.assertTrue(b.recv(common.RESPONSE).endswith(job.digest))
+                b.close()
+        self.assertEqual(calls, [(3, True), (2, False), (1, False)])
+
+    def test_handle_jobs_deadline(self):
+        server = ipc.ScheduledClientServer([MockSocket()], ExpiringSerialClient(),
+            Signer()
+        )
+        (a, b) = socket.socketpair()
+        job = Job(a, random_digest(), 0, received=0.0, deadline=1.0)
+        server.handle_jobs([job])
+        self.assertEqual(a.fileno(), -1)
+        self.assertEqual(b.recv(common.RESPONSE), b'')
+        self.assertEqual(server.scheduler.expired, [1, 0])
+        self.assertEqual(server.scheduler.stats()['interactive']['served'], 0)
+        self.assertEqual(server.pool.devices[0].failures, 0)
+        b.close()
+
+
+class TestFunctions(TestCase):
+    def test_recv_message(self):
+        buf = bytearray(49)
+        data = os.urandom(48)
+        sock = MockSocket(data[:10], data[10:20], data[20:])
+        self.assertEqual(ipc.recv_message(sock, buf, 48), 48)
+        self.assertEqual(buf[:48], data)
+        sock = MockSocket(data[:10])
+        self.assertEqual(ipc.recv_message(sock, buf, 48), 10)
+        sock = MockSeqPacketSocket(data + b'x')
+        self.assertEqual(ipc.recv_message(sock, buf, 48), 49)
+
+    def test_check_chain_name(self):
+        for name in ['default', 'a', 'tenant-a', 'build_2', 'x' * 20]:
+            self.assertIs(ipc.check_chain_name(name), name)
+        for name in ['', 'x' * 21, 'Tenant', '-a', 'a.b', 'a/b', '../a',
+                b'a', None]:
+            with self.assertRaises(ValueError) as cm:
+                ipc.check_chain_name(name)
+            self.assertEqual(str(cm.exception),
+                'bad chain name: {!r}'.format(name)
+            )
 
-def _run_server(queue, filename, build_func, *build_args):
+    def test_pack_private_request(self):
+        s = Signer()
+        requests = [s.sign(random_digest()) for i in range(MAX_BATCH)]
+        for count in [1, 2, MAX_BATCH]:
+            data = b''.join(requests[:count])
+            for chain in [None, 'default']:
+                msg = ipc.pack_private_request(requests[:count], chain)
+                self.assertEqual(msg, data)
+                self.assertEqual(ipc.unpack_private_request(msg),
+                    ('default', requests[:count])
+                )
+            msg = ipc.pack_private_request(requests[:count], 'tenant-a')
+            self.assertEqual(msg, b'\x08tenant-a' + data)
+            self.assertEqual(ipc.unpack_private_request(msg),
+                ('tenant-a', requests[:count])
+            )
+            msg = ipc.pack_private_request(requests[:count], 'x' * 20)
+            self.assertEqual(len(msg), ipc.MAX_CHAIN_FIELD + len(data))
+            self.assertEqual(ipc.unpack_private_request(memoryview(msg)),
+                ('x' * 20, requests[:count])
+            )
+        for msg in [b'', b'\x08tenant-a', requests[0][:-1],
+                b''.join(requests) + requests[0]]:
+            with self.assertRaises(ValueError) as cm:
+                ipc.unpack_private_request(msg)
+            self.assertEqual(str(cm.exception),
+                'bad request: expected 1 to 8 times 224 bytes; got {}'.format(
+                    len(msg) - (9 if msg.startswith(b'\x08t') else 0)
+                )
+            )
+        with self.assertRaises(ValueError) as cm:
+            ipc.unpack_private_request(b'\x02..' + requests[0])
+        self.assertEqual(str(cm.exception), "bad chain name: '..'")
+        with self.assertRaises(ValueError):
+            ipc.unpack_private_request(b'\x01\xff' + requests[0])
+
+    def test_open_activated_socket(self):
+        for sock_type in [socket.SOCK_STREAM, socket.SOCK_SEQPACKET]:
+            tmp = TempDir()
+            listener = socket.socket(socket.AF_UNIX, sock_type)
+            listener.bind(tmp.join('test.socket'))
+            try:
+                sock = ipc.open_activated_socket(listener.fileno())
+                self.assertEqual(sock.type, sock_type)
+                self.assertEqual(sock.family, socket.AF_UNIX)
+                sock.close()
+            finally:
+                listener.close()
+
+    def test_parse_client_request(self):
+        digest = random_digest()
+        self.assertEqual(ipc.parse_client_request(digest), (digest, 0, None))
+        self.assertEqual(ipc.parse_client_request(digest, 1),
+            (digest, 1, None)
+        )
+        for p in [0, 1]:
+            self.assertEqual(
+                ipc.parse_client_request(digest + bytes([p])), (digest, p, None)
+            )
+        with self.assertRaises(ValueError) as cm:
+            ipc.parse_client_request(digest + b'\x02')
+        self.assertEqual(str(cm.exception), 'bad priority: 2')
+        for size in [0, 47, 50, 56, 58]:
+            with self.assertRaises(ValueError) as cm:
+                ipc.parse_client_request(os.urandom(size))
+            self.assertEqual(str(cm.exception),
+                'bad request: expected 48, 49 or 57 bytes; got {}'.format(size)
+            )
+
+        # With a deadline:
+        request = ipc.build_client_request(digest, 1, 1234.5)
+        self.assertEqual(len(request), 57)
+        self.assertEqual(ipc.parse_client_request(request),
+            (digest, 1, 1234.5)
+        )
+        request = ipc.build_client_request(digest, deadline=1234.5)
+        self.assertEqual(request[48], ipc.DEFAULT_PRIORITY)
+        self.assertEqual(ipc.parse_client_request(request, 1),
+            (digest, 1, 1234.5)
+        )
+        self.assertEqual(ipc.build_client_request(digest), digest)
+        self.assertEqual(ipc.build_client_request(digest, 0),
+            digest + b'\x00'
+        )
+
+    def test_peer_closed(self):
+        (a, b) = socket.socketpair()
+        try:
+            self.assertFalse(ipc.peer_closed(a))
+            b.sendall(b'x')
+            self.assertFalse(ipc.peer_closed(a))
+            # Done sending, but still waiting for the response:
+            b.shutdown(socket.SHUT_WR)
+            self.assertEqual(a.recv(1), b'x')
+            self.assertEqual(a.recv(1), b'')
+            self.assertFalse(ipc.peer_closed(a))
+            b.close()
+            self.assertTrue(ipc.peer_closed(a))
+        finally:
+            a.close()
+
+
+def _run_server(queue, filename, sock_type, build_func, *build_args):
     try:
-        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        sock = socket.socket(socket.AF_UNIX, sock_type)
         sock.bind(filename)
         sock.listen(5)
         server = build_func(sock, *build_args)
@@ -231,12 +724,12 @@ def _run_server(queue, filename, build_func, *build_args):
         raise e
 
 
-def _start_server(filename, build_func, *build_args):
+def _start_server(filename, sock_type, build_func, *build_args):
     import multiprocessing
     queue = multiprocessing.Queue()
     process = multiprocessing.Process(
         target=_run_server,
-        args=(queue, filename, build_func) + build_args,
+        args=(queue, filename, sock_type, build_func) + build_args,
         daemon=True,
     )
     process.start()
@@ -249,10 +742,12 @@ def _start_server(filename, build_func, *build_args):
 
 
 class TempServer:
-    def __init__(self, build_func, *build_args):
+    def __init__(self, build_func, *build_args, sock_type=socket.SOCK_STREAM):
         self.tmpdir = TempDir()
         self.filename = self.tmpdir.join('temp.socket')
-        self.process = _start_server(self.filename, build_func, *build_args)
+        self.process = _start_server(
+            self.filename, sock_type, build_func, *build_args
+        )
 
     def __del__(self):
         self.terminate()
@@ -266,6 +761,13 @@ class TempServer:
 def _build_private_server(sock):
     return ipc.PrivateServer(sock, MockDisplayClient(), Signer())
 
+
+def _build_rotating_private_server(sock):
+    server = _build_private_server(sock)
+    signal.signal(signal.SIGUSR1, lambda signum, frame: server.request_rotate())
+    return server
+
+
 class MockSerialClient:
     def __init__(self):
         self._signer = Signer()
@@ -273,11 +775,23 @@ class MockSerialClient:
     def make_request(self, request):
         return self._signer.sign(request)
 
+    def ping(self):
+        return Status(bytes(16), self._signer.public, self._signer.tail,
+            self._signer.counter, 0
+        )
+
+    def make_requests(self, requests, deadline=None, batch=False):
+        return [self.make_request(r) for r in requests]
+
 
 def _build_client_server(sock):
     return ipc.ClientServer(sock, MockSerialClient(), Signer())
 
 
+def _build_scheduled_client_server(sock):
+    return ipc.ScheduledClientServer([sock], MockSerialClient(), Signer())
+
+
 class TestLiveIPC(TestCase):
     def test_private_ipc(self):
         server = TempServer(_build_private_server)        
@@ -301,6 +815,39 @@ class TestLiveIPC(TestCase):
         self.assertNotEqual(b1[:176], b2[:176])
         self.assertEqual(verify.get_pubkey(b1), verify.get_pubkey(b2))
 
+    def test_private_ipc_rotate(self):
+        server = TempServer(_build_rotating_private_server)
+        client = ipc.PrivateClient(server.filename)
+        s = Signer()
+        first = client.make_request(s.sign(random_digest()))
+        os.kill(server.process.pid, signal.SIGUSR1)
+        # Requests are served throughout; the rotation lands between two:
+        responses = []
+        for i in range(100):
+            response = client.make_request(s.sign(random_digest()))
+            if verify.get_pubkey(response) != verify.get_pubkey(first):
+                break
+            responses.append(response)
+            time.sleep(ipc.ROTATE_POLL / 20)
+        else:
+            self.fail('key never rotated')
+        self.assertEqual(verify.get_counter(response), 1)
+        self.assertEqual(
+            [verify.get_counter(r) for r in responses],
+            list(range(2, len(responses) + 2))
+        )
+    def test_private_ipc_batch_stream(self):
+        # No message boundaries, so it's a connection per request:
+        server = TempServer(_build_private_server)
+        client = ipc.PrivateClient(server.filename)
+        s = Signer()
+        requests = [s.sign(random_digest()) for i in range(3)]
+        responses = client.make_requests(requests)
+        self.assertEqual(client.sock_type, socket.SOCK_STREAM)
+        self.assertEqual([verify.get_counter(r) for r in responses], [1, 2, 3])
+        for (request, response) in zip(requests, responses):
+            self.assertEqual(response[176:], request)
+
     def test_request_ipc(self):
         server = TempServer(_build_client_server)        
         client = ipc.ClientClient(server.filename)
@@ -309,4 +856,54 @@ class TestLiveIPC(TestCase):
             response = client.make_request(digest)
             self.assertTrue(response.endswith(digest))
 
+    def test_seqpacket_ipc(self):
+        server = TempServer(_build_private_server,
+            sock_type=socket.SOCK_SEQPACKET
+        )
+        client = ipc.PrivateClient(server.filename)
+        self.assertIsNone(client.sock_type)
+        s = Signer()
+        for i in range(1, 21):
+            a = s.sign(random_digest())
+            b = client.make_request(a)
+            self.assertEqual(b[176:], a)
+            self.assertEqual(verify.get_counter(b), i)
+        self.assertEqual(client.sock_type, socket.SOCK_SEQPACKET)
+
+        # A batch in one message, signed as consecutive nodes:
+        for count in [1, 2, MAX_BATCH]:
+            requests = [s.sign(random_digest()) for j in range(count)]
+            responses = client.make_requests(requests)
+            self.assertEqual(len(responses), count)
+            for (request, response) in zip(requests, responses):
+                self.assertEqual(response[176:], request)
+                self.assertEqual(verify.get_counter(response), i + 1)
+                i += 1
+
+        # Stream server, auto-detected:
+        server = TempServer(_build_client_server)
+        client = ipc.ClientClient(server.filename)
+        digest = random_digest()
+        self.assertTrue(client.make_request(digest).endswith(digest))
+        self.assertEqual(client.sock_type, socket.SOCK_STREAM)
+
+        # Scheduled server over SOCK_SEQPACKET:
+        server = TempServer(_build_scheduled_client_server,
+            sock_type=socket.SOCK_SEQPACKET
+        )
+        client = ipc.ClientClient(server.filename, socket.SOCK_SEQPACKET)
+        for priority in [None, 0, 1]:
+            digest = random_digest()
+            response = client.make_request(digest, priority)
+            self.assertTrue(response.endswith(digest))
+
+    def test_scheduled_request_ipc(self):
+        server = TempServer(_build_scheduled_client_server)
+        client = ipc.ClientClient(server.filename)
+        for i in range(20):
+            for priority in [None, 0, 1]:
+                digest = random_digest()
+                response = client.make_request(digest, priority)
+                self.assertTrue(response.endswith(digest))
+
 
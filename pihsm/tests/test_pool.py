@@ -0,0 +1,191 @@
+# pihsm: Turn your Raspberry Pi into a Hardware Security Module 
+# Copyright (C) 2017 System76, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from unittest import TestCase
+
+from .helpers import random_digest
+from ..serial import Status
+from ..sign import Signer
+from .. import pool
+
+
+def build_pool(*names, retry_interval=pool.RETRY_INTERVAL):
+    return pool.DevicePool(
+        [pool.Device(name, None, None) for name in names], retry_interval
+    )
+
+
+class TestDevice(TestCase):
+    def test_init(self):
+        d = pool.Device('/dev/ttyUSB0', 'client', 'signer')
+        self.assertEqual(d.name, '/dev/ttyUSB0')
+        self.assertEqual(d.serial_client, 'client')
+        self.assertEqual(d.signer, 'signer')
+        self.assertIsNone(d.public)
+        self.assertFalse(d.down)
+        self.assertIsNone(d.status)
+        self.assertEqual(d.stats(), {
+            'public': None,
+            'load': 0,
+            'signed': 0,
+            'failures': 0,
+            'healthy': True,
+            'down': False,
+            'counter': None,
+        })
+
+    def test_available(self):
+        d = pool.Device('a', None, None)
+        self.assertTrue(d.available(0))
+        d.retry_at = 10
+        self.assertFalse(d.available(9.9))
+        self.assertTrue(d.available(10))
+
+
+class TestDevicePool(TestCase):
+    def test_init(self):
+        p = build_pool('a', 'b')
+        self.assertEqual(len(p), 2)
+        self.assertEqual([d.name for d in p.devices], ['a', 'b'])
+        self.assertEqual(p.retry_interval, pool.RETRY_INTERVAL)
+        with self.assertRaises(AssertionError):
+            build_pool()
+        with self.assertRaises(AssertionError):
+            build_pool('a', 'a')
+
+    def test_acquire(self):
+        p = build_pool('a', 'b', 'c')
+        (a, b, c) = p.devices
+        self.assertIs(p.acquire(8, now=0), a)
+        self.assertIs(p.acquire(2, now=0), b)
+        self.assertIs(p.acquire(4, now=0), c)
+        self.assertIs(p.acquire(1, now=0), b)
+        self.assertEqual([d.load for d in p.devices], [8, 3, 4])
+        self.assertIs(p.acquire(1, exclude=[b], now=0), c)
+
+        # Failed devices are skipped while any other is in rotation:
+        p = build_pool('a', 'b', 'c', retry_interval=10)
+        (a, b, c) = p.devices
+        p.release(p.acquire(now=0), 1, now=0)
+        p.release(p.acquire(now=1), 1, now=1)
+        self.assertEqual((a.retry_at, b.retry_at), (10, 11))
+        self.assertIs(p.acquire(5, now=2), c)
+        self.assertIs(p.acquire(now=2), c)
+        # Then the one due first, even when busier:
+        self.assertIs(p.acquire(now=2, exclude=[c]), a)
+        self.assertIs(p.acquire(now=2, exclude=[c]), a)
+        # And again by load once it's due:
+        self.assertIs(p.acquire(now=11, exclude=[c]), b)
+
+    def test_release(self):
+        p = build_pool('a', retry_interval=5)
+        d = p.acquire(3, now=0)
+        p.release(d, 3, now=1)
+        self.assertEqual(d.load, 0)
+        self.assertEqual(d.failures, 1)
+        self.assertEqual(d.retry_at, 6)
+        self.assertFalse(d.stats()['healthy'])
+
+        signer = Signer()
+        responses = [signer.sign(random_digest()) for i in range(3)]
+        d = p.acquire(3, now=7)
+        p.release(d, 3, responses)
+        self.assertEqual(d.load, 0)
+        self.assertEqual(d.signed, 3)
+        self.assertEqual(d.failures, 1)
+        self.assertIsNone(d.retry_at)
+        self.assertEqual(d.public, signer.public)
+        self.assertTrue(d.stats()['healthy'])
+
+    def test_check(self):
+        p = build_pool('a', 'b', retry_interval=10)
+        (a, b) = p.devices
+        status = Status(bytes(16), bytes(32), bytes(64), 7, 0)
+        p.check(a, status, now=0)
+        self.assertIs(a.status, status)
+        self.assertFalse(a.down)
+        self.assertEqual(a.stats()['counter'], 7)
+
+        p.check(a, None, now=1)
+        self.assertTrue(a.down)
+        self.assertEqual(a.retry_at, 11)
+        self.assertEqual(a.failures, 1)
+        self.assertIs(p.acquire(now=2), b)
+
+        # With every device out of rotation and one down, fail at once:
+        p.release(b, 1, now=2)
+        with self.assertRaises(pool.NoDevice) as cm:
+            p.acquire(now=3)
+        self.assertEqual(str(cm.exception), 'all 2 devices are down')
+        self.assertEqual((a.load, b.load), (0, 0))
+
+        # Until one answers again:
+        p.check(b, status, now=4)
+        self.assertIs(p.acquire(now=4), b)
+        self.assertEqual(p.idle(), [a])
+        self.assertIs(p.acquire(now=11), a)
+        self.assertEqual(p.idle(), [])
+
+        # A signed batch brings a device back up too:
+        p.release(a, 1, [Signer().sign(random_digest())])
+        self.assertFalse(a.down)
+
+    def test_bench(self):
+        p = build_pool('a', 'b', retry_interval=5)
+        (a, b) = p.devices
+        self.assertEqual(p.retry_interval, 5)
+        # Each failure in a row doubles the interval, up to RETRY_MAX:
+        self.assertEqual(
+            [p.bench(a, 0) for i in range(6)], [5, 10, 20, 40, 60, 60]
+        )
+        self.assertEqual((a.failures, a.strikes, a.retry_at), (6, 6, 60))
+        p.release(p.acquire(now=0), 1, now=1)
+        self.assertEqual((b.strikes, b.retry_at), (1, 6))
+
+        # While a success starts it over:
+        p.release(a, 0, [])
+        self.assertEqual(a.strikes, 0)
+        p.release(p.acquire(now=2, exclude=[b]), 1, now=2)
+        self.assertEqual(a.retry_at, 7)
+        p.check(a, Status(bytes(16), bytes(32), bytes(64), 0, 0), now=3)
+        self.assertEqual(a.strikes, 0)
+        p.check(a, None, now=3)
+        self.assertEqual(a.retry_at, 8)
+
+    def test_single(self):
+        # With nowhere else to go, a lone device that's down is still tried:
+        p = build_pool('a', retry_interval=10)
+        (a,) = p.devices
+        p.check(a, None, now=0)
+        self.assertTrue(a.down)
+        self.assertIs(p.acquire(now=1), a)
+        self.assertEqual(a.load, 1)
+
+    def test_find(self):
+        p = build_pool('a', 'b')
+        signers = (Signer(), Signer())
+        for (device, signer) in zip(p.devices, signers):
+            p.release(device, 0, [signer.sign(random_digest())])
+        for (device, signer) in zip(p.devices, signers):
+            self.assertIs(p.find(signer.sign(random_digest())), device)
+        self.assertIsNone(p.find(Signer().sign(random_digest())))
+
+    def test_stats(self):
+        p = build_pool('a', 'b')
+        p.acquire(2)
+        self.assertEqual(sorted(p.stats()), ['a', 'b'])
+        self.assertEqual(p.stats()['a']['load'], 2)
+        self.assertEqual(p.stats()['b']['load'], 0)
@@ -0,0 +1,180 @@
+# pihsm: Turn your Raspberry Pi into a Hardware Security Module 
+# Copyright (C) 2017 System76, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from unittest import TestCase
+import os
+import socket
+
+from .helpers import random_digest
+from .. import schedule
+
+
+class TestFunctions(TestCase):
+    def test_get_peercred(self):
+        (a, b) = socket.socketpair(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.assertEqual(schedule.get_peercred(a),
+                (os.getpid(), os.getuid(), os.getgid())
+            )
+        finally:
+            a.close()
+            b.close()
+
+    def test_percentile(self):
+        self.assertIsNone(schedule.percentile([], 50))
+        ordered = list(range(1, 101))
+        self.assertEqual(schedule.percentile(ordered, 50), 50)
+        self.assertEqual(schedule.percentile(ordered, 99), 99)
+        self.assertEqual(schedule.percentile(ordered, 100), 100)
+        self.assertEqual(schedule.percentile([7], 1), 7)
+        self.assertEqual(schedule.percentile([7], 99), 7)
+        self.assertEqual(schedule.percentile([1, 2, 3], 50), 2)
+
+
+class TestQueueFull(TestCase):
+    def test_init(self):
+        e = schedule.QueueFull(1, 17)
+        self.assertEqual(e.priority, 1)
+        self.assertEqual(e.size, 17)
+        self.assertEqual(str(e), 'bulk queue is full (17 requests)')
+
+
+class TestDeadlineExpired(TestCase):
+    def test_init(self):
+        e = schedule.DeadlineExpired(3)
+        self.assertEqual(e.count, 3)
+        self.assertEqual(str(e), 'deadline passed with 3 requests unsigned')
+
+
+class TestJob(TestCase):
+    def test_expired(self):
+        job = schedule.Job(None, random_digest(), 0)
+        self.assertIsNone(job.deadline)
+        self.assertFalse(job.expired(1e9))
+        job = schedule.Job(None, random_digest(), 0, deadline=10.0)
+        self.assertFalse(job.expired(9.9))
+        self.assertTrue(job.expired(10.0))
+
+    def test_latest_deadline(self):
+        jobs = [
+            schedule.Job(None, random_digest(), 0, deadline=d)
+            for d in [3.0, 7.0, 5.0]
+        ]
+        self.assertEqual(schedule.latest_deadline(jobs), 7.0)
+        jobs.append(schedule.Job(None, random_digest(), 0))
+        self.assertIsNone(schedule.latest_deadline(jobs))
+
+
+class TestLatencyStats(TestCase):
+    def test_add(self):
+        stats = schedule.LatencyStats(10)
+        self.assertEqual(stats.percentiles(50, 99), (None, None))
+        for i in range(20):
+            stats.add(float(i))
+        self.assertEqual(stats.count, 20)
+        self.assertEqual(len(stats.samples), 10)
+        self.assertEqual(stats.percentiles(50, 99), (14.0, 19.0))
+
+
+def _job(priority, uid):
+    return schedule.Job(None, random_digest(), priority, uid=uid)
+
+
+class TestScheduler(TestCase):
+    def test_init(self):
+        s = schedule.Scheduler()
+        self.assertEqual(s.max_queue, 32)
+        self.assertEqual(len(s), 0)
+        self.assertIsNone(s.next(timeout=0))
+
+    def test_priority(self):
+        s = schedule.Scheduler()
+        bulk = [_job(1, 1000) for i in range(3)]
+        interactive = [_job(0, 1001) for i in range(2)]
+        for job in bulk + interactive:
+            s.submit(job)
+        self.assertEqual(len(s), 5)
+        self.assertEqual(
+            [s.next(timeout=0) for i in range(5)],
+            interactive + bulk
+        )
+        self.assertIsNone(s.next(timeout=0))
+
+    def test_fair_share(self):
+        s = schedule.Scheduler()
+        a = [_job(1, 1000) for i in range(4)]
+        b = [_job(1, 1001) for i in range(2)]
+        c = [_job(1, 1002)]
+        for job in a + b + c:
+            s.submit(job)
+        self.assertEqual(
+            [s.next(timeout=0) for i in range(7)],
+            [a[0], b[0], c[0], a[1], b[1], a[2], a[3]]
+        )
+
+    def test_take(self):
+        s = schedule.Scheduler()
+        self.assertEqual(s.take(8), [])
+        bulk = [_job(1, 1000) for i in range(3)]
+        interactive = [_job(0, 1001) for i in range(2)]
+        for job in bulk + interactive:
+            s.submit(job)
+        self.assertEqual(s.take(4), interactive + bulk[:2])
+        self.assertEqual(s.take(4), bulk[2:])
+        self.assertEqual(len(s), 0)
+
+    def test_submit_full(self):
+        s = schedule.Scheduler(2)
+        s.submit(_job(1, 1000))
+        s.submit(_job(1, 1000))
+        with self.assertRaises(schedule.QueueFull) as cm:
+            s.submit(_job(1, 1001))
+        self.assertEqual(cm.exception.priority, 1)
+        self.assertEqual(s.rejected, [0, 1])
+
+        # Other classes have their own bound:
+        s.submit(_job(0, 1000))
+        self.assertEqual(len(s), 3)
+
+    def test_done(self):
+        s = schedule.Scheduler()
+        job = schedule.Job(None, random_digest(), 0, received=10.0)
+        s.done(job, 10.5)
+        stats = s.stats()
+        self.assertEqual(stats['interactive'], {
+            'queued': 0,
+            'served': 1,
+            'rejected': 0,
+            'expired': 0,
+            'abandoned': 0,
+            'p50': 0.5,
+            'p90': 0.5,
+            'p99': 0.5,
+        })
+        self.assertEqual(stats['bulk']['served'], 0)
+        self.assertIsNone(s.log_latency(0))
+
+    def test_drop(self):
+        s = schedule.Scheduler()
+        s.drop(_job(0, 1000))
+        s.drop(_job(1, 1000))
+        s.drop(_job(1, 1000), abandoned=True)
+        self.assertEqual(s.expired, [1, 1])
+        self.assertEqual(s.abandoned, [0, 1])
+        stats = s.stats()
+        self.assertEqual(stats['bulk']['expired'], 1)
+        self.assertEqual(stats['bulk']['abandoned'], 1)
+        self.assertEqual(stats['bulk']['served'], 0)
@@ -16,11 +16,31 @@
 
 
 from unittest import TestCase
+from os import path
+import io
+import json
 import os
+import random
+import time
 
-from .helpers import iter_permutations, random_id, random_digest
+from nacl.signing import SigningKey
+
+from .helpers import iter_permutations, random_id, random_digest, TempDir
+from ..schedule import DeadlineExpired
 from ..sign import Signer
-from .. import common, serial
+from ..verify import isvalid
+from .. import capture, common, serial, wire
+
+
+def frame(ftype, seq, payload):
+    return wire.pack_frame(ftype, seq, payload)
+
+
+def reads(ftype, seq, payload):
+    # A frame as MockSerial returns it, header and the rest in separate reads:
+    f = frame(ftype, seq, payload)
+    size = len(wire.MAGIC) + wire.HEADER.size
+    return [f[:size], f[size:]]
 
 
 class MockSerialOpen:
@@ -33,11 +53,25 @@ class MockSerial:
     def __init__(self, *returns):
         self._returns = list(returns)
         self._calls = []
+        self.baudrate = common.SERIAL_BAUDRATE
+        self.timeout = common.SERIAL_TIMEOUT
 
     def read(self, size):
         self._calls.append(('read', size))
         return self._returns.pop(0)
 
+    def readinto(self, buf):
+        self._calls.append(('readinto', len(buf)))
+        data = self._returns.pop(0)
+        if isinstance(data, Exception):
+            raise data
+        data = data[:len(buf)]
+        buf[0:len(data)] = data
+        return len(data)
+
+    def close(self):
+        self._calls.append('close')
+
     def write(self, msg):
         self._calls.append(('write', msg))
         return len(msg)
@@ -45,9 +79,6 @@ class MockSerial:
     def flush(self):
         self._calls.append('flush')
 
-    def reset_input_buffer(self):
-        self._calls.append('reset_input_buffer')
-
 
 class MockSerialFactory:
     def __init__(self, port, *returns):
@@ -67,6 +98,74 @@ class MockSerialFactory:
         return self._returns.pop(0)
 
 
+class LinkEnd:
+    # One end of an in-memory serial link.  Bytes written while the two ends
+    # disagree on baudrate, or above the link's max_baudrate, arrive garbled.
+    # A read on an empty inbox first lets the other end run *step*.
+
+    def __init__(self, link, step=None):
+        self.link = link
+        self.step = step
+        self.peer = None
+        self.inbox = bytearray()
+        self.baudrate = common.SERIAL_BAUDRATE
+        self.timeout = common.SERIAL_TIMEOUT
+        self.closed = False
+
+    def write(self, data):
+        if self.baudrate != self.peer.baudrate or \
+                self.baudrate > self.link.max_baudrate:
+            data = os.urandom(len(data))
+        self.peer.inbox += data
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def readinto(self, buf):
+        if not self.inbox and self.step is not None:
+            self.step()
+        size = min(len(buf), len(self.inbox))
+        buf[0:size] = self.inbox[:size]
+        del self.inbox[:size]
+        return size
+
+    def read(self, size):
+        buf = bytearray(size)
+        return bytes(buf[:self.readinto(buf)])
+
+    def close(self):
+        self.closed = True
+
+
+class Link:
+    def __init__(self, max_baudrate=common.SERIAL_BAUDRATES[-1]):
+        self.max_baudrate = max_baudrate
+        self.client = LinkEnd(self)
+        self.server = LinkEnd(self)
+        self.client.peer = self.server
+        self.server.peer = self.client
+
+    def factory(self, end):
+        def open_end(port, **kw):
+            return end
+        return open_end
+
+
+def connect_link(link, private_client=None):
+    server = serial.SerialServer(private_client, 'server',
+        link.factory(link.server)
+    )
+    def step():
+        # The server keeps up with whatever the client has written so far:
+        server.serve_once()
+        while link.server.inbox:
+            server.serve_once()
+    link.client.step = step
+    client = serial.SerialClient('client', link.factory(link.client))
+    return (client, server)
+
+
 class MockClient:
     def __init__(self, *returns):
         self._returns = list(returns)
@@ -76,6 +175,9 @@ class MockClient:
         self._calls.append(request)
         return self._returns.pop(0)
 
+    def make_requests(self, requests):
+        return [self.make_request(r) for r in requests]
+
 
 class TestFunctions(TestCase):
     def test_open_serial(self):
@@ -88,39 +190,223 @@ class TestFunctions(TestCase):
                 'timeout': common.SERIAL_TIMEOUT,
             })
 
-    def test_read_serial(self):
-        for size in [224, 400]:
-
-            # Size doesn't match (should return None):
-            for d in [-1, 1]:
-                msg = os.urandom(size + d)
-                ttl = MockSerial(msg)
-                self.assertIsNone(serial.read_serial(ttl, size))
-                self.assertEqual(ttl._calls,
-                    [('read', size), 'reset_input_buffer']
-                )
-
-            # Signature isn't good (should return None):
-            msg = os.urandom(size)
-            ttl = MockSerial(msg)
-            self.assertIsNone(serial.read_serial(ttl, size))
-            self.assertEqual(ttl._calls, [('read', size)])
-
-            # Good signature:
-            s = Signer()
-            msg = os.urandom(size - 176)
-            signed = s.sign(msg)
-            self.assertEqual(len(signed), size)
-            ttl = MockSerial(signed)
-            self.assertEqual(serial.read_serial(ttl, size), signed)
-            self.assertEqual(ttl._calls, [('read', size)])
-
-            # Should fail on all 1-bit permutations:
-            for p in iter_permutations(signed):
-                ttl = MockSerial(p)
-                self.assertEqual(len(p), size)
-                self.assertIsNone(serial.read_serial(ttl, size))
-                self.assertEqual(ttl._calls, [('read', size)])
+    def test_build_baudrate_frame(self):
+        key = SigningKey.generate()
+        for rate in common.SERIAL_BAUDRATES:
+            frame = serial.build_baudrate_frame(key, rate)
+            self.assertEqual(len(frame), common.REQUEST)
+            self.assertTrue(isvalid(frame))
+            self.assertEqual(frame[64:96], bytes(key.verify_key))
+            self.assertEqual(frame[96:112], serial.BAUDRATE_MAGIC)
+            self.assertEqual(serial.parse_baudrate_frame(frame), rate)
+            self.assertNotEqual(serial.build_baudrate_frame(key, rate), frame)
+        nonce = os.urandom(serial.BAUDRATE_NONCE)
+        self.assertEqual(
+            serial.build_baudrate_frame(key, 115200, nonce),
+            serial.build_baudrate_frame(key, 115200, nonce),
+        )
+
+    def test_parse_baudrate_frame(self):
+        s = Signer()
+        request = s.sign(random_digest())
+        self.assertIsNone(serial.parse_baudrate_frame(request))
+        self.assertIsNone(serial.parse_baudrate_frame(os.urandom(400)))
+
+    def test_build_status_frame(self):
+        key = SigningKey.generate()
+        nonce = os.urandom(wire.PING_NONCE)
+        frame = serial.build_status_frame(key, nonce, timestamp=1234)
+        self.assertEqual(len(frame), common.REQUEST)
+        self.assertTrue(isvalid(frame))
+        self.assertEqual(frame[64:96], bytes(key.verify_key))
+        self.assertEqual(serial.parse_status_frame(frame),
+            serial.Status(nonce, bytes(32), bytes(64), 0, 1234)
+        )
+
+        s1 = Signer()
+        s2 = Signer()
+        s2.sign(s1.sign(random_digest()))
+        response = s2.sign(s1.sign(random_digest()))
+        frame = serial.build_status_frame(key, nonce, response)
+        self.assertTrue(isvalid(frame))
+        status = serial.parse_status_frame(frame)
+        self.assertEqual(status.nonce, nonce)
+        self.assertEqual(status.public, s2.public)
+        self.assertEqual(status.tail, common.get_signature(response))
+        self.assertEqual(status.counter, 2)
+        self.assertGreater(status.timestamp, 0)
+
+    def test_load_status_key(self):
+        tmp = TempDir()
+        filename = tmp.join('status.key')
+        key = serial.load_status_key(filename)
+        self.assertIsInstance(key, SigningKey)
+        self.assertEqual(open(filename, 'rb').read(), bytes(key))
+        self.assertEqual(os.stat(filename).st_mode & 0o777, 0o600)
+
+        # The same key after a restart:
+        self.assertEqual(bytes(serial.load_status_key(filename)), bytes(key))
+
+        with open(filename, 'wb') as fp:
+            fp.write(bytes(31))
+        with self.assertRaises(ValueError) as cm:
+            serial.load_status_key(filename)
+        self.assertEqual(str(cm.exception),
+            'status key: bad size 31 in {!r}'.format(filename)
+        )
+
+    def test_read_frame_counters(self):
+        counters = serial.new_counters()
+        self.assertEqual(counters, {
+            'short_reads': 0,
+            'resyncs': 0,
+            'bad_frames': 0,
+            'bad_signatures': 0,
+            'io_errors': 0,
+            'fallbacks': 0,
+        })
+        decoder = wire.FrameDecoder()
+        ttl = MockSerial(wire.MAGIC + bytes(5), b'')
+        self.assertIsNone(serial.read_frame(ttl, decoder, None, counters))
+        self.assertEqual(counters['bad_frames'], 1)
+        ttl = MockSerial(b'')
+        self.assertIsNone(serial.read_frame(ttl, decoder, None, counters))
+        self.assertEqual(counters['short_reads'], 0)
+        (header, rest) = reads(wire.FULL_REQUEST, 0, os.urandom(224))
+        ttl = MockSerial(header, rest[:100], b'')
+        self.assertIsNone(serial.read_frame(ttl, decoder, None, counters))
+        self.assertEqual(counters['short_reads'], 1)
+        self.assertEqual(len(decoder), 0)
+        ttl = MockSerial(header, bytes(len(rest)), b'')
+        self.assertIsNone(serial.read_frame(ttl, decoder, None, counters))
+        self.assertEqual(counters['bad_frames'], 2)
+        self.assertEqual(counters['short_reads'], 1)
+
+    def test_read_frame(self):
+        # Nothing read (timeout):
+        ttl = MockSerial(b'')
+        self.assertIsNone(serial.read_frame(ttl, wire.FrameDecoder()))
+        self.assertEqual(ttl._calls, [('readinto', 7)])
+
+        # Bad header (version, type, then length):
+        for header in [b'\x01\x00\x00\xe0\x00', b'\x3f\x00\x00\xe0\x00',
+                b'\x31\x00\x00\xe1\x00']:
+            ttl = MockSerial(wire.MAGIC + header, b'')
+            self.assertIsNone(serial.read_frame(ttl, wire.FrameDecoder()))
+            self.assertEqual(ttl._calls, [('readinto', 7), ('readinto', 7)])
+
+        for (ftype, size) in sorted(wire.PAYLOAD_SIZES.items()):
+            seq = random.randint(0, wire.SEQ_MASK)
+            payload = os.urandom(size)
+            (header, rest) = reads(ftype, seq, payload)
+
+            # Cut short by the timeout (should return None):
+            ttl = MockSerial(header, rest[:-1], b'')
+            self.assertIsNone(serial.read_frame(ttl, wire.FrameDecoder()))
+            self.assertEqual(ttl._calls,
+                [('readinto', 7), ('readinto', size + 4), ('readinto', 1)]
+            )
+
+            ttl = MockSerial(header, rest)
+            self.assertEqual(serial.read_frame(ttl, wire.FrameDecoder()),
+                (ftype, seq, payload)
+            )
+            self.assertEqual(ttl._calls,
+                [('readinto', 7), ('readinto', size + 4)]
+            )
+
+            # Into a reusable buffer:
+            buf = bytearray(wire.MAX_FRAME)
+            ttl = MockSerial(header, rest)
+            self.assertEqual(serial.read_frame(ttl, wire.FrameDecoder(), buf),
+                (ftype, seq, payload)
+            )
+            self.assertEqual(bytes(buf[:size + 4]), rest)
+
+    def test_read_frame_resync(self):
+        # Junk and a corrupt frame cost nothing but their own bytes:
+        frames = [(wire.NEED_FULL, seq, os.urandom(64)) for seq in range(3)]
+        packed = [frame(*f) for f in frames]
+        bad = bytearray(packed[1])
+        bad[20] ^= 1
+        ttl = LinkEnd(None)
+        ttl.inbox += b'\x00junk' + packed[0] + bytes(bad) + packed[2]
+        decoder = wire.FrameDecoder()
+        counters = serial.new_counters()
+        self.assertEqual(serial.read_frame(ttl, decoder, None, counters),
+            frames[0]
+        )
+        self.assertEqual(serial.read_frame(ttl, decoder, None, counters),
+            frames[2]
+        )
+        self.assertIsNone(serial.read_frame(ttl, decoder, None, counters))
+        self.assertEqual(counters['bad_frames'], 1)
+        self.assertEqual(counters['resyncs'], 2)
+        self.assertEqual(counters['short_reads'], 0)
+        self.assertEqual(decoder.discarded, 5 + len(bad))
+
+    def test_check_signature(self):
+        counters = serial.new_counters()
+        s = Signer()
+        signed = s.sign(random_digest())
+        self.assertIs(serial.check_signature(signed, counters), signed)
+        self.assertEqual(counters['bad_signatures'], 0)
+
+        # Should fail on all 1-bit permutations:
+        for p in iter_permutations(signed):
+            self.assertIsNone(serial.check_signature(p))
+        self.assertIsNone(serial.check_signature(os.urandom(224), counters))
+        self.assertEqual(counters['bad_signatures'], 1)
+
+
+class TestRttEstimator(TestCase):
+    def test_init(self):
+        rtt = serial.RttEstimator()
+        self.assertEqual(rtt.stats(), {
+            'srtt': None,
+            'rttvar': None,
+            'rto': common.SERIAL_TIMEOUT,
+            'samples': 0,
+            'timeouts': 0,
+        })
+
+    def test_add(self):
+        rtt = serial.RttEstimator()
+        rtt.add(0.2)
+        self.assertEqual(rtt.srtt, 0.2)
+        self.assertEqual(rtt.rttvar, 0.1)
+        self.assertAlmostEqual(rtt.rto, 0.6)
+        rtt.add(0.2)
+        self.assertAlmostEqual(rtt.srtt, 0.2)
+        self.assertAlmostEqual(rtt.rttvar, 0.075)
+        self.assertAlmostEqual(rtt.rto, 0.5)
+        self.assertEqual(rtt.samples, 2)
+
+        # Converges on a steady link, never below RTO_MIN:
+        for i in range(100):
+            rtt.add(0.01)
+        self.assertAlmostEqual(rtt.srtt, 0.01, places=3)
+        self.assertEqual(rtt.rto, serial.RTO_MIN)
+
+        # Never above RTO_MAX:
+        rtt.add(10)
+        self.assertEqual(rtt.rto, serial.RTO_MAX)
+
+    def test_backoff(self):
+        rtt = serial.RttEstimator()
+        for i in range(20):
+            rtt.add(0.15)
+        self.assertEqual(rtt.rto, serial.RTO_MIN)
+        rtt.backoff()
+        self.assertEqual(rtt.rto, serial.RTO_MIN * 2)
+        for i in range(5):
+            rtt.backoff()
+        self.assertEqual(rtt.rto, serial.RTO_MAX)
+        self.assertEqual(rtt.timeouts, 6)
+
+        # The next sample resets it:
+        rtt.add(0.15)
+        self.assertEqual(rtt.rto, serial.RTO_MIN)
 
 
 class TestBaseSerial(TestCase):
@@ -129,6 +415,8 @@ class TestBaseSerial(TestCase):
         base = serial.BaseSerial(port)
         self.assertIs(base.port, port)
         self.assertIsNone(base.SerialClass)
+        self.assertIsNone(base.ttl)
+        self.assertEqual(base.buf, bytearray(wire.MAX_FRAME))
         sc = random_id()
         base = serial.BaseSerial(port, SerialClass=sc)
         self.assertIs(base.port, port)
@@ -147,6 +435,44 @@ class TestBaseSerial(TestCase):
             'timeout': common.SERIAL_TIMEOUT,
         })
 
+    def test_get_serial(self):
+        port = random_id()
+        ttl1 = MockSerial()
+        ttl2 = MockSerial()
+        f = MockSerialFactory(port, ttl1, ttl2)
+        base = serial.BaseSerial(port, f)
+        self.assertIs(base.get_serial(), ttl1)
+        self.assertIs(base.get_serial(), ttl1)
+        self.assertEqual(f._calls, 1)
+        self.assertIsNone(base.close_serial())
+        self.assertIsNone(base.ttl)
+        self.assertEqual(ttl1._calls, ['close'])
+        self.assertIsNone(base.close_serial())
+        self.assertIs(base.get_serial(), ttl2)
+        self.assertEqual(f._calls, 2)
+
+    def test_capture(self):
+        port = random_id()
+        ttl = MockSerial(b'abc')
+        fp = io.BytesIO()
+        base = serial.BaseSerial(port, MockSerialFactory(port, ttl),
+            capture.Capture(fp)
+        )
+        tap = base.get_serial()
+        self.assertIs(type(tap), capture.TapSerial)
+        self.assertIs(tap.ttl, ttl)
+        base.write_frame(wire.NEED_FULL, 1, bytes(64))
+        base.set_baudrate(115200)
+        buf = bytearray(8)
+        self.assertEqual(tap.readinto(buf), 3)
+        fp.seek(0)
+        self.assertEqual([r[1:] for r in capture.iter_capture(fp)], [
+            (capture.RATE, capture.rate_record(common.SERIAL_BAUDRATE)),
+            (capture.WRITE, frame(wire.NEED_FULL, 1, bytes(64))),
+            (capture.RATE, capture.rate_record(115200)),
+            (capture.READ, b'abc'),
+        ])
+
 
 class TestSerialServer(TestCase):
     def test_init(self):
@@ -163,6 +489,10 @@ class TestSerialServer(TestCase):
         self.assertIs(server.port, port)
         self.assertIs(server.SerialClass, sc)
 
+        key = SigningKey.generate()
+        server = serial.SerialServer(client, port, status_key=key)
+        self.assertIs(server.key, key)
+
     def test_handle_request(self):
         signed1 = os.urandom(common.RESPONSE)
         client = MockClient(signed1)
@@ -172,6 +502,369 @@ class TestSerialServer(TestCase):
         self.assertIs(server.handle_request(request1), signed1)
         self.assertEqual(client._calls, [request1])
 
+    def test_serve_once(self):
+        s1 = Signer()
+        s2 = Signer()
+        request = s1.sign(random_digest())
+        response = s2.sign(request)
+        port = random_id()
+        ttl = MockSerial(b'', *reads(wire.FULL_REQUEST, 9, request), b'')
+        f = MockSerialFactory(port, ttl)
+        client = MockClient(response)
+        server = serial.SerialServer(client, port, f)
+        for i in range(3):
+            self.assertIsNone(server.serve_once())
+        self.assertEqual(f._calls, 1)
+        self.assertEqual(client._calls, [request])
+        self.assertEqual(ttl._calls, [
+            ('readinto', 7),
+            ('readinto', 7),
+            ('readinto', common.REQUEST + 4),
+            ('write',
+                frame(wire.RESPONSE_PREFIX, 9, response[:common.PREFIX])
+            ),
+            'flush',
+            ('readinto', 7),
+        ])
+        self.assertEqual(list(server.known), [request])
+        self.assertEqual(server.expected, 10)
+
+        # Port is only reopened after an error:
+        ttl1 = MockSerial(OSError('gone'))
+        ttl2 = MockSerial(b'')
+        f = MockSerialFactory(port, ttl1, ttl2)
+        server = serial.SerialServer(MockClient(), port, f)
+        server.serve_once()
+        self.assertIsNone(server.ttl)
+        server.serve_once()
+        self.assertIs(server.ttl, ttl2)
+        self.assertEqual(f._calls, 2)
+        self.assertEqual(ttl1._calls, [('readinto', 7), 'close'])
+
+    def test_compact_request(self):
+        s1 = Signer()
+        s2 = Signer()
+        requests = [s1.sign(random_digest()) for i in range(3)]
+        responses = [s2.sign(r) for r in requests]
+        compact = [wire.compact_request(r) for r in requests]
+        ttl = MockSerial(
+            *reads(wire.COMPACT_REQUEST, 0, compact[0]),
+            *reads(wire.FULL_REQUEST, 0, requests[0]),
+            *reads(wire.COMPACT_REQUEST, 1, compact[1]),
+            *reads(wire.COMPACT_REQUEST, 1, compact[1]),
+            *reads(wire.COMPACT_REQUEST, 2, compact[2]),
+        )
+        client = MockClient(*responses)
+        server = serial.SerialServer(client, 'server', lambda p, **kw: ttl)
+        for i in range(5):
+            server.serve_once()
+        self.assertEqual(client._calls, requests)
+        writes = [c[1] for c in ttl._calls if c[0] == 'write']
+        self.assertEqual(writes, [
+            frame(wire.NEED_FULL, 0, common.get_signature(requests[0])),
+            frame(wire.RESPONSE_PREFIX, 0, responses[0][:common.PREFIX]),
+            frame(wire.RESPONSE_PREFIX, 1, responses[1][:common.PREFIX]),
+            frame(wire.RESPONSE_PREFIX, 1, responses[1][:common.PREFIX]),
+            frame(wire.RESPONSE_PREFIX, 2, responses[2][:common.PREFIX]),
+        ])
+        self.assertEqual(list(server.known), requests[1:])
+
+        # A compact frame with a bad signature never reaches the signer:
+        bad = bytearray(compact[2])
+        bad[0] ^= 1
+        ttl = MockSerial(*reads(wire.COMPACT_REQUEST, 3, bytes(bad)))
+        server.ttl = ttl
+        server.serve_once()
+        self.assertEqual(len(client._calls), 3)
+        self.assertEqual(ttl._calls[-2:], [
+            ('write', frame(wire.NEED_FULL, 3, bytes(bad[:64]))), 'flush'
+        ])
+
+    def test_held_frames(self):
+        s1 = Signer()
+        s2 = Signer()
+        requests = [s1.sign(random_digest()) for i in range(5)]
+        responses = [s2.sign(r) for r in requests]
+        compact = [wire.compact_request(r) for r in requests]
+        ttl = MockSerial(
+            *reads(wire.FULL_REQUEST, 65535, requests[0]),
+            # Frame 0 was lost, 1 and 2 are held until it's retransmitted:
+            *reads(wire.COMPACT_REQUEST, 1, compact[2]),
+            *reads(wire.COMPACT_REQUEST, 2, compact[3]),
+            *reads(wire.FULL_REQUEST, 0, requests[1]),
+            # Outside the window, so the server starts over:
+            *reads(wire.FULL_REQUEST, 500, requests[4]),
+        )
+        client = MockClient(*responses)
+        server = serial.SerialServer(client, 'server', lambda p, **kw: ttl)
+        for i in range(3):
+            server.serve_once()
+        self.assertEqual(client._calls, requests[:1])
+        self.assertEqual(server.expected, 0)
+        self.assertEqual(sorted(server.held), [1, 2])
+        server.serve_once()
+        self.assertEqual(client._calls, requests[:4])
+        self.assertEqual(server.expected, 3)
+        self.assertEqual(server.held, {})
+        writes = [c[1] for c in ttl._calls if c[0] == 'write']
+        self.assertEqual(writes, [
+            frame(wire.RESPONSE_PREFIX, seq, r[:common.PREFIX])
+            for (seq, r) in zip([65535, 0, 1, 2], responses)
+        ])
+        server.serve_once()
+        self.assertEqual(client._calls, requests)
+        self.assertEqual(server.expected, 501)
+
+
+class TestPolledSerialServer(TestCase):
+    def test_poll(self):
+        s1 = Signer()
+        s2 = Signer()
+        requests = [s1.sign(random_digest()) for i in range(2)]
+        responses = [s2.sign(r) for r in requests]
+        port = random_id()
+        (f1, f2) = (frame(wire.FULL_REQUEST, 5, requests[0]),
+            frame(wire.FULL_REQUEST, 6, requests[1])
+        )
+        # The second frame arrives split across two polls:
+        ttl = MockSerial(f1, f2[:20], b'', f2[20:], b'')
+        client = MockClient(*responses)
+        server = serial.PolledSerialServer(client, port,
+            MockSerialFactory(port, ttl)
+        )
+        self.assertEqual(server.poll(now=1), 1)
+        self.assertEqual(ttl.timeout, 0)
+        self.assertEqual(len(server.decoder), 20)
+        self.assertEqual(server.poll(now=2), 2)
+        self.assertEqual(len(server.decoder), 0)
+        self.assertEqual(list(server.frames), [
+            (1, (wire.FULL_REQUEST, 5, requests[0])),
+            (2, (wire.FULL_REQUEST, 6, requests[1])),
+        ])
+        for now in [1.5, 2.25]:
+            (received, f) = server.frames.popleft()
+            server.handle_frame(*f)
+            server.add_latency(received, now)
+        self.assertEqual(client._calls, requests)
+        self.assertEqual(len(server.frames), 0)
+        self.assertEqual(server.latency.count, 2)
+        self.assertEqual(sorted(server.latency.samples), [0.25, 0.5])
+        stats = server.stats()
+        self.assertEqual(stats['served'], 2)
+        self.assertEqual(stats['queued'], 0)
+        self.assertEqual(stats['p99'], 0.5)
+        self.assertEqual(stats['bad_frames'], 0)
+
+    def test_poll_timeout(self):
+        port = random_id()
+        f = frame(wire.NEED_FULL, 1, bytes(64))
+        ttl = MockSerial(f[:10], b'', b'')
+        server = serial.PolledSerialServer(MockClient(), port,
+            MockSerialFactory(port, ttl)
+        )
+        now = server.last_read
+        self.assertEqual(server.poll(now), 0)
+        self.assertEqual(len(server.decoder), 10)
+        # A partial frame is dropped after SERIAL_TIMEOUT without more bytes:
+        self.assertEqual(server.poll(now + common.SERIAL_TIMEOUT), 0)
+        self.assertEqual(len(server.decoder), 0)
+        self.assertEqual(server.counters['short_reads'], 1)
+
+
+class TestBaudrate(TestCase):
+    def test_ping(self):
+        s1 = Signer()
+        s2 = Signer()
+        request = s1.sign(random_digest())
+        response = s2.sign(request)
+        link = Link()
+        (client, server) = connect_link(link, MockClient(response))
+        status = client.ping()
+        self.assertIs(client.status, status)
+        self.assertEqual(status.counter, 0)
+        self.assertEqual(status.public, bytes(32))
+
+        # The status follows the chain, without adding to it:
+        self.assertEqual(client.make_request(request), response)
+        status = client.ping()
+        self.assertEqual(status.counter, 1)
+        self.assertEqual(status.public, s2.public)
+        self.assertEqual(status.tail, common.get_signature(response))
+        self.assertEqual(s2.counter, 1)
+        self.assertEqual(server.errors, 0)
+        self.assertEqual(client.status_key, bytes(server.key.verify_key))
+
+        # Anything signed by another key is ignored, however well formed:
+        server.key = SigningKey.generate()
+        self.assertIsNone(client.ping())
+        self.assertEqual(client.counters['bad_signatures'],
+            common.SERIAL_RETRIES
+        )
+
+        # Nothing answers:
+        ttl = MockSerial(*([b''] * common.SERIAL_RETRIES))
+        port = random_id()
+        client = serial.SerialClient(port, MockSerialFactory(port, ttl))
+        self.assertIsNone(client.ping())
+        self.assertIsNone(client.status)
+        writes = [c for c in ttl._calls if c[0] == 'write']
+        self.assertEqual(len(writes), common.SERIAL_RETRIES)
+        self.assertEqual(client.rtt.timeouts, common.SERIAL_RETRIES)
+
+    def test_negotiate(self):
+        for max_baudrate in common.SERIAL_BAUDRATES:
+            link = Link(max_baudrate)
+            (client, server) = connect_link(link)
+            self.assertEqual(client.negotiate(), max_baudrate)
+            self.assertEqual(link.client.baudrate, max_baudrate)
+            self.assertEqual(link.server.baudrate, max_baudrate)
+            self.assertIsNone(server.pending)
+            self.assertEqual(client.best, max_baudrate)
+
+    def test_max_baudrate(self):
+        link = Link()
+        (client, server) = connect_link(link)
+        client.max_baudrate = 230400
+        self.assertEqual(client.negotiate(), 230400)
+        self.assertEqual(link.server.baudrate, 230400)
+
+    def test_remembered(self):
+        tmp = TempDir()
+        filename = tmp.join('baudrate')
+        link = Link(460800)
+        (client, server) = connect_link(link)
+        client.filename = filename
+        self.assertEqual(client.load_baudrate(), common.SERIAL_BAUDRATE)
+        self.assertEqual(client.negotiate(), 460800)
+        self.assertEqual(open(filename, 'rb').read(), b'460800')
+
+        # Client restarts, server is still at 460800:
+        link.client.baudrate = common.SERIAL_BAUDRATE
+        client = serial.SerialClient('client', link.factory(link.client),
+            filename=filename
+        )
+        self.assertEqual(client.load_baudrate(), 460800)
+        self.assertEqual(client.negotiate(), 460800)
+        self.assertEqual(link.server.baudrate, 460800)
+
+        # Both restart:
+        link = Link(460800)
+        (client, server) = connect_link(link)
+        client.filename = filename
+        client.load_baudrate()
+        self.assertEqual(client.negotiate(), 460800)
+
+    def test_pinned_status_key(self):
+        tmp = TempDir()
+        filename = tmp.join('status_key')
+        key = SigningKey.generate()
+        public = bytes(key.verify_key)
+        link = Link()
+        (client, server) = connect_link(link)
+        server.key = key
+        client.status_file = filename
+        self.assertIsNone(client.load_status_key())
+        self.assertIsNotNone(client.ping())
+        self.assertEqual(client.status_key, public)
+        self.assertEqual(open(filename, 'rb').read(),
+            common.b32enc(public).encode()
+        )
+
+        # Client restarts, and only takes the pinned key:
+        client = serial.SerialClient('client', link.factory(link.client),
+            status_file=filename
+        )
+        self.assertEqual(client.load_status_key(), public)
+        server.key = SigningKey.generate()
+        self.assertIsNone(client.ping())
+        server.key = key
+        self.assertIsNotNone(client.ping())
+
+        # Pinned ahead of time:
+        other = SigningKey.generate()
+        with open(filename, 'wb') as fp:
+            fp.write(common.b32enc(bytes(other.verify_key)).encode())
+        self.assertEqual(client.load_status_key(), bytes(other.verify_key))
+        self.assertIsNone(client.ping())
+        server.key = other
+        self.assertIsNotNone(client.ping())
+
+    def test_fall_back(self):
+        s1 = Signer()
+        s2 = Signer()
+        requests = [s1.sign(random_digest()) for i in range(2)]
+        responses = [s2.sign(r) for r in requests]
+        link = Link()
+        (client, server) = connect_link(link, MockClient(*responses))
+        self.assertEqual(client.negotiate(), 921600)
+
+        # Link degrades, both ends fall back and the request still succeeds:
+        link.max_baudrate = 460800
+        self.assertEqual(client.make_request(requests[0]), responses[0])
+        self.assertEqual(link.client.baudrate, common.SERIAL_BAUDRATE)
+        self.assertEqual(link.server.baudrate, common.SERIAL_BAUDRATE)
+        self.assertEqual(client.counters['fallbacks'], 1)
+        self.assertEqual(server.counters['fallbacks'], 1)
+        self.assertGreater(server.errors, 0)
+        self.assertIsNotNone(client.renegotiate_at)
+
+        # Renegotiated once the interval has passed:
+        client.renegotiate_at = 0
+        self.assertEqual(client.make_request(requests[1]), responses[1])
+        self.assertIsNone(client.renegotiate_at)
+        self.assertEqual(link.client.baudrate, 460800)
+        self.assertEqual(link.server.baudrate, 460800)
+
+    def test_negotiate_if_due(self):
+        link = Link()
+        (client, server) = connect_link(link)
+        self.assertIsNone(client.negotiate_if_due())
+        self.assertEqual(link.client.baudrate, common.SERIAL_BAUDRATE)
+
+        # Due, so the first ping negotiates:
+        client.renegotiate_at = 0
+        self.assertEqual(client.ping().counter, 0)
+        self.assertIsNone(client.renegotiate_at)
+        self.assertEqual(link.client.baudrate, 921600)
+        self.assertEqual(link.server.baudrate, 921600)
+
+        # No adapter: still due, and the ping fails rather than raising:
+        def missing(port, **kw):
+            raise FileNotFoundError(port)
+        client = serial.SerialClient('client', missing)
+        client.renegotiate_at = 0
+        self.assertIsNone(client.ping())
+        self.assertEqual(client.renegotiate_at, 0)
+        self.assertEqual(client.counters['io_errors'], common.SERIAL_RETRIES)
+        self.assertIsNone(client.ttl)
+        with self.assertRaises(FileNotFoundError):
+            client.make_request(bytes(common.REQUEST))
+        self.assertEqual(client.renegotiate_at, 0)
+
+    def test_handle_baudrate(self):
+        link = Link()
+        server = serial.SerialServer(None, 'server', link.factory(link.server))
+        key = SigningKey.generate()
+
+        frame = serial.build_baudrate_frame(key, 12345)
+        server.handle_baudrate(0, frame, 12345)
+        self.assertEqual(link.client.inbox, b'')
+        self.assertEqual(link.server.baudrate, common.SERIAL_BAUDRATE)
+
+        frame = serial.build_baudrate_frame(key, 115200)
+        server.handle_baudrate(0, frame, 115200)
+        self.assertEqual(link.client.inbox,
+            wire.pack_frame(wire.BAUDRATE, 0, frame)
+        )
+        self.assertEqual(link.server.baudrate, 115200)
+        self.assertEqual(server.pending, common.SERIAL_BAUDRATE)
+
+        # No confirmation:
+        server.serve_once()
+        self.assertEqual(link.server.baudrate, common.SERIAL_BAUDRATE)
+        self.assertIsNone(server.pending)
+        self.assertEqual(server.counters['fallbacks'], 1)
+
 
 class TestSerialClient(TestCase):
     def test_make_request(self):
@@ -179,56 +872,351 @@ class TestSerialClient(TestCase):
         s2 = Signer()
         request = s1.sign(random_digest())
         signed = s2.sign(request)
+        prefix = signed[:common.PREFIX]
+        full = ('write', frame(wire.FULL_REQUEST, 0, request))
+        read = [('readinto', 7), ('readinto', common.PREFIX + 4)]
 
         port = random_id()
-        ttl = MockSerial(signed)
+        ttl = MockSerial(*reads(wire.RESPONSE_PREFIX, 0, prefix))
         f = MockSerialFactory(port, ttl)
         client = serial.SerialClient(port, f)
-        self.assertIs(client.make_request(request), signed)
+        client.seq = 0
+        self.assertEqual(client.make_request(request), signed)
+        self.assertIs(client.acked, request)
+        self.assertEqual(client.seq, 1)
         self.assertEqual(f._calls, 1)
-        self.assertEqual(ttl._calls, [
-            ('write', request),
-            'flush',
-            ('read', common.RESPONSE)
-        ])
+        self.assertEqual(ttl._calls, [full, 'flush'] + read)
 
-        for bad in iter_permutations(signed):
-            ttl = MockSerial(bad, b'some junk', signed)
+        for bad in iter_permutations(prefix):
+            ttl = MockSerial(
+                *reads(wire.RESPONSE_PREFIX, 0, bad), b'',
+                *reads(wire.RESPONSE_PREFIX, 0, prefix),
+            )
             f = MockSerialFactory(port, ttl)
             client = serial.SerialClient(port, f)
-            self.assertIs(client.make_request(request), signed)
+            client.seq = 0
+            self.assertEqual(client.make_request(request), signed)
             self.assertEqual(f._calls, 1)
-            self.assertEqual(ttl._calls, [
-                ('write', request),
-                'flush',
-                ('read', common.RESPONSE),
-                ('read', common.RESPONSE * 2),
-                ('write', request),
-                'flush',
-                ('read', common.RESPONSE)
-            ])
-
-            ttl = MockSerial(bad, b'some junk', bad, b'stuff', bad, b'a', signed)
-            f = MockSerialFactory(port, ttl)
-            client = serial.SerialClient(port, f)
-            with self.assertRaises(Exception) as cm:
-                client.make_request(request)
-            self.assertEqual(str(cm.exception),
-                'serial request failed {!r} tries'.format(common.SERIAL_RETRIES)
+            self.assertEqual(ttl._calls,
+                [full, 'flush'] + read + [('readinto', 7), full, 'flush'] + read
             )
-            self.assertEqual(f._calls, 1)
-            self.assertEqual(ttl._calls, [
-                ('write', request),
-                'flush',
-                ('read', common.RESPONSE),
-                ('read', common.RESPONSE * 2),
-                ('write', request),
-                'flush',
-                ('read', common.RESPONSE),
-                ('read', common.RESPONSE * 2),
-                ('write', request),
-                'flush',
-                ('read', common.RESPONSE),
-                ('read', common.RESPONSE * 2),
-            ])
+        self.assertEqual(client.counters['bad_signatures'], 1)
+
+        ttl = MockSerial(b'', b'', b'')
+        f = MockSerialFactory(port, ttl)
+        client = serial.SerialClient(port, f)
+        client.seq = 0
+        with self.assertRaises(Exception) as cm:
+            client.make_request(request)
+        self.assertEqual(str(cm.exception),
+            'serial request failed {!r} tries'.format(common.SERIAL_RETRIES)
+        )
+        self.assertEqual(f._calls, 1)
+        self.assertEqual(ttl._calls, [full, 'flush', ('readinto', 7)] * 3)
+        self.assertIsNone(client.acked)
+        self.assertEqual(client.seq, 1 + common.SERIAL_WINDOW)
+
+    def test_compact_request(self):
+        s1 = Signer()
+        s2 = Signer()
+        requests = [s1.sign(random_digest()) for i in range(3)]
+        responses = [s2.sign(r) for r in requests]
+        prefixes = [r[:common.PREFIX] for r in responses]
+        ttl = MockSerial(
+            *reads(wire.RESPONSE_PREFIX, 0, prefixes[0]),
+            *reads(wire.RESPONSE_PREFIX, 1, prefixes[1]),
+            *reads(wire.NEED_FULL, 2, common.get_signature(requests[2])),
+            *reads(wire.RESPONSE_PREFIX, 2, prefixes[2]),
+        )
+        client = serial.SerialClient('client', lambda p, **kw: ttl)
+        client.seq = 0
+        for (req, resp) in zip(requests, responses):
+            self.assertEqual(client.make_request(req), resp)
+        writes = [c[1] for c in ttl._calls if c[0] == 'write']
+        self.assertEqual(writes, [
+            frame(wire.FULL_REQUEST, 0, requests[0]),
+            frame(wire.COMPACT_REQUEST, 1, wire.compact_request(requests[1])),
+            frame(wire.COMPACT_REQUEST, 2, wire.compact_request(requests[2])),
+            frame(wire.FULL_REQUEST, 2, requests[2]),
+        ])
+
+    def test_link(self):
+        s1 = Signer()
+        s2 = Signer()
+        requests = [s1.sign(random_digest()) for i in range(4)]
+        responses = [s2.sign(r) for r in requests]
+        link = Link()
+        (client, server) = connect_link(link, MockClient(*responses))
+        sent = []
+        write = link.client.write
+        link.client.write = lambda data: sent.append(len(data)) or write(data)
+        for (req, resp) in zip(requests, responses):
+            self.assertEqual(client.make_request(req), resp)
+        self.assertEqual(sent, [
+            wire.OVERHEAD + common.REQUEST,
+            wire.OVERHEAD + wire.COMPACT,
+            wire.OVERHEAD + wire.COMPACT,
+            wire.OVERHEAD + wire.COMPACT,
+        ])
+
+    def test_junk_on_link(self):
+        s1 = Signer()
+        s2 = Signer()
+        requests = [s1.sign(random_digest()) for i in range(2)]
+        responses = [s2.sign(r) for r in requests]
+        link = Link()
+        (client, server) = connect_link(link, MockClient(*responses))
+        writes = []
+        write = link.client.write
+        link.client.write = lambda data: writes.append(data) or write(data)
+
+        # Line noise ahead of a request, and ahead of a response:
+        link.server.inbox += b'\x00\xa5noise'
+        link.client.inbox += b'\xa5\x7e\xff'
+        start = time.monotonic()
+        for (req, resp) in zip(requests, responses):
+            self.assertEqual(client.make_request(req), resp)
+        self.assertLess(time.monotonic() - start, common.SERIAL_TIMEOUT)
+        self.assertEqual(len(writes), 2)
+        self.assertEqual(server.counters['resyncs'], 1)
+        self.assertEqual(client.counters['resyncs'], 1)
+        self.assertEqual(client.counters['bad_frames'], 1)
+
+    def test_adaptive_timeout(self):
+        tmp = TempDir()
+        count = serial.REPORT_INTERVAL + 1
+        s1 = Signer()
+        s2 = Signer()
+        requests = [s1.sign(random_digest()) for i in range(count)]
+        responses = [s2.sign(r) for r in requests]
+        link = Link()
+        private = MockClient(*responses[:10], *responses[11:])
+        (client, server) = connect_link(link, private)
+        client.metrics_file = tmp.join('link.json')
+        self.assertEqual(link.client.timeout, common.SERIAL_TIMEOUT)
+        self.assertEqual(client.make_requests(requests[:10]), responses[:10])
+        self.assertEqual(client.rtt.samples, 10)
+        self.assertEqual(client.rtt.rto, serial.RTO_MIN)
+        self.assertEqual(link.client.timeout, serial.RTO_MIN)
+        self.assertFalse(path.exists(client.metrics_file))
+
+        # A lost frame costs the RTO, not SERIAL_TIMEOUT:
+        (write, step) = (link.client.write, link.client.step)
+        link.client.write = lambda data: len(data)
+        link.client.step = None
+        with self.assertRaises(Exception):
+            client.make_request(requests[10])
+        self.assertEqual(client.rtt.timeouts, 3)
+        self.assertEqual(client.rtt.rto, serial.RTO_MIN * 8)
+
+        # Exported once every REPORT_INTERVAL requests:
+        (link.client.write, link.client.step) = (write, step)
+        self.assertEqual(client.make_requests(requests[11:]), responses[11:])
+        stats = json.loads(open(client.metrics_file).read())
+        self.assertEqual(stats, client.stats())
+        self.assertEqual(stats['timeouts'], 3)
+        self.assertEqual(stats['baudrate'], common.SERIAL_BAUDRATE)
+
+    def test_make_requests(self):
+        count = common.SERIAL_WINDOW * 2 + 3
+        s1 = Signer()
+        s2 = Signer()
+        requests = [s1.sign(random_digest()) for i in range(count)]
+        responses = [s2.sign(r) for r in requests]
+        link = Link()
+        private = MockClient(*responses)
+        (client, server) = connect_link(link, private)
+
+        # A full window is written before the first response is read:
+        sent = []
+        write = link.client.write
+        link.client.write = lambda data: sent.append(data) or write(data)
+        step = link.client.step
+        outstanding = []
+        def count_outstanding():
+            outstanding.append(len(sent))
+            step()
+        link.client.step = count_outstanding
+        self.assertEqual(client.make_requests(requests), responses)
+        self.assertEqual(private._calls, requests)
+        self.assertEqual(outstanding[0], common.SERIAL_WINDOW)
+        self.assertEqual(len(sent), count)
+        self.assertIs(client.acked, requests[-1])
+
+    def test_make_requests_lost(self):
+        count = common.SERIAL_WINDOW
+        s1 = Signer()
+        s2 = Signer()
+        requests = [s1.sign(random_digest()) for i in range(count)]
+        responses = [s2.sign(r) for r in requests]
+        link = Link()
+        private = MockClient(*responses)
+        (client, server) = connect_link(link, private)
+
+        # Second frame is lost; the Pi still signs in order, and only once:
+        writes = []
+        lost = {1}
+        write = link.client.write
+        def lossy_write(data):
+            if len(writes) not in lost:
+                write(data)
+            writes.append(data)
+            return len(data)
+        link.client.write = lossy_write
+        self.assertEqual(client.make_requests(requests), responses)
+        self.assertEqual(private._calls, requests)
+        # Only the lost frame went again; the ones after it were held by the
+        # Pi, not resent:
+        self.assertEqual(len(writes), count + 1)
+        start = len(wire.MAGIC)
+        seq = wire.unpack_header(writes[1][start:start + wire.HEADER.size])[1]
+        self.assertEqual(writes[-1],
+            wire.pack_frame(wire.FULL_REQUEST, seq, requests[1])
+        )
+
+        # Two gaps are filled one at a time, each resent once:
+        requests = [s1.sign(random_digest()) for i in range(count)]
+        responses = [s2.sign(r) for r in requests]
+        private._returns.extend(responses)
+        writes.clear()
+        lost.update([3])
+        self.assertEqual(client.make_requests(requests), responses)
+        self.assertEqual(private._calls[count:], requests)
+        self.assertEqual(len(writes), count + 2)
+
+    def test_make_requests_deadline(self):
+        s1 = Signer()
+        s2 = Signer()
+        requests = [s1.sign(random_digest()) for i in range(4)]
+        responses = [s2.sign(r) for r in requests[2:]]
+        link = Link()
+        private = MockClient(*responses)
+        (client, server) = connect_link(link, private)
+
+        # Already passed, so nothing is sent:
+        writes = []
+        write = link.client.write
+        link.client.write = lambda data: writes.append(data) or len(data)
+        with self.assertRaises(DeadlineExpired) as cm:
+            client.make_requests(requests[:2], time.monotonic() - 1)
+        self.assertEqual(cm.exception.count, 2)
+        self.assertEqual(writes, [])
 
+        # Every frame lost; given up at the deadline rather than retried:
+        step = link.client.step
+        link.client.step = lambda: time.sleep(link.client.timeout)
+        start = time.monotonic()
+        with self.assertRaises(DeadlineExpired) as cm:
+            client.make_requests(requests[:2], start + serial.RTO_MIN / 2)
+        self.assertEqual(cm.exception.count, 2)
+        self.assertEqual(len(writes), 2)
+        self.assertLess(time.monotonic() - start, serial.RTO_MIN)
+        self.assertEqual(client.expired, 4)
+        self.assertEqual(client.stats()['expired'], 4)
+
+        # The link is still good for the next batch:
+        (link.client.write, link.client.step) = (write, step)
+        self.assertEqual(
+            client.make_requests(requests[2:], time.monotonic() + 10),
+            responses
+        )
+        self.assertEqual(private._calls, requests[2:])
+
+    def test_make_requests_batch(self):
+        count = wire.MAX_BATCH + 3
+        s1 = Signer()
+        s2 = Signer()
+        requests = [s1.sign(random_digest()) for i in range(count)]
+        responses = [s2.sign(r) for r in requests]
+        link = Link()
+        private = MockClient(*responses)
+        (client, server) = connect_link(link, private)
+        frames = []
+        write = link.client.write
+        def record(data):
+            frames.append(data[2] & 0x0F)
+            return write(data)
+        link.client.write = record
+        self.assertEqual(client.make_requests(requests, batch=True), responses)
+        self.assertEqual(private._calls, requests)
+        self.assertEqual(frames, [wire.BATCH_REQUEST, wire.BATCH_REQUEST])
+        self.assertIs(client.acked, requests[-1])
+        self.assertIs(server.tail, responses[-1])
+        self.assertEqual(list(server.known), requests[-2:])
+
+        # Single requests carry on from the batch with compact frames:
+        request = s1.sign(random_digest())
+        response = s2.sign(request)
+        private._returns.append(response)
+        self.assertEqual(client.make_request(request), response)
+        self.assertEqual(frames[-1], wire.COMPACT_REQUEST)
+
+    def test_make_requests_batch_lost(self):
+        s1 = Signer()
+        s2 = Signer()
+        requests = [s1.sign(random_digest()) for i in range(4)]
+        responses = [s2.sign(r) for r in requests]
+        link = Link()
+        private = MockClient(*responses)
+        (client, server) = connect_link(link, private)
+
+        # The first batch response is lost; the retransmit is answered from
+        # the server's cache, so nothing is signed twice:
+        dropped = []
+        write = link.server.write
+        def lossy_write(data):
+            if not dropped:
+                dropped.append(data)
+                return len(data)
+            return write(data)
+        link.server.write = lossy_write
+        self.assertEqual(client.make_requests(requests, batch=True), responses)
+        self.assertEqual(private._calls, requests)
+        self.assertEqual(len(dropped), 1)
+        self.assertEqual(client.rtt.timeouts, 1)
+
+        # A batch with a bad signature is dropped whole:
+        bad = bytearray(wire.pack_batch([s1.sign(random_digest())
+            for i in range(2)]))
+        bad[300] ^= 1
+        server.handle_frame(wire.BATCH_REQUEST, server.expected, bytes(bad))
+        self.assertEqual(private._calls, requests)
+        self.assertEqual(server.counters['bad_signatures'], 1)
+
+    def test_persistent_port(self):
+        s1 = Signer()
+        s2 = Signer()
+        requests = [s1.sign(random_digest()) for i in range(3)]
+        responses = [s2.sign(r) for r in requests]
+        port = random_id()
+        ttl = MockSerial(*(x for (seq, r) in enumerate(responses)
+            for x in reads(wire.RESPONSE_PREFIX, seq, r[:common.PREFIX])
+        ))
+        f = MockSerialFactory(port, ttl)
+        client = serial.SerialClient(port, f)
+        client.seq = 0
+        for (req, resp) in zip(requests, responses):
+            self.assertEqual(client.make_request(req), resp)
+        self.assertEqual(f._calls, 1)
+
+        # Reopened after an error:
+        request = s1.sign(random_digest())
+        response = s2.sign(request)
+        ttl1 = MockSerial(OSError('gone'))
+        ttl2 = MockSerial(
+            *reads(wire.RESPONSE_PREFIX, 0, response[:common.PREFIX])
+        )
+        f = MockSerialFactory(port, ttl1, ttl2)
+        client = serial.SerialClient(port, f)
+        client.seq = 0
+        self.assertEqual(client.make_request(request), response)
+        self.assertEqual(f._calls, 2)
+        self.assertEqual(ttl1._calls, [
+            ('write', frame(wire.FULL_REQUEST, 0, request)),
+            'flush',
+            ('readinto', 7),
+            'close',
+        ])
+        self.assertEqual(ttl2._calls[0],
+            ('write', frame(wire.FULL_REQUEST, 0, request))
+        )
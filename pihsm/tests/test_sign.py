@@ -18,8 +18,11 @@ from unittest import TestCase
 import os
 
 import nacl.signing
+from nacl.exceptions import BadSignatureError
 
-from .helpers import random_u64
+from .helpers import random_u64, TempDir
+from ..common import ChainStore, get_counter, get_message, get_previous
+from ..verify import get_pubkey, verify_genesis, verify_message
 from  .. import sign
 
 
@@ -49,6 +52,75 @@ class TestFunctions(TestCase):
             public + previous + cnt + ts
         )
 
+    def test_get_uptime(self):
+        tmp = TempDir()
+        filename = tmp.join('uptime')
+        with open(filename, 'wb') as fp:
+            fp.write(b'350735.47 234388.90\n')
+        self.assertEqual(sign.get_uptime(filename), 350735.47)
+        self.assertGreater(sign.get_uptime(), 0)
+
+    def test_wait_for_entropy(self):
+        calls = []
+
+        def getrandom(size):
+            calls.append(('getrandom', size))
+            return os.urandom(size)
+
+        def poll_random():
+            calls.append('poll_random')
+
+        self.assertEqual(
+            sign.wait_for_entropy(getrandom, poll_random,
+                iter([10.0, 12.5]).__next__
+            ),
+            2.5
+        )
+        self.assertEqual(calls, [('getrandom', 1)])
+
+        # Where there's no os.getrandom():
+        try:
+            saved = os.getrandom
+            del os.getrandom
+            self.assertEqual(
+                sign.wait_for_entropy(None, poll_random,
+                    iter([10.0, 11.0]).__next__
+                ),
+                1.0
+            )
+        finally:
+            os.getrandom = saved
+        self.assertEqual(calls, [('getrandom', 1), 'poll_random'])
+
+        # Long since initialized here:
+        self.assertLess(sign.wait_for_entropy(), 1)
+        sign._poll_random()
+
+    def test_pack_state(self):
+        s = sign.Signer()
+        tail = s.sign(os.urandom(48))
+        data = sign.pack_state(s.key, s.genesis, tail)
+        self.assertEqual(len(data), 32 + 96 + 224)
+        (key, genesis, tail2) = sign.unpack_state(data)
+        self.assertEqual(bytes(key), bytes(s.key))
+        self.assertEqual(genesis, s.genesis)
+        self.assertEqual(tail2, tail)
+        data = sign.pack_state(s.key, s.genesis, s.genesis)
+        self.assertEqual(sign.unpack_state(data)[2], s.genesis)
+
+        with self.assertRaises(ValueError) as cm:
+            sign.unpack_state(data[:-1])
+        self.assertEqual(str(cm.exception), 'signer state: bad size 223')
+        # Every part is checked against the key:
+        other = sign.Signer()
+        with self.assertRaises(ValueError) as cm:
+            sign.unpack_state(sign.pack_state(other.key, s.genesis, tail))
+        self.assertTrue(str(cm.exception).startswith('signer state: '))
+        bad = bytearray(sign.pack_state(s.key, s.genesis, tail))
+        bad[-1] ^= 1
+        with self.assertRaises(BadSignatureError):
+            sign.unpack_state(bytes(bad))
+
 
 class TestSigner(TestCase):
     def test_init(self):
@@ -61,6 +133,8 @@ class TestSigner(TestCase):
         self.assertEqual(s.message, b'')
         self.assertEqual(s.counter, 0)
         self.assertIs(type(s.store), sign.DummyStore)
+        self.assertIsNone(s.next_key)
+        self.assertIsNone(s.state_file)
 
     def test_build_signing_form(self):
         s = sign.Signer()
@@ -101,3 +175,113 @@ class TestSigner(TestCase):
         self.assertEqual(s.counter, 2)
         self.assertEqual(s.public, pub)
 
+    def test_sign_many(self):
+        tmp = TempDir()
+        store = ChainStore(tmp.dir)
+        s = sign.Signer(store)
+        ts = random_u64()
+        msgs = [os.urandom(48) for i in range(3)]
+        signed = s.sign_many(msgs, timestamp=ts)
+        self.assertEqual(len(signed), 3)
+        self.assertEqual(s.counter, 3)
+        self.assertIs(s.tail, signed[-1])
+
+        # The same chain sign() would have made:
+        s2 = sign.Signer()
+        s2.key = s.key
+        s2.public = s.public
+        s2.tail = s.genesis
+        s2.counter = 0
+        self.assertEqual([s2.sign(m, timestamp=ts) for m in msgs], signed)
+
+        # All of them stored:
+        for response in signed:
+            with store.open(response[:64]) as fp:
+                self.assertEqual(fp.read(), response)
+        self.assertEqual(tmp.listdir('chain', 'tmp'), [])
+
+    def test_next_key(self):
+        s = sign.Signer()
+        s.prepare_next_key()
+        key = s.next_key
+        self.assertIsInstance(key, nacl.signing.SigningKey)
+        self.assertNotEqual(bytes(key.verify_key), s.public)
+        # Already prepared, so kept:
+        s.prepare_next_key()
+        self.assertIs(s.next_key, key)
+        s = sign.Signer()
+        s.start_next_key().join()
+        self.assertIsInstance(s.next_key, nacl.signing.SigningKey)
+
+    def test_rotate(self):
+        tmp = TempDir()
+        store = ChainStore(tmp.dir)
+        s = sign.Signer(store)
+        old = (s.public, s.genesis)
+        first = s.sign(os.urandom(48))
+        s.start_next_key().join()
+        next_public = bytes(s.next_key.verify_key)
+        ts = random_u64()
+        handover = s.rotate(timestamp=ts)
+
+        # The last node of the old chain carries the new genesis:
+        verify_message(handover)
+        self.assertEqual(len(handover), 176 + 96)
+        self.assertEqual(get_pubkey(handover), old[0])
+        self.assertEqual(get_previous(handover), first[:64])
+        self.assertEqual(get_counter(handover), 2)
+        self.assertEqual(get_message(handover), s.genesis)
+        verify_genesis(s.genesis[:64], s.genesis[64:])
+
+        # Which the prepared key started:
+        self.assertEqual(s.public, next_public)
+        self.assertIsNone(s.next_key)
+        self.assertNotEqual(s.genesis, old[1])
+        self.assertIs(s.tail, s.genesis)
+        self.assertEqual(s.counter, 0)
+        response = s.sign(os.urandom(48))
+        self.assertEqual(get_previous(response), s.genesis[:64])
+        self.assertEqual(get_counter(response), 1)
+        for signed in [old[1], first, handover, s.genesis, response]:
+            with store.open(signed[:64]) as fp:
+                self.assertEqual(fp.read(), signed)
+
+        # Without a prepared key, one is made on the spot:
+        genesis = s.genesis
+        handover = s.rotate()
+        self.assertEqual(get_message(handover), s.genesis)
+        self.assertNotEqual(s.genesis, genesis)
+
+    def test_resume(self):
+        tmp = TempDir()
+        store = ChainStore(tmp.dir)
+        filename = tmp.join('signer')
+        s = sign.Signer(store, filename)
+        self.assertEqual(s.state_file, filename)
+        self.assertEqual(os.stat(filename).st_mode & 0o777, 0o600)
+
+        # Before anything is signed, the genesis is the tail:
+        s2 = sign.Signer(store, filename)
+        self.assertEqual(s2.public, s.public)
+        self.assertEqual(s2.genesis, s.genesis)
+        self.assertEqual(s2.tail, s.genesis)
+        self.assertEqual(s2.counter, 0)
+
+        s.sign(os.urandom(48))
+        s.sign_many([os.urandom(48) for i in range(2)])
+        s2 = sign.Signer(store, filename)
+        self.assertEqual(s2.public, s.public)
+        self.assertEqual(s2.tail, s.tail)
+        self.assertEqual(s2.counter, 3)
+        # The counter carries on, chained to the last node:
+        signed = s2.sign(os.urandom(48))
+        self.assertEqual(get_counter(signed), 4)
+        self.assertEqual(get_previous(signed), s.tail[:64])
+
+        # A rotation is saved too:
+        s2.rotate()
+        s3 = sign.Signer(store, filename)
+        self.assertEqual(s3.public, s2.public)
+        self.assertEqual(s3.genesis, s2.genesis)
+        self.assertEqual(s3.counter, 0)
+        self.assertEqual(tmp.listdir(), ['chain', 'signer'])
@@ -0,0 +1,69 @@
+# pihsm: Turn your Raspberry Pi into a Hardware Security Module 
+# Copyright (C) 2017 System76, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from unittest import TestCase
+import os
+
+from .. import simulate
+
+
+class TestWire(TestCase):
+    def test_transform(self):
+        data = os.urandom(1000)
+        w = simulate.Wire()
+        self.assertIs(w.transform(data), data)
+
+        w = simulate.Wire(drop=0.5, seed=1)
+        out = w.transform(data)
+        self.assertEqual(len(out), len(data) - w.dropped)
+        self.assertGreater(w.dropped, 0)
+        self.assertEqual(w.corrupted, 0)
+
+        w = simulate.Wire(corrupt=0.5, seed=1)
+        out = w.transform(data)
+        self.assertEqual(len(out), len(data))
+        self.assertGreater(w.corrupted, 0)
+        self.assertEqual(
+            sum(a != b for (a, b) in zip(data, out)), w.corrupted
+        )
+
+    def test_delay(self):
+        self.assertEqual(simulate.Wire(115200).delay(11520), 1.0)
+        self.assertEqual(simulate.Wire(57600).delay(576), 0.1)
+
+
+class TestFunctions(TestCase):
+    def test_simulate(self):
+        results = simulate.simulate(12, 3, baudrate=921600)
+        self.assertEqual(results['signatures'], 12)
+        self.assertEqual(results['errors'], 0)
+        self.assertGreater(results['rate'], 0)
+        self.assertLessEqual(results['p50'], results['p99'])
+        self.assertEqual(results['serial_samples'], 12)
+        self.assertEqual(results['dropped'], 0)
+
+        # Counts that don't divide evenly aren't rounded down:
+        results = simulate.simulate(11, 3, baudrate=921600)
+        self.assertEqual(results['signatures'], 11)
+        self.assertEqual(results['errors'], 0)
+
+    def test_simulate_devices(self):
+        results = simulate.simulate(16, 4, baudrate=921600, devices=2)
+        self.assertEqual(results['signatures'], 16)
+        self.assertEqual(len(results['devices']), 2)
+        self.assertEqual(
+            sum(d['signed'] for d in results['devices'].values()), 16
+        )
@@ -63,6 +63,18 @@ class TestFunctions(TestCase):
                     'Signature was forged or corrupt'
                 )
 
+    def test_get_verifications(self):
+        sk = SigningKey.generate()
+        signed = bytes(sk.sign(bytes(sk.verify_key)))
+        count = verify.get_verifications()
+        verify.verify_message(signed)
+        self.assertEqual(verify.get_verifications(), count + 1)
+        # Failures cost just as much, so they count too:
+        self.assertIs(verify.isvalid(signed[:-1] + bytes([signed[-1] ^ 1])),
+            False
+        )
+        self.assertEqual(verify.get_verifications(), count + 2)
+
     def test_isvalid(self):
         sk = SigningKey.generate()
         pubkey = bytes(sk.verify_key)
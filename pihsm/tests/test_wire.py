@@ -0,0 +1,226 @@
+# pihsm: Turn your Raspberry Pi into a Hardware Security Module 
+# Copyright (C) 2017 System76, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+from unittest import TestCase
+import os
+
+from .helpers import random_digest
+from ..sign import Signer
+from ..verify import isvalid
+from .. import common, wire
+
+
+class TestConstants(TestCase):
+    def test_sizes(self):
+        self.assertEqual(wire.COMPACT, 120)
+        self.assertEqual(wire.PAYLOAD_SIZES, {
+            wire.FULL_REQUEST: 224,
+            wire.COMPACT_REQUEST: 120,
+            wire.RESPONSE_PREFIX: 176,
+            wire.NEED_FULL: 64,
+            wire.BAUDRATE: 224,
+            wire.PING: 16,
+            wire.STATUS: 224,
+        })
+        self.assertEqual(wire.BATCH_SIZES, {
+            wire.BATCH_REQUEST: frozenset(
+                [224, 344, 464, 584, 704, 824, 944, 1064]
+            ),
+            wire.BATCH_RESPONSE: frozenset(
+                [176, 352, 528, 704, 880, 1056, 1232, 1408]
+            ),
+        })
+        self.assertEqual(wire.MAX_PAYLOAD, 1408)
+        self.assertEqual(wire.OVERHEAD, 11)
+        self.assertEqual(wire.MAX_FRAME, 1419)
+
+
+def _frames(count):
+    # Payloads that can't contain the preamble, so every frame is recoverable:
+    return [
+        (wire.NEED_FULL, seq, bytes([seq % 128]) * 64) for seq in range(count)
+    ]
+
+
+class TestFrameDecoder(TestCase):
+    def test_init(self):
+        d = wire.FrameDecoder()
+        self.assertEqual(len(d), 0)
+        self.assertEqual(d.bad_frames, 0)
+        self.assertEqual(d.discarded, 0)
+        self.assertIsNone(d.next())
+        self.assertEqual(d.needed(), 7)
+
+    def test_next(self):
+        frames = _frames(3)
+        stream = b''.join(wire.pack_frame(*f) for f in frames)
+
+        # All at once:
+        d = wire.FrameDecoder()
+        d.feed(stream)
+        self.assertEqual([d.next() for i in range(4)], frames + [None])
+        self.assertEqual(len(d), 0)
+
+        # A byte at a time, asking for exactly what's needed:
+        d = wire.FrameDecoder()
+        decoded = []
+        pos = 0
+        while pos < len(stream):
+            size = d.needed()
+            self.assertGreater(size, 0)
+            d.feed(stream[pos:pos + size])
+            pos += size
+            frame = d.next()
+            if frame is not None:
+                decoded.append(frame)
+        self.assertEqual(decoded, frames)
+        self.assertEqual(d.discarded, 0)
+
+    def test_resync(self):
+        frames = _frames(2)
+        packed = [wire.pack_frame(*f) for f in frames]
+
+        # Junk before a frame, including a partial preamble at the end:
+        for junk in [b'\x00', os.urandom(50).replace(b'\xa5', b''),
+                wire.MAGIC[:1], b'\x00' + wire.MAGIC + b'\x00' * 5]:
+            d = wire.FrameDecoder()
+            d.feed(junk + packed[0])
+            self.assertEqual(d.next(), frames[0])
+            self.assertEqual(d.discarded, len(junk))
+
+        # Any single corrupted byte costs only the frame it's in:
+        for i in range(len(packed[0])):
+            bad = bytearray(packed[0])
+            bad[i] ^= 0xFF
+            d = wire.FrameDecoder()
+            d.feed(bytes(bad) + packed[1])
+            self.assertEqual(d.next(), frames[1], i)
+            self.assertIsNone(d.next())
+            self.assertEqual(d.discarded, len(bad))
+
+    def test_reset(self):
+        d = wire.FrameDecoder()
+        d.feed(wire.pack_frame(*_frames(1)[0])[:20])
+        self.assertIsNone(d.next())
+        self.assertEqual(len(d), 20)
+        d.reset()
+        self.assertEqual(len(d), 0)
+        self.assertEqual(d.discarded, 0)
+
+
+class TestFunctions(TestCase):
+    def test_seq(self):
+        self.assertEqual(wire.next_seq(0), 1)
+        self.assertEqual(wire.next_seq(65535), 0)
+        self.assertEqual(wire.seq_distance(10, 10), 0)
+        self.assertEqual(wire.seq_distance(10, 13), 3)
+        self.assertEqual(wire.seq_distance(65534, 1), 3)
+        self.assertEqual(wire.seq_distance(13, 10), 65533)
+
+    def test_pack_frame(self):
+        payload = os.urandom(224)
+        frame = wire.pack_frame(wire.FULL_REQUEST, 258, payload)
+        self.assertEqual(len(frame), wire.OVERHEAD + 224)
+        self.assertEqual(frame[:7], wire.MAGIC + b'\x31\x02\x01\xe0\x00')
+        self.assertEqual(frame[7:-4], payload)
+        self.assertTrue(wire.check_crc(frame[2:]))
+        self.assertEqual(wire.unpack_header(frame[2:7]),
+            (wire.FULL_REQUEST, 258, 224)
+        )
+        with self.assertRaises(ValueError) as cm:
+            wire.pack_frame(wire.RESPONSE_PREFIX, 0, payload)
+        self.assertEqual(str(cm.exception),
+            'frame type 3: expected 176 bytes; got 224'
+        )
+        with self.assertRaises(ValueError) as cm:
+            wire.pack_frame(wire.BATCH_RESPONSE, 0, payload)
+        self.assertEqual(str(cm.exception),
+            'frame type 9: bad batch size 224'
+        )
+
+    def test_unpack_header(self):
+        for ftype in wire.PAYLOAD_SIZES:
+            frame = wire.pack_frame(ftype, 7, bytes(wire.PAYLOAD_SIZES[ftype]))
+            self.assertEqual(wire.unpack_header(frame[2:7]),
+                (ftype, 7, wire.PAYLOAD_SIZES[ftype])
+            )
+        for (ftype, sizes) in wire.BATCH_SIZES.items():
+            for size in sizes:
+                frame = wire.pack_frame(ftype, 7, bytes(size))
+                self.assertEqual(wire.unpack_header(frame[2:7]),
+                    (ftype, 7, size)
+                )
+        for header in [b'\x21\x00\x00\xe0\x00', b'\x30\x00\x00\xe0\x00',
+                b'\x3f\x00\x00\xe0\x00', b'\x31\x00\x00\xe1\x00',
+                b'\x38\x00\x00\xe1\x00', b'\x39\x00\x00\xe0\x00']:
+            self.assertIsNone(wire.unpack_header(header))
+
+    def test_check_crc(self):
+        frame = wire.pack_frame(wire.NEED_FULL, 1, os.urandom(64))[2:]
+        self.assertTrue(wire.check_crc(frame))
+        for i in range(len(frame)):
+            bad = bytearray(frame)
+            bad[i] ^= 0x80
+            self.assertFalse(wire.check_crc(bytes(bad)))
+
+    def test_compact_request(self):
+        s = Signer()
+        requests = [s.sign(random_digest()) for i in range(3)]
+        for (previous, request) in zip(requests, requests[1:]):
+            self.assertTrue(wire.follows(previous, request))
+            self.assertFalse(wire.follows(request, previous))
+            compact = wire.compact_request(request)
+            self.assertEqual(len(compact), wire.COMPACT)
+            self.assertEqual(compact[:64], common.get_signature(request))
+            self.assertEqual(compact[-48:], common.get_message(request))
+            self.assertEqual(wire.expand_request(previous, compact), request)
+            self.assertFalse(isvalid(wire.expand_request(request, compact)))
+        self.assertFalse(wire.follows(None, requests[0]))
+        self.assertFalse(wire.follows(requests[0], requests[2]))
+        self.assertFalse(
+            wire.follows(requests[0], Signer().sign(random_digest()))
+        )
+
+    def test_rebuild_response(self):
+        client = Signer()
+        server = Signer()
+        request = client.sign(random_digest())
+        response = server.sign(request)
+        self.assertEqual(
+            wire.rebuild_response(response[:common.PREFIX], request),
+            response
+        )
+
+    def test_batch(self):
+        client = Signer()
+        server = Signer()
+        requests = [client.sign(random_digest()) for i in range(wire.MAX_BATCH)]
+        responses = [server.sign(r) for r in requests]
+        for count in [1, 2, wire.MAX_BATCH]:
+            payload = wire.pack_batch(requests[:count])
+            self.assertEqual(len(payload), 224 + 120 * (count - 1))
+            self.assertEqual(wire.unpack_batch(payload), requests[:count])
+            payload = wire.pack_batch_response(responses[:count])
+            self.assertEqual(len(payload), 176 * count)
+            self.assertEqual(
+                wire.unpack_batch_response(payload, requests[:count]),
+                responses[:count]
+            )
+            self.assertIsNone(
+                wire.unpack_batch_response(payload, requests[1:count])
+            )
+        with self.assertRaises(AssertionError):
+            wire.pack_batch([requests[0], requests[2]])
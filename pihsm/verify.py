@@ -15,6 +15,7 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 from collections import namedtuple
+import threading
 
 from nacl.signing import VerifyKey
 from nacl.exceptions import BadSignatureError
@@ -44,7 +45,21 @@ def get_counter(signed):
     return int.from_bytes(cnt, 'little')
 
 
+# Every Ed25519 verification this process makes.  A signature should be
+# checked once per process it passes through, so this over the number of
+# requests served shows when one is being checked again:
+_verifications = 0
+_verifications_lock = threading.Lock()
+
+
+def get_verifications():
+    return _verifications
+
+
 def verify_message(signed):
+    global _verifications
+    with _verifications_lock:
+        _verifications += 1
     VerifyKey(get_pubkey(signed)).verify(signed)
 
 
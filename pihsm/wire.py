@@ -0,0 +1,284 @@
+# pihsm: Turn your Raspberry Pi into a Hardware Security Module 
+# Copyright (C) 2017 System76, Inc.
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+"""
+Serial wire format.
+
+Every frame starts with a 2-byte magic preamble, then a 5-byte header (the
+wire version in the high nibble and the frame type in the low nibble of the
+first byte, then a 16-bit sequence number and a 16-bit payload length),
+followed by the payload and a CRC-32 of the header and payload.  The payload
+size is fixed by the frame type.
+
+After a corrupt or truncated frame, a receiver finds the next frame boundary
+by scanning for the preamble; a false match inside a payload is caught by the
+header and CRC checks.
+
+A compact request leaves out the public key, previous signature and counter,
+which the server can derive from the previous request it signed for the same
+client.  The server only returns the 176-byte prefix of its response, as the
+client already has the request that makes up the rest.
+
+A ping is answered with a status frame without signing anything into the
+chain.
+
+A batch request carries up to MAX_BATCH consecutive requests from one client
+chain: the first in full, the rest compact.  The server signs them all and
+answers with one batch response holding the response prefixes in order.  The
+payload size of a batch frame depends on how many requests it carries.
+"""
+
+import struct
+from zlib import crc32
+
+from .common import (
+    SIGNATURE,
+    TIMESTAMP,
+    DIGEST,
+    PREFIX,
+    REQUEST,
+    get_signature,
+    get_pubkey,
+    get_previous,
+    get_counter,
+    get_message,
+)
+
+
+WIRE_VERSION = 3
+
+FULL_REQUEST = 1
+COMPACT_REQUEST = 2
+RESPONSE_PREFIX = 3
+NEED_FULL = 4
+BAUDRATE = 5
+PING = 6
+STATUS = 7
+BATCH_REQUEST = 8
+BATCH_RESPONSE = 9
+
+COMPACT = SIGNATURE + TIMESTAMP + DIGEST
+PING_NONCE = 16
+MAX_BATCH = 8
+
+PAYLOAD_SIZES = {
+    FULL_REQUEST: REQUEST,
+    COMPACT_REQUEST: COMPACT,
+    RESPONSE_PREFIX: PREFIX,
+    NEED_FULL: SIGNATURE,
+    BAUDRATE: REQUEST,
+    PING: PING_NONCE,
+    STATUS: REQUEST,
+}
+BATCH_SIZES = {
+    BATCH_REQUEST: frozenset(
+        REQUEST + COMPACT * (n - 1) for n in range(1, MAX_BATCH + 1)
+    ),
+    BATCH_RESPONSE: frozenset(PREFIX * n for n in range(1, MAX_BATCH + 1)),
+}
+MAX_PAYLOAD = max(
+    max(PAYLOAD_SIZES.values()),
+    max(max(sizes) for sizes in BATCH_SIZES.values()),
+)
+
+MAGIC = b'\xa5\x7e'
+HEADER = struct.Struct('<BHH')
+CRC = 4
+OVERHEAD = len(MAGIC) + HEADER.size + CRC
+MAX_FRAME = OVERHEAD + MAX_PAYLOAD
+SEQ_MASK = 0xFFFF
+
+
+def next_seq(seq):
+    return (seq + 1) & SEQ_MASK
+
+
+# How far *seq* is ahead of *expected*, modulo the sequence space:
+def seq_distance(expected, seq):
+    return (seq - expected) & SEQ_MASK
+
+
+def valid_size(ftype, size):
+    if ftype in BATCH_SIZES:
+        return size in BATCH_SIZES[ftype]
+    return PAYLOAD_SIZES.get(ftype) == size
+
+
+def pack_frame(ftype, seq, payload):
+    if ftype in BATCH_SIZES:
+        if len(payload) not in BATCH_SIZES[ftype]:
+            raise ValueError('frame type {}: bad batch size {}'.format(
+                ftype, len(payload))
+            )
+    elif len(payload) != PAYLOAD_SIZES[ftype]:
+        raise ValueError('frame type {}: expected {} bytes; got {}'.format(
+            ftype, PAYLOAD_SIZES[ftype], len(payload))
+        )
+    assert 0 <= seq <= SEQ_MASK
+    frame = HEADER.pack((WIRE_VERSION << 4) | ftype, seq, len(payload)) \
+        + payload
+    return MAGIC + frame + crc32(frame).to_bytes(CRC, 'little')
+
+
+def unpack_header(header):
+    assert len(header) == HEADER.size
+    (first, seq, size) = HEADER.unpack(header)
+    if first >> 4 != WIRE_VERSION:
+        return None
+    ftype = first & 0x0F
+    if not valid_size(ftype, size):
+        return None
+    return (ftype, seq, size)
+
+
+def check_crc(frame):
+    assert len(frame) > CRC
+    return crc32(frame[:-CRC]) == int.from_bytes(frame[-CRC:], 'little')
+
+
+# Finds frames in a byte stream, without doing any I/O itself:
+class FrameDecoder:
+    __slots__ = ('data', 'bad_frames', 'discarded')
+
+    def __init__(self):
+        self.data = bytearray()
+        self.bad_frames = 0
+        self.discarded = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def feed(self, data):
+        self.data += data
+
+    def reset(self):
+        self.data.clear()
+
+    def _skip(self, size):
+        self.discarded += size
+        del self.data[:size]
+
+    # Drop everything before the next preamble (keeping a trailing partial
+    # one), and return the header at the start of the buffer if we have it:
+    def _sync(self):
+        while True:
+            i = self.data.find(MAGIC)
+            if i < 0:
+                keep = (1 if self.data.endswith(MAGIC[:1]) else 0)
+                self._skip(len(self.data) - keep)
+                return None
+            self._skip(i)
+            start = len(MAGIC)
+            if len(self.data) < start + HEADER.size:
+                return None
+            header = unpack_header(bytes(self.data[start:start + HEADER.size]))
+            if header is not None:
+                return header
+            self.bad_frames += 1
+            self._skip(1)
+
+    # Bytes to read before next() can return a frame (at least 1):
+    def needed(self):
+        header = self._sync()
+        if header is None:
+            return len(MAGIC) + HEADER.size - len(self.data)
+        return len(MAGIC) + HEADER.size + header[2] + CRC - len(self.data)
+
+    def next(self):
+        while True:
+            header = self._sync()
+            if header is None:
+                return None
+            (ftype, seq, size) = header
+            start = len(MAGIC)
+            end = start + HEADER.size + size + CRC
+            if len(self.data) < end:
+                return None
+            if check_crc(self.data[start:end]):
+                payload = bytes(self.data[start + HEADER.size:end - CRC])
+                del self.data[:end]
+                return (ftype, seq, payload)
+            self.bad_frames += 1
+            self._skip(1)
+
+
+def compact_request(request):
+    assert len(request) == REQUEST
+    return b''.join([
+        get_signature(request),
+        request[168:176],
+        get_message(request),
+    ])
+
+
+def expand_request(previous, compact):
+    assert len(previous) == REQUEST
+    assert len(compact) == COMPACT
+    return b''.join([
+        compact[0:64],
+        get_pubkey(previous),
+        get_signature(previous),
+        (get_counter(previous) + 1).to_bytes(8, 'little'),
+        compact[64:72],
+        compact[72:120],
+    ])
+
+
+def follows(previous, request):
+    return previous is not None \
+        and get_pubkey(request) == get_pubkey(previous) \
+        and get_previous(request) == get_signature(previous) \
+        and get_counter(request) == get_counter(previous) + 1
+
+
+def rebuild_response(prefix, request):
+    assert len(prefix) == PREFIX
+    assert len(request) == REQUEST
+    return prefix + request
+
+
+# The requests must follow each other, so all but the first can be compact:
+def pack_batch(requests):
+    assert 0 < len(requests) <= MAX_BATCH
+    for (previous, request) in zip(requests, requests[1:]):
+        assert follows(previous, request)
+    return b''.join(
+        [requests[0]] + [compact_request(r) for r in requests[1:]]
+    )
+
+
+# Expands every request against the one before it; the caller still has to
+# check the signatures:
+def unpack_batch(payload):
+    assert len(payload) in BATCH_SIZES[BATCH_REQUEST]
+    requests = [payload[:REQUEST]]
+    for i in range(REQUEST, len(payload), COMPACT):
+        requests.append(expand_request(requests[-1], payload[i:i + COMPACT]))
+    return requests
+
+
+def pack_batch_response(responses):
+    assert 0 < len(responses) <= MAX_BATCH
+    return b''.join(response[:PREFIX] for response in responses)
+
+
+def unpack_batch_response(payload, requests):
+    if len(payload) != PREFIX * len(requests):
+        return None
+    return [
+        rebuild_response(payload[i * PREFIX:(i + 1) * PREFIX], request)
+        for (i, request) in enumerate(requests)
+    ]
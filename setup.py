@@ -39,10 +39,12 @@ TREE = path.dirname(path.abspath(__file__))
 SCRIPTS = [
     'pihsm-private',
     'pihsm-server',
+    'pihsm-combined',
     'pihsm-display',
     'pihsm-display-enable',
     'pihsm-client',
     'pihsm-request',
+    'pihsm-benchmark',
 ]
 
 